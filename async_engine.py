@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import Future
+import m3u8
+from rich import print
+import segment_store
+from decrypt import PlaylistKeys
+from manifest import SegmentManifest
+from metrics import metrics
+from progress import progress
+from library import pending_episodes
+from pipeline import MergeJob, PostProcessor, merge_episode
+from myself import AnimeTotalInfoTableDict, Myself
+from myself_async import AsyncMyself
+from retry import EpisodeSource, IncompleteEpisodeError, RetryPolicy
+from variants import VariantDict, needs_probe, pick_variant, record_probe, variant_label, variant_path, variants_of
+
+log = logging.getLogger("rich")
+
+
+async def download_ts_async(client: AsyncMyself,
+                            budget: asyncio.Semaphore,
+                            source: EpisodeSource,
+                            directory: str,
+                            uri: str,
+                            manifest: SegmentManifest | None = None,
+                            retry: RetryPolicy | None = None,
+                            keys: PlaylistKeys | None = None,
+                            index: int = 0) -> int:
+    # the manifest stats, appends and with --checksum hashes whole files, keep it off the loop like the store
+    if manifest is not None and await asyncio.to_thread(manifest.is_complete, uri):
+        return 0
+
+    policy = retry or RetryPolicy()
+    path = os.path.join(directory, uri)
+    # the store is sqlite and file links, keep it off the loop
+    store = segment_store.store
+    tag = keys.fingerprint(index) if keys is not None else ''
+    if store is not None:
+        cached_url = source.segment_url(uri)
+        length = None
+        if await asyncio.to_thread(store.cached, cached_url, tag):
+            async with budget:
+                length = await client.content_length(cached_url)
+        if await asyncio.to_thread(store.fetch, cached_url, path, tag, length) is not None:
+            if manifest is not None:
+                await asyncio.to_thread(manifest.record, uri)
+            return 0
+    header = keys.header(index) if keys is not None else b''
+    for attempt in range(policy.attempts):
+        video_url = source.video_url
+        ts_url = source.segment_url(uri, video_url)
+        # chunks are decrypted as they arrive, a CBC stream cannot pick up in the middle
+        decryptor = keys.decryptor(index) if keys is not None else None
+        start = await asyncio.to_thread(manifest.partial_size, uri) \
+            if manifest is not None and decryptor is None and not header else 0
+        sha256 = hashlib.sha256() if store is not None else None
+        try:
+            async with budget:
+                with metrics.span('segment') as span, progress.attempt():
+                    span.bytes = await client.download_to(ts_url, path, start=start, decryptor=decryptor, header=header,
+                                                          sha256=sha256)
+            break
+        except ValueError as e:
+            # a failover resolves the episode again over the blocking websocket client
+            await asyncio.to_thread(source.report_failure, video_url)
+            if attempt + 1 >= policy.attempts:
+                raise
+            delay = policy.delay(attempt, e)
+            metrics.inc('retries_total', error=type(e).__name__)
+            log.debug(f'attempt {attempt + 1} of {uri} failed ({e}), retrying in {delay:.1f}s')
+            # sleep outside the budget so a backing-off segment does not hold a slot
+            await asyncio.sleep(delay)
+    source.report_success()
+
+    if store is not None and sha256 is not None:
+        await asyncio.to_thread(store.add, ts_url, path, tag, sha256.hexdigest(), span.bytes if start == 0 else None)
+    if manifest is not None:
+        await asyncio.to_thread(manifest.record, uri)
+    return span.bytes
+
+
+async def media_playlist_async(client: AsyncMyself,
+                               m3u8_url: str,
+                               quality: str = 'best',
+                               probe_segments: int = 2) -> tuple[m3u8.M3U8, str, VariantDict | None]:
+    # the I/O of variants.media_playlist, with the probe running on the loop
+    playlist = m3u8.loads(await client.get_m3u8_text(m3u8_url), uri=m3u8_url)
+    if not playlist.is_variant:
+        return playlist, m3u8_url, None
+
+    variants = variants_of(playlist)
+    probed: m3u8.M3U8 | None = None
+    if needs_probe(variants, quality, probe_segments):
+        probed = m3u8.loads(await client.get_m3u8_text(variants[0]['uri']), uri=variants[0]['uri'])
+        urls = [s.absolute_uri for s in probed.segments[:probe_segments]]
+        start = time.perf_counter()
+        try:
+            contents = await asyncio.gather(*(client.get_content(url) for url in urls))
+            if urls:
+                record_probe(urls[0], sum(map(len, contents)), time.perf_counter() - start)
+        except ValueError as e:
+            log.warning(f'throughput probe failed: {e}')
+
+    chosen = pick_variant(variants, quality)
+    if probed is not None and chosen is variants[0]:
+        return probed, chosen['uri'], chosen
+    return m3u8.loads(await client.get_m3u8_text(chosen['uri']), uri=chosen['uri']), chosen['uri'], chosen
+
+
+async def download_episode_async(client: AsyncMyself,
+                                 budget: asyncio.Semaphore,
+                                 thread_id: int,
+                                 episode_index: int,
+                                 anime_info: AnimeTotalInfoTableDict,
+                                 download_dir: str = '.',
+                                 resume: bool = True,
+                                 checksum: bool = False,
+                                 retry: RetryPolicy | None = None,
+                                 failover_after: int = 3,
+                                 quality: str = 'best',
+                                 probe_segments: int = 2,
+                                 post: PostProcessor | None = None) -> Future | None:
+    episode_info = anime_info['video'][episode_index]
+    merged_mp4 = f'{anime_info["name"]} {episode_info["name"]}.mp4'
+    video_url, m3u8_url = await client.parse_episode_url(episode_info['url'])
+    m3u8_obj, media_url, variant = await media_playlist_async(client, m3u8_url, quality, probe_segments)
+    if (path := variant_path(video_url, media_url)) is not None:
+        source = EpisodeSource(episode_info['url'], video_url, failover_after=failover_after, variant=path)
+    else:
+        # the variant lives on another host, re-resolving the episode would not move it
+        source = EpisodeSource(episode_info['url'], media_url[:media_url.rfind('/')], failover_after=0)
+
+    ts_dir = os.path.join(os.curdir, 'ts', str(thread_id), str(episode_index))
+    if variant is not None:
+        ts_dir += f'-{variant_label(variant)}'
+    manifest: SegmentManifest | None = None
+    if resume:
+        os.makedirs(ts_dir, exist_ok=True)
+        for leftover in ('files.txt', merged_mp4):
+            if os.path.exists(os.path.join(ts_dir, leftover)):
+                os.remove(os.path.join(ts_dir, leftover))
+        manifest = await asyncio.to_thread(SegmentManifest, ts_dir, checksum)
+    else:
+        shutil.rmtree(ts_dir, ignore_errors=True)
+        os.makedirs(ts_dir, exist_ok=True)
+
+    log.info(f'Downloading {anime_info["name"]}: {episode_info["name"]}...')
+
+    # keys and init sections are fetched once up front, the segment tasks only read them
+    keys = PlaylistKeys(m3u8_obj)
+    urls = keys.urls()
+    for url, data in zip(urls, await asyncio.gather(*(client.get_content(url) for url in urls))):
+        keys.add(url, data)
+
+    with progress.episode(os.path.splitext(merged_mp4)[0], len(m3u8_obj.segments)) as episode:
+        # every segment task starts with a copy of this context and counts its chunks for the episode
+        with progress.track(episode):
+            tasks = {asyncio.create_task(download_ts_async(
+                client,
+                budget,
+                source=source,
+                directory=ts_dir,
+                uri=m3u8_data.uri,
+                manifest=manifest,
+                retry=retry,
+                keys=keys,
+                index=i
+            )): m3u8_data.uri for i, m3u8_data in enumerate(m3u8_obj.segments)}
+
+        metrics.gauge('segments_pending', len(tasks))
+        missing: list[str] = []
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if (error := task.exception()) is not None:
+                        log.warning(f'{tasks[task]}: {error}')
+                        missing.append(tasks[task])
+                        episode.segment_done()
+                    else:
+                        episode.segment_done(task.result())
+                    metrics.gauge('segments_pending', -1)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    if missing:
+        # leave ts/ in place so the next run only fetches what is missing
+        raise IncompleteEpisodeError(f'{anime_info["name"]} {episode_info["name"]}', missing)
+
+    if post is not None:
+        # submit blocks while the remux queue is full, the returned future resolves once published
+        log.info(f'{episode_info["name"]} downloaded!')
+        return await asyncio.to_thread(post.submit, (thread_id, episode_index),
+                                       MergeJob(ts_dir, merged_mp4, download_dir, episode_info['name'],
+                                                thread_id, episode_info['url'], tuple(tasks.values())))
+
+    # ffmpeg and the move to the destination block, keep them off the event loop
+    await asyncio.to_thread(merge_episode, ts_dir, merged_mp4, download_dir, episode_info['name'],
+                            thread_id, episode_info['url'], list(tasks.values()))
+    log.info(f'{episode_info["name"]} downloaded!')
+    return None
+
+
+async def download_anime_async(thread_id: int,
+                               download_dir: str = '.',
+                               max_inflight: int = 32,
+                               e_concurrency: int = 4,
+                               episode_list: list[int] = [],
+                               resume: bool = True,
+                               checksum: bool = False,
+                               retry: RetryPolicy | None = None,
+                               failover_after: int = 3,
+                               quality: str = 'best',
+                               probe_segments: int = 2,
+                               remux_workers: int = 1,
+                               publish_workers: int = 1,
+                               stage_queue: int = 2):
+    post = PostProcessor(remux_workers, publish_workers, stage_queue) if remux_workers > 0 else None
+    async with AsyncMyself(limit=max_inflight) as client:
+        print(f'fetching anime info of {thread_id}...')
+        anime_info = await client.anime_total_info(url=Myself.thread_url(thread_id))
+
+        download_dir = os.path.join(download_dir, anime_info['name'])
+        download_list = pending_episodes(anime_info, download_dir, episode_list, thread_id=thread_id)
+
+        # one segment budget shared by every episode, episodes only bound ts/ usage and merges
+        budget = asyncio.Semaphore(max_inflight)
+        episodes = asyncio.Semaphore(e_concurrency)
+
+        async def run(e: int):
+            async with episodes:
+                published = await download_episode_async(client, budget, thread_id, e, anime_info,
+                                                         download_dir=download_dir,
+                                                         resume=resume,
+                                                         checksum=checksum,
+                                                         retry=retry,
+                                                         failover_after=failover_after,
+                                                         quality=quality,
+                                                         probe_segments=probe_segments,
+                                                         post=post)
+            # the episode slot is free again while the stages merge and publish
+            if published is not None:
+                await asyncio.wrap_future(published)
+
+        tasks = [asyncio.create_task(run(e)) for e in download_list]
+        failed = 0
+        with progress.run(len(tasks)):
+            for task in asyncio.as_completed(tasks):
+                try:
+                    await task
+                except Exception as e:
+                    failed += 1
+                    log.error(f'episode failed: {e}')
+
+    if post is not None:
+        await asyncio.to_thread(post.close)
+    print(f'finished downloading {anime_info["name"]}' + (f', {failed} episodes failed' if failed else ''))
@@ -0,0 +1,293 @@
+"""
+End to end download benchmark against bench/fake_server.py.
+
+    python -m bench.download_bench --episodes 4 --segments 200 -t 8 -c 4 -o results.json
+    python -m bench.download_bench --engine async --latency 0.05 --error-rate 0.01
+
+Starts the fake site in a child process, runs download_anime (or the async
+engine) in this process inside a temporary directory and reports
+segments/s, MB/s, p50/p99 segment latency, peak RSS and peak thread count.
+The fake segments are not real video, so the remux is replaced by a plain
+concatenation unless --merge is given together with --segment-file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from statistics import quantiles
+from bench.fake_server import add_server_arguments
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.bytes = 0
+        self.errors = 0
+        self.peak_threads = threading.active_count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def record(self, seconds: float, nbytes: int):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.bytes += nbytes
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def _sample(self):
+        while not self._stop.wait(0.05):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self):
+        self._sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._sampler.join()
+
+
+def _instrument(recorder: Recorder):
+    from myself import Myself
+    from myself_async import AsyncMyself
+
+    get_content = Myself.get_content.__func__
+
+    def timed_get_content(cls, url: str, *args, **kwargs):
+        # stream mode reads whole segments, the playlist keys and init sections come through here too
+        if not url.endswith('.ts'):
+            return get_content(cls, url, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            content = get_content(cls, url, *args, **kwargs)
+        except BaseException:
+            recorder.error()
+            raise
+        recorder.record(time.perf_counter() - start, len(content))
+        return content
+
+    Myself.get_content = classmethod(timed_get_content)
+
+    sync_download_to = Myself.download_to.__func__
+
+    def timed_sync_download_to(cls, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            written = sync_download_to(cls, *args, **kwargs)
+        except BaseException:
+            recorder.error()
+            raise
+        recorder.record(time.perf_counter() - start, written)
+        return written
+
+    Myself.download_to = classmethod(timed_sync_download_to)
+
+    download_to = AsyncMyself.download_to
+
+    async def timed_download_to(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            written = await download_to(self, *args, **kwargs)
+        except BaseException:
+            recorder.error()
+            raise
+        recorder.record(time.perf_counter() - start, written)
+        return written
+
+    AsyncMyself.download_to = timed_download_to
+
+
+def _start_server(args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+    cmd = [sys.executable, '-m', 'bench.fake_server',
+           '--episodes', str(args.episodes),
+           '--segments', str(args.segments),
+           '--segment-size', str(args.segment_size),
+           '--latency', str(args.latency),
+           '--bandwidth', str(args.bandwidth),
+           '--connection-bandwidth', str(args.connection_bandwidth),
+           '--error-rate', str(args.error_rate),
+           '--error-status', str(args.error_status),
+           '--seed', str(args.seed),
+           '--variants', args.variants]
+    if args.segment_file:
+        cmd += ['--segment-file', os.path.abspath(args.segment_file)]
+    if args.encrypt:
+        cmd.append('--encrypt')
+    if args.init_section:
+        cmd.append('--init-section')
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert process.stdout is not None
+    line = process.stdout.readline().strip()
+    if not line.startswith('listening on '):
+        process.kill()
+        raise SystemExit(f'fake server did not start: {line!r}')
+    return process, line[len('listening on '):]
+
+
+def run(args: argparse.Namespace) -> dict:
+    import main
+    import myself
+    import async_engine
+    import pipeline
+    import progress
+    import segment_store
+    import throttle
+
+    server, url = _start_server(args)
+    workdir = tempfile.mkdtemp(prefix='myself-bench-')
+    cwd = os.getcwd()
+    try:
+        myself.site_opt['url'] = url
+        myself.ws_opt['url'] = url.replace('http://', 'ws://') + '/ws'
+        myself.ws_opt['host'] = url.split('://')[1]
+        myself.ws_pool.configure(args.ws_pool_size)
+        myself.session_pool.configure(pool_maxsize=args.threads * args.c)
+        myself.Myself.cache = None
+        throttle.bandwidth.configure(args.limit_rate)
+        progress.progress.configure(args.progress, interval=args.progress_interval)
+
+        if not args.merge:
+            # stand-in for ffmpeg so the publish stage still moves a file of the right size
+            def concat(ts_dir, merged_mp4, segments=None):
+                with open(os.path.join(ts_dir, merged_mp4), 'wb') as out:
+                    for name in segments or sorted(n for n in os.listdir(ts_dir) if n.endswith('.ts')):
+                        with open(os.path.join(ts_dir, name), 'rb') as f:
+                            shutil.copyfileobj(f, out)
+            pipeline.concat_ts_dir = concat
+
+        def download(download_dir: str):
+            if args.engine == 'async':
+                asyncio.run(async_engine.download_anime_async(
+                    args.thread_id, download_dir=download_dir,
+                    max_inflight=args.max_inflight or args.threads * args.c,
+                    e_concurrency=args.c,
+                    quality=args.quality,
+                    remux_workers=args.remux_workers))
+            else:
+                main.download_anime(
+                    args.thread_id, download_dir=download_dir,
+                    threads=args.threads, e_threads=args.c,
+                    stream=args.stream, adaptive=args.adaptive,
+                    max_inflight=args.max_inflight,
+                    quality=args.quality,
+                    remux_workers=args.remux_workers)
+
+        os.chdir(workdir)
+        if args.segment_cache:
+            # fill the store with a first download, the measured one is the re-download
+            segment_store.store = segment_store.SegmentStore(os.path.join(workdir, 'cache'), link=args.segment_link)
+            download('warmup')
+
+        recorder = Recorder()
+        _instrument(recorder)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with recorder:
+            start = time.perf_counter()
+            download('download')
+            elapsed = time.perf_counter() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        store_stats = segment_store.store.stats() if segment_store.store is not None else None
+    finally:
+        if segment_store.store is not None:
+            segment_store.store.close()
+            segment_store.store = None
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.kill()
+        server.wait()
+
+    latencies = sorted(recorder.latencies)
+    cuts = quantiles(latencies, n=100) if len(latencies) >= 2 else latencies * 99
+    return {
+        'config': {
+            'engine': args.engine,
+            'threads': args.threads,
+            'episodes_at_once': args.c,
+            'adaptive': args.adaptive,
+            'stream': args.stream,
+            'max_inflight': args.max_inflight,
+            'episodes': args.episodes,
+            'segments': args.segments,
+            'segment_size': args.segment_size,
+            'latency': args.latency,
+            'bandwidth': args.bandwidth,
+            'connection_bandwidth': args.connection_bandwidth,
+            'error_rate': args.error_rate,
+            'merge': args.merge,
+            'remux_workers': args.remux_workers,
+            'variants': args.variants,
+            'quality': args.quality,
+            'limit_rate': args.limit_rate,
+            'segment_cache': args.segment_cache,
+            'progress': args.progress,
+        },
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'seconds': round(elapsed, 3),
+        'segments_done': len(latencies),
+        'segment_errors': recorder.errors,
+        'segments_per_s': round(len(latencies) / elapsed, 2),
+        'mb_per_s': round(recorder.bytes / 1e6 / elapsed, 2),
+        'latency_p50_ms': round(cuts[49] * 1000, 2) if cuts else None,
+        'latency_p99_ms': round(cuts[98] * 1000, 2) if cuts else None,
+        # ru_maxrss is KB on Linux
+        'peak_rss_mb': round(rss_after / 1024, 1),
+        'rss_growth_mb': round((rss_after - rss_before) / 1024, 1),
+        'peak_threads': recorder.peak_threads,
+        'segment_store': store_stats,
+    }
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('-t', '--threads', type=int, default=8)
+    parser.add_argument('-c', type=int, default=4)
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--stream', choices=['mp4', 'ts'], default=None)
+    parser.add_argument('--max-inflight', type=int, default=None)
+    parser.add_argument('--ws-pool-size', type=int, default=2)
+    parser.add_argument('--quality', default='best', help='with --variants, which one to download (Default: best)')
+    parser.add_argument('--remux-workers', type=int, default=1, help='0 merges inside the download slot (Default: 1)')
+    parser.add_argument('--limit-rate', type=float, default=0, help='client side cap in bytes/s, 0 is unlimited')
+    parser.add_argument('--segment-cache', action='store_true', help='download once to fill a segment store, then measure the re-download')
+    parser.add_argument('--segment-link', choices=['auto', 'reflink', 'copy'], default='auto', help='with --segment-cache (Default: auto)')
+    parser.add_argument('--progress', choices=['off', 'bar', 'log'], default='off', help='draw progress while measuring, to see what it costs (Default: off)')
+    parser.add_argument('--progress-interval', type=float, default=60, help='seconds between lines with --progress log (Default: 60)')
+    parser.add_argument('--thread-id', type=int, default=1)
+    parser.add_argument('--merge', action='store_true', help='run the real merge (PyAV or ffmpeg, see --remuxer in main.py), needs --segment-file')
+    parser.add_argument('-o', '--output', help='append the result as one JSON line to this file')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    if args.merge and not args.segment_file:
+        parser.error('--merge needs --segment-file with a real .ts segment')
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+Local stand-in for Myself-bbs: thread pages, the /ws episode lookup and HLS
+playlists/segments, with knobs for size, latency, bandwidth and errors.
+
+    python -m bench.fake_server --port 8080 --episodes 4 --segments 200 --segment-size 500000
+
+With --variants 1080,720,480 index.m3u8 becomes a master playlist and each
+variant's segments shrink with its height. --encrypt serves AES-128 segments
+behind an EXT-X-KEY (IV from the media sequence) and --init-section adds an
+EXT-X-MAP in front of them.
+
+Prints "listening on http://HOST:PORT" once ready. Point the client at it
+with site_opt['url'] = 'http://HOST:PORT' and ws_opt['url'] = 'ws://HOST:PORT/ws'.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from aiohttp import web
+import hashlib
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from bench.fixtures import finish_list_html, finish_page_html, thread_html, week_html
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    async def take(self, n: int):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= n:
+                self.tokens -= n
+                return
+            await asyncio.sleep((n - self.tokens) / self.rate)
+
+
+class FakeMyself:
+    def __init__(self,
+                 episodes: int = 4,
+                 segments: int = 100,
+                 segment_size: int = 256 * 1024,
+                 segment_file: str | None = None,
+                 latency: float = 0.0,
+                 bandwidth: float = 0.0,
+                 connection_bandwidth: float = 0.0,
+                 error_rate: float = 0.0,
+                 error_status: int = 500,
+                 seed: int = 0,
+                 variants: list[int] | None = None,
+                 finish_pages: int = 3,
+                 encrypt: bool = False,
+                 init_section: bool = False):
+        self.episodes = episodes
+        self.segments = segments
+        self.latency = latency
+        self.connection_bandwidth = connection_bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.bucket = TokenBucket(bandwidth) if bandwidth > 0 else None
+        if segment_file:
+            with open(segment_file, 'rb') as f:
+                self.payload = f.read()
+        else:
+            # null MPEG-TS packets, right shape but nothing ffmpeg can remux
+            packet = b'\x47\x1f\xff\x10' + b'\xff' * 184
+            self.payload = (packet * (segment_size // 188 + 1))[:segment_size]
+        self.variants = sorted(variants or [], reverse=True)
+        self.finish_pages = finish_pages
+        self.key = hashlib.sha256(f'key-{seed}'.encode()).digest()[:16] if encrypt else None
+        # a PAT-sized stand-in, only its position in the output matters
+        self.init = b'\x47\x40\x00\x10' + b'\x00' * 184 if init_section else None
+        self._encrypted: dict[tuple[str | None, int], bytes] = {}
+        self.stats = {'pages': 0, 'not_modified': 0, 'thread': 0, 'ws': 0, 'playlist': 0, 'segments': 0, 'errors': 0, 'bytes': 0}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/thread-{tid}-1-1.html', self.thread)
+        app.router.add_get('/portal.php', self.portal)
+        app.router.add_get('/forum-113-{page}.html', self.finish_page)
+        app.router.add_get('/ws', self.ws)
+        app.router.add_get('/hls/{tid}/{vid}/key.bin', self.get_key)
+        app.router.add_get('/hls/{tid}/{vid}/init.ts', self.get_init)
+        app.router.add_get('/hls/{tid}/{vid}/index.m3u8', self.playlist)
+        app.router.add_get('/hls/{tid}/{vid}/{segment}.ts', self.segment)
+        app.router.add_get('/hls/{tid}/{vid}/{height}p/index.m3u8', self.playlist)
+        app.router.add_get('/hls/{tid}/{vid}/{height}p/{segment}.ts', self.segment)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+    async def thread(self, request: web.Request) -> web.Response:
+        self.stats['thread'] += 1
+        tid = int(request.match_info['tid'])
+        return web.Response(text=thread_html(name=f'Bench {tid}', episodes=self.episodes, tid=tid),
+                            content_type='text/html', charset='utf-8')
+
+    def _page(self, request: web.Request, text: str) -> web.Response:
+        # static pages carry an ETag so catalog refreshes can get a 304
+        etag = '"' + hashlib.sha1(text.encode('utf-8')).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            self.stats['not_modified'] += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        self.stats['pages'] += 1
+        return web.Response(text=text, content_type='text/html', charset='utf-8', headers={'ETag': etag})
+
+    async def portal(self, request: web.Request) -> web.Response:
+        if request.query.get('mod') == 'topic':
+            return self._page(request, finish_list_html())
+        return self._page(request, week_html())
+
+    async def finish_page(self, request: web.Request) -> web.Response:
+        page = int(request.match_info['page'])
+        items = 40 if page <= self.finish_pages else 0
+        return self._page(request, finish_page_html(items=items, first=(page - 1) * 40))
+
+    async def ws(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            self.stats['ws'] += 1
+            payload = json.loads(msg.data)
+            await ws.send_str(json.dumps({'video': f'//{request.host}/hls/{payload["tid"]}/{payload["vid"]}/index.m3u8'}))
+        return ws
+
+    async def playlist(self, request: web.Request) -> web.Response:
+        self.stats['playlist'] += 1
+        if self.variants and 'height' not in request.match_info:
+            lines = ['#EXTM3U']
+            for height in self.variants:
+                bandwidth = int(len(self.payload) * height / self.variants[0] * 8 / 4)
+                lines += [f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={height * 16 // 9}x{height}',
+                          f'{height}p/index.m3u8']
+            return web.Response(text='\n'.join(lines) + '\n', content_type='application/vnd.apple.mpegurl')
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0']
+        prefix = '../' if 'height' in request.match_info else ''
+        # the init section is served in the clear, so it comes before the key
+        if self.init is not None:
+            lines.append(f'#EXT-X-MAP:URI="{prefix}init.ts"')
+        if self.key is not None:
+            lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="{prefix}key.bin"')
+        for i in range(self.segments):
+            lines += ['#EXTINF:4.000,', f'{i:05d}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines) + '\n', content_type='application/vnd.apple.mpegurl')
+
+    async def segment(self, request: web.Request) -> web.StreamResponse:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            headers = {'Retry-After': '1'} if self.error_status in (429, 503) else {}
+            return web.Response(status=self.error_status, headers=headers)
+
+        body = self.payload
+        if 'height' in request.match_info:
+            body = body[:len(body) * int(request.match_info['height']) // self.variants[0]]
+        if self.key is not None:
+            body = self.encrypted(request.match_info.get('height'), int(request.match_info['segment']), body)
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        if (range_header := request.headers.get('Range', '')).startswith('bytes='):
+            start = int(range_header[6:].split('-')[0] or 0)
+            if start >= len(body):
+                return web.Response(status=416, headers={'Content-Range': f'bytes */{len(body)}'})
+            headers['Content-Range'] = f'bytes {start}-{len(body) - 1}/{len(body)}'
+            body = body[start:]
+            status = 206
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_type = 'video/mp2t'
+        response.content_length = len(body)
+        await response.prepare(request)
+        chunk = 64 * 1024
+        for offset in range(0, len(body), chunk):
+            piece = body[offset:offset + chunk]
+            if self.bucket is not None:
+                await self.bucket.take(len(piece))
+            if self.connection_bandwidth:
+                await asyncio.sleep(len(piece) / self.connection_bandwidth)
+            await response.write(piece)
+        await response.write_eof()
+        self.stats['segments'] += 1
+        self.stats['bytes'] += len(body)
+        return response
+
+    def encrypted(self, height: str | None, index: int, body: bytes) -> bytes:
+        if (cached := self._encrypted.get((height, index))) is None:
+            padder = padding.PKCS7(128).padder()
+            encryptor = Cipher(algorithms.AES(self.key), modes.CBC(index.to_bytes(16, 'big'))).encryptor()
+            padded = padder.update(body) + padder.finalize()
+            cached = self._encrypted[(height, index)] = encryptor.update(padded) + encryptor.finalize()
+        return cached
+
+    async def get_key(self, request: web.Request) -> web.Response:
+        self.stats['keys'] = self.stats.get('keys', 0) + 1
+        if self.key is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.key, content_type='application/octet-stream')
+
+    async def get_init(self, request: web.Request) -> web.Response:
+        if self.init is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.init, content_type='video/mp2t')
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--episodes', type=int, default=4, help='episodes per thread (Default: 4)')
+    parser.add_argument('--segments', type=int, default=100, help='segments per episode (Default: 100)')
+    parser.add_argument('--segment-size', type=int, default=256 * 1024, help='bytes per segment (Default: 262144)')
+    parser.add_argument('--segment-file', default=None, help='serve this .ts file for every segment instead of filler')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each segment response starts')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='total bytes/s across all connections, 0 is unlimited')
+    parser.add_argument('--connection-bandwidth', type=float, default=0.0, help='bytes/s per segment response, 0 is unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of segment requests that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='status code of injected failures (Default: 500)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--finish-pages', type=int, default=3, help='finished forum pages with entries (Default: 3)')
+    parser.add_argument('--variants', default='', help='comma separated heights, serves a master playlist with one variant each')
+    parser.add_argument('--encrypt', action='store_true', help='AES-128 encrypt segments behind an EXT-X-KEY')
+    parser.add_argument('--init-section', action='store_true', help='add an EXT-X-MAP init section to the playlists')
+
+
+def server_from_args(args: argparse.Namespace) -> FakeMyself:
+    return FakeMyself(episodes=args.episodes,
+                      segments=args.segments,
+                      segment_size=args.segment_size,
+                      segment_file=args.segment_file,
+                      latency=args.latency,
+                      bandwidth=args.bandwidth,
+                      connection_bandwidth=args.connection_bandwidth,
+                      error_rate=args.error_rate,
+                      error_status=args.error_status,
+                      seed=args.seed,
+                      variants=[int(h) for h in args.variants.split(',') if h],
+                      finish_pages=args.finish_pages,
+                      encrypt=args.encrypt,
+                      init_section=args.init_section)
+
+
+async def _serve(server: FakeMyself, host: str, port: int):
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound = runner.addresses[0][1]
+    print(f'listening on http://{host}:{bound}', flush=True)
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0, help='0 picks a free port')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(server_from_args(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Synthetic pages shaped like the Myself-bbs markup the parsers look at,
+padded with forum boilerplate so parse cost is in the same ballpark as the
+real thing. Recorded pages (see parse_bench.py --record) are better when
+you have them.
+"""
+import html
+
+_NAV = ''.join(f'<li><a href="forum-{j}.html">link {j}</a></li>' for j in range(20))
+_BOILERPLATE = ''.join(
+    f'<div class="bm cl"><ul class="nav">{_NAV}</ul>'
+    f'<script type="text/javascript">var x{i} = {i};</script><p class="xg1">footer text {i}</p></div>'
+    for i in range(60)
+)
+
+
+def thread_html(name: str = '測試動畫', episodes: int = 24, tid: int = 47717, video_host: str = 'v.myself-bbs.com') -> str:
+    items = []
+    for i in range(1, episodes + 1):
+        items.append(
+            f'<li><a href="javascript:;">第 {i:02d} 話</a>'
+            f'<ul class="display_none">'
+            f'<li><a href="javascript:;" class="multiple-url">站內</a>'
+            f'<a href="javascript:;" data-href="https://{video_host}/player/play/{tid}/{i:03d}\r\n" class="various fancybox.iframe">播放</a></li>'
+            f'<li><a href="javascript:;">站外</a><a href="javascript:;" data-href="https://example.com/{i}">播放</a></li>'
+            f'</ul></li>'
+        )
+    return (
+        f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(name)}【連載中】 - Myself</title></head><body>'
+        f'{_BOILERPLATE}'
+        f'<div class="info_box"><div class="info_img_box fl"><img src="https://myself-bbs.com/data/attachment/{tid}.jpg"></div>'
+        f'<div class="info_info"><ul>'
+        f'<li>作品類型: 奇幻</li><li>首播日期: 2024年04月06日</li><li>播出集數: {episodes}</li>'
+        f'<li>原著作者: 某人</li><li>官方網站: https://example.com</li><li>備注: 無</li>'
+        f'</ul><p>這是一段簡介。</p></div></div>'
+        f'<ul class="main_list">{"".join(items)}</ul>'
+        f'{_BOILERPLATE}'
+        f'</body></html>'
+    )
+
+
+def finish_list_html(years: int = 12) -> str:
+    tabs = []
+    for y in range(years):
+        blocks = []
+        for season, month in enumerate(('01', '04', '07', '10')):
+            links = ''.join(
+                f'<li><a href="thread-{y * 1000 + season * 100 + k}-1-1.html" title="動畫 {y}-{season}-{k}">動畫 {k}</a></li>'
+                for k in range(30)
+            )
+            blocks.append(f'<div class="block move-span"><span class="titletext">{2010 + y}年{month}月</span><ul>{links}</ul></div>')
+        tabs.append(f'<div class="tab-title title column cl">{"".join(blocks)}</div>')
+    return f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>完結列表</title></head><body>{_BOILERPLATE}{"".join(tabs)}</body></html>'
+
+
+def finish_page_html(items: int = 120, first: int = 0) -> str:
+    cells = ''.join(
+        f'<div class="c cl"><a href="thread-{40000 + i}-1-1.html" title="完結動畫 {i}"><img src="data/attachment/{i}.jpg"></a></div>'
+        for i in range(first, first + items)
+    )
+    return f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>2013年10月</title></head><body>{_BOILERPLATE}{cells}</body></html>'
+
+
+def week_html(per_day: int = 15) -> str:
+    days = ''.join(
+        '<div class="module cl xl xl1"><ul>' + ''.join(
+            f'<li><a href="thread-{50000 + day * 100 + k}-1-1.html" title="連載動畫 {day}-{k}">連載動畫 {k}</a>'
+            f'<span><font style="color: #333">更新至 {k + 1:02d}<font style="color: red">new</font></font></span></li>'
+            for k in range(per_day)
+        ) + '</ul></div>'
+        for day in range(7)
+    )
+    return f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>Myself</title></head><body>{_BOILERPLATE}<div id="tabSuCvYn">{days}</div></body></html>'
@@ -0,0 +1,130 @@
+"""
+Compare the bs4 and lxml parser backends on recorded or synthetic pages.
+
+    python -m bench.parse_bench                       # synthetic pages
+    python -m bench.parse_bench thread:saved.html finish_list:list.html
+    python -m bench.parse_bench --record thread:https://myself-bbs.com/thread-47717-1-1.html
+
+Every (backend, page) pair runs in its own process so the peak RSS growth
+reported is that parse alone. Outputs of both backends are compared and the
+run fails if they differ.
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+KINDS = ('thread', 'finish_list', 'finish_page')
+BACKENDS = ('bs4', 'lxml')
+
+
+def _load_cases(specs: list[str]) -> list[tuple[str, str, str]]:
+    if not specs:
+        from bench.fixtures import finish_list_html, finish_page_html, thread_html
+        return [
+            ('thread', 'synthetic thread', thread_html()),
+            ('finish_list', 'synthetic finish list', finish_list_html()),
+            ('finish_page', 'synthetic finish page', finish_page_html()),
+        ]
+
+    cases = []
+    for spec in specs:
+        kind, _, path = spec.partition(':')
+        if kind not in KINDS:
+            raise SystemExit(f'unknown page kind "{kind}", expected one of {KINDS}')
+        with open(path, encoding='utf-8') as f:
+            cases.append((kind, os.path.basename(path), f.read()))
+    return cases
+
+
+def _parse(kind: str, text: str):
+    from myself import Myself
+    if kind == 'thread':
+        return Myself.parse_anime_total_info(url='https://myself-bbs.com/thread-0-1-1.html', text=text)
+    if kind == 'finish_list':
+        return Myself.parse_finish_list(text=text)
+    return Myself.parse_finish_anime_page_data(text=text)
+
+
+def _child(backend: str, spec: str, index: int, rounds: int):
+    import myself
+    myself.parser_opt['backend'] = backend
+    kind, name, text = _load_cases([spec] if spec else [])[index]
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = _parse(kind, text)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        _parse(kind, text)
+    elapsed = (time.perf_counter() - start) / rounds
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({
+        'backend': backend,
+        'page': name,
+        'kind': kind,
+        'bytes': len(text.encode('utf-8')),
+        'ms_per_parse': round(elapsed * 1000, 3),
+        'peak_rss_growth_kb': rss_after - rss_before,
+        'digest': hashlib.sha256(json.dumps(result, ensure_ascii=False).encode('utf-8')).hexdigest(),
+    }))
+
+
+def _record(specs: list[str]):
+    from myself import Myself
+    os.makedirs('bench/pages', exist_ok=True)
+    for spec in specs:
+        kind, _, url = spec.partition(':')
+        res = Myself._req(url=url, timeout=(10, 10))
+        path = os.path.join('bench/pages', f'{kind}-{hashlib.sha1(url.encode()).hexdigest()[:8]}.html')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(res.text)
+        print(f'{kind}:{path}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pages', nargs='*', help='KIND:PATH of recorded pages, KIND is one of ' + ', '.join(KINDS))
+    parser.add_argument('-n', '--rounds', type=int, default=20, help='parses per page and backend (Default: 20)')
+    parser.add_argument('-o', '--output', help='also write the results as JSON to this file')
+    parser.add_argument('--record', nargs='+', metavar='KIND:URL', help='save pages under bench/pages for later runs')
+    parser.add_argument('--child', nargs=3, metavar=('BACKEND', 'SPEC', 'INDEX'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        backend, spec, index = args.child
+        return _child(backend, spec, int(index), args.rounds)
+    if args.record:
+        return _record(args.record)
+
+    cases = _load_cases(args.pages)
+    results = []
+    for index, (kind, name, _) in enumerate(cases):
+        spec = args.pages[index] if args.pages else ''
+        digests = set()
+        for backend in BACKENDS:
+            out = subprocess.run(
+                [sys.executable, '-m', 'bench.parse_bench', '-n', str(args.rounds), '--child', backend, spec, str(index if not spec else 0)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            digests.add(result['digest'])
+            results.append(result)
+        if len(digests) != 1:
+            raise SystemExit(f'{name}: bs4 and lxml backends produced different output')
+
+    print(f'{"page":<28}{"backend":<8}{"KB":>8}{"ms/parse":>12}{"peak RSS +KB":>14}')
+    for r in results:
+        print(f'{r["page"][:27]:<28}{r["backend"]:<8}{r["bytes"] // 1024:>8}{r["ms_per_parse"]:>12}{r["peak_rss_growth_kb"]:>14}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
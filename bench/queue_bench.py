@@ -0,0 +1,175 @@
+"""
+Backfill through the job queue with several local worker processes against
+bench/fake_server.py, one of which can be killed halfway.
+
+    python -m bench.queue_bench --shows 4 --episodes 3 --workers 3
+    python -m bench.queue_bench --workers 3 --kill-after 4 --lease 3 --bandwidth 8000000
+    python -m bench.queue_bench --workers 2 --http                # workers go through "queue serve"
+
+The coordinator side runs in this process: it fills a queue file with
+every episode of --shows threads, optionally serves it over HTTP, starts
+--workers processes that each download into a directory of their own,
+like separate machines would, and waits for them. With --kill-after the
+first worker is SIGKILLed that many seconds in, so its leases have to run
+out and be picked up by the others. The run fails unless every job ends
+up done and every episode is on disk in at least one worker's directory.
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from bench.download_bench import _start_server
+from bench.fake_server import add_server_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _point_at(url: str):
+    import myself
+    myself.site_opt['url'] = url
+    myself.ws_opt['url'] = url.replace('http://', 'ws://') + '/ws'
+    myself.ws_opt['host'] = url.split('://')[1]
+    myself.Myself.cache = None
+
+
+def worker(args: argparse.Namespace):
+    """One worker process, started by run with --site."""
+    import main
+    import pipeline
+    from jobs import open_queue
+
+    _point_at(args.site)
+    # the fake segments are not video, concatenate them instead of remuxing
+    def concat(ts_dir, merged_mp4, segments=None):
+        with open(os.path.join(ts_dir, merged_mp4), 'wb') as out:
+            for name in segments or sorted(n for n in os.listdir(ts_dir) if n.endswith('.ts')):
+                with open(os.path.join(ts_dir, name), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+    pipeline.concat_ts_dir = concat
+
+    os.chdir(args.download_dir)
+    stats = main.work_queue(open_queue(args.queue), download_dir='.', threads=args.threads, e_threads=args.c,
+                            lease=args.lease, linger=args.linger, worker=args.name)
+    print(json.dumps(stats), flush=True)
+
+
+def run(args: argparse.Namespace) -> dict:
+    import main
+    from jobs import JobQueue, serve_queue
+
+    server, url = _start_server(args)
+    workdir = tempfile.mkdtemp(prefix='myself-queue-bench-')
+    processes: list[subprocess.Popen] = []
+    http = None
+    try:
+        _point_at(url)
+        queue = JobQueue(os.path.join(workdir, 'jobs.sqlite3'))
+        main.enqueue_shows(queue, list(range(1, args.shows + 1)))
+        spec = queue.path
+        if args.http:
+            http = serve_queue(queue, 0)
+            spec = f'http://127.0.0.1:{http.server_address[1]}'
+
+        start = time.perf_counter()
+        for i in range(args.workers):
+            directory = os.path.join(workdir, f'worker-{i}')
+            os.makedirs(directory)
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'bench.queue_bench', '--site', url, '--queue', spec, '--download-dir', directory,
+                 '--name', f'worker-{i}', '--lease', str(args.lease), '--linger', str(args.linger),
+                 '-t', str(args.threads), '-c', str(args.c)],
+                cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True))
+
+        killed = None
+        if args.kill_after is not None:
+            time.sleep(args.kill_after)
+            processes[0].send_signal(signal.SIGKILL)
+            killed = 'worker-0'
+        results = {}
+        for i, process in enumerate(processes):
+            out, _ = process.communicate()
+            lines = out.strip().splitlines()
+            results[f'worker-{i}'] = json.loads(lines[-1]) if process.returncode == 0 and lines else None
+        elapsed = time.perf_counter() - start
+
+        stats = queue.stats()
+        with queue._lock:
+            reclaimed, = queue._db.execute("SELECT COUNT(*) FROM jobs WHERE attempts > 1").fetchone()
+            jobs = queue._db.execute('SELECT jobs.episode_index, shows.info FROM jobs JOIN shows USING (thread_id)').fetchall()
+        missing = []
+        for episode_index, info in jobs:
+            anime_info = json.loads(info)
+            name = f'{anime_info["name"]} {anime_info["video"][episode_index]["name"]}.mp4'
+            if not any(os.path.exists(os.path.join(workdir, f'worker-{i}', anime_info['name'], name))
+                       for i in range(args.workers)):
+                missing.append(name)
+        queue.close()
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        if http is not None:
+            http.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.kill()
+        server.wait()
+
+    return {
+        'config': {
+            'shows': args.shows,
+            'episodes': args.episodes,
+            'segments': args.segments,
+            'workers': args.workers,
+            'lease': args.lease,
+            'kill_after': args.kill_after,
+            'http': args.http,
+        },
+        'seconds': round(elapsed, 3),
+        'queue': stats,
+        'reclaimed_or_retried': reclaimed,
+        'killed': killed,
+        'workers': results,
+        'missing_episodes': missing,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shows', type=int, default=4, help='thread ids 1..N are queued (Default: 4)')
+    parser.add_argument('--workers', type=int, default=3, help='worker processes (Default: 3)')
+    parser.add_argument('--lease', type=float, default=5, help='lease seconds of every worker (Default: 5)')
+    parser.add_argument('--linger', type=float, default=0, help='--linger of every worker (Default: 0)')
+    parser.add_argument('--kill-after', type=float, default=None, help='SIGKILL the first worker after this many seconds')
+    parser.add_argument('--http', action='store_true', help='serve the queue over HTTP instead of sharing the file')
+    parser.add_argument('-t', '--threads', type=int, default=4)
+    parser.add_argument('-c', type=int, default=2, help='episodes per worker at a time (Default: 2)')
+    parser.add_argument('-o', '--output', help='append the result as one JSON line to this file')
+    # set by run for the worker processes
+    parser.add_argument('--site', help=argparse.SUPPRESS)
+    parser.add_argument('--queue', help=argparse.SUPPRESS)
+    parser.add_argument('--download-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--name', help=argparse.SUPPRESS)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    if args.site:
+        worker(args)
+        return
+
+    result = run(args)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    queue = result['queue']
+    if queue['queued'] or queue['leased'] or queue['failed'] or result['missing_episodes']:
+        raise SystemExit('backfill incomplete')
+
+
+if __name__ == '__main__':
+    main()
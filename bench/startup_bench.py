@@ -0,0 +1,148 @@
+"""
+Cold start of the CLI, measured with `python -X importtime`.
+
+    python -m bench.startup_bench                # compare with bench/startup_baseline.json
+    python -m bench.startup_bench --save         # record the current numbers as the baseline
+    python -m bench.startup_bench -o startup.json
+
+Every case runs main.py in a fresh interpreter a few times. Its import time
+is the sum of the top level imports of a run minus those of a bare
+`python -c pass`, and the median over the runs is compared with the
+baseline. The run fails when a case got slower than its baseline by more
+than --tolerance, or when it loads one of the heavy modules the case must
+not need, which catches a stray top level import on any machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'startup_baseline.json')
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+# only imported once something is fetched, parsed, decrypted or drawn
+HEAVY = ('requests', 'websocket', 'bs4', 'lxml', 'm3u8', 'rich.progress', 'cryptography', 'aiohttp', 'av',
+         'asyncio', 'http.server')
+# the help screens print through argparse, not rich
+HELP_HEAVY = HEAVY + ('rich.console', 'rich.logging', 'rich.table')
+
+
+def _cases(workdir: str) -> list[tuple[str, list[str], tuple[str, ...]]]:
+    cache_dir = os.path.join(workdir, 'cache')
+    return [
+        ('help', ['-h'], HELP_HEAVY),
+        ('download help', ['download', '-h'], HELP_HEAVY),
+        ('catalog search', ['--cache-dir', cache_dir, 'catalog', 'search', 'x'], HEAVY),
+        # the thread page is cached and the episode is on disk, nothing goes out
+        ('nothing to download', ['--cache-dir', cache_dir, 'download', '1', '-d', os.path.join(workdir, 'download')], HEAVY),
+    ]
+
+
+def _seed(workdir: str):
+    from cache import MetadataCache
+    from myself import Myself
+    url = Myself.thread_url(1)
+    cache = MetadataCache(os.path.join(workdir, 'cache'))
+    cache.put('thread', url, {'name': 'show', 'url': url,
+                              'video': [{'name': 'episode 1', 'url': 'https://v.myself-bbs.com/vpx/1/001'}]})
+    cache.close()
+    os.makedirs(os.path.join(workdir, 'download', 'show'), exist_ok=True)
+    open(os.path.join(workdir, 'download', 'show', 'show episode 1.mp4'), 'wb').close()
+
+
+def _importtime(argv: list[str]) -> tuple[float, float, set[str]]:
+    """Import ms of the top level imports, wall ms and every module imported by one run."""
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', *argv], capture_output=True, text=True,
+                          cwd=os.path.dirname(MAIN))
+    wall = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        raise SystemExit(f'{" ".join(argv)} exited with {proc.returncode}:\n{proc.stderr[-2000:]}')
+
+    total = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented below the one that triggered them
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+        modules.add(name.strip())
+    return total / 1000, wall, modules
+
+
+def measure(runs: int) -> list[dict]:
+    with tempfile.TemporaryDirectory() as workdir:
+        _seed(workdir)
+        _importtime(['-c', 'pass'])
+        bare = statistics.median(_importtime(['-c', 'pass'])[0] for _ in range(runs))
+
+        results = []
+        for name, args, heavy in _cases(workdir):
+            # the first run compiles .pyc files and warms the page cache
+            _importtime([MAIN, *args])
+            import_ms, wall_ms, modules = zip(*(_importtime([MAIN, *args]) for _ in range(runs)))
+            loaded = sorted(m for m in heavy if any(m in run for run in modules))
+            results.append({
+                'case': name,
+                'args': [arg.replace(workdir, '$TMP') for arg in args],
+                'import_ms': round(statistics.median(import_ms) - bare, 1),
+                'wall_ms': round(statistics.median(wall_ms), 1),
+                'modules': len(modules[0]),
+                'heavy_loaded': loaded,
+            })
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--runs', type=int, default=7, help='runs per case, the median is used (Default: 7)')
+    parser.add_argument('--baseline', default=BASELINE, help=f'baseline file (Default: {os.path.relpath(BASELINE)})')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline as a fraction (Default: 0.25)')
+    parser.add_argument('--slack', type=float, default=10.0,
+                        help='ms a case may always grow by, absorbs noise on fast cases (Default: 10)')
+    parser.add_argument('--save', action='store_true', help='write the measured numbers to the baseline file')
+    parser.add_argument('-o', '--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    baseline = {}
+    if not args.save and os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            recorded = json.load(f)
+        if recorded.get('python') != platform.python_version():
+            print(f'baseline was recorded with python {recorded.get("python")}, numbers may not compare')
+        baseline = {case['case']: case['import_ms'] for case in recorded['cases']}
+
+    failures = []
+    print(f'{"case":<22}{"import ms":>10}{"baseline":>10}{"wall ms":>10}{"modules":>9}  heavy modules loaded')
+    for r in results:
+        limit = baseline.get(r['case'])
+        print(f'{r["case"]:<22}{r["import_ms"]:>10}{limit if limit is not None else "-":>10}{r["wall_ms"]:>10}'
+              f'{r["modules"]:>9}  {", ".join(r["heavy_loaded"]) or "-"}')
+        if r['heavy_loaded']:
+            failures.append(f'{r["case"]}: imports {", ".join(r["heavy_loaded"])} at startup')
+        if limit is not None and r['import_ms'] > limit * (1 + args.tolerance) + args.slack:
+            failures.append(f'{r["case"]}: {r["import_ms"]}ms of imports, baseline {limit}ms')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'cases': results}, f, indent=2)
+            f.write('\n')
+        print(f'baseline written to {args.baseline}')
+    if failures:
+        raise SystemExit('startup got slower:\n  ' + '\n  '.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, TypedDict
+
+log = logging.getLogger("rich")
+
+# seconds an entry is served without asking the site again, per kind
+DEFAULT_TTL = {
+    'thread': 10 * 60,  # parsed thread page, the episode list lives in here
+    'episode': 6 * 60 * 60,  # (video_url, m3u8_url) from the websocket
+}
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def default_cache_dir() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'myself-downloader')
+
+
+class CacheEntryDict(TypedDict):
+    value: Any
+    fresh: bool
+    etag: str | None
+    last_modified: str | None
+
+
+class MetadataCache:
+    """
+    sqlite backed cache for parsed pages and resolved episode urls.
+
+    Stale entries are still returned (fresh=False) together with their
+    ETag/Last-Modified so callers can revalidate with a conditional request
+    and `touch` the entry on 304. Least recently used entries are dropped
+    once the stored values exceed `max_bytes`.
+    """
+
+    def __init__(self,
+                 directory: str | None = None,
+                 ttl: dict[str, float] | None = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        directory = directory or default_cache_dir()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'cache.sqlite3')
+        self.ttl = {**DEFAULT_TTL, **(ttl or {})}
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (kind, key)
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)')
+
+    def get(self, kind: str, key: str) -> CacheEntryDict | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value, etag, last_modified, stored_at FROM entries WHERE kind = ? AND key = ?',
+                (kind, key)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE entries SET accessed_at = ? WHERE kind = ? AND key = ?', (now, kind, key))
+        value, etag, last_modified, stored_at = row
+        fresh = now - stored_at < self.ttl.get(kind, 0)
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return {'value': json.loads(value), 'fresh': fresh, 'etag': etag, 'last_modified': last_modified}
+
+    def get_fresh(self, kind: str, key: str) -> Any | None:
+        entry = self.get(kind, key)
+        return entry['value'] if entry is not None and entry['fresh'] else None
+
+    def put(self, kind: str, key: str, value: Any, etag: str | None = None, last_modified: str | None = None):
+        text = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, key, text, etag, last_modified, now, now, len(text)))
+            self._evict()
+
+    def touch(self, kind: str, key: str):
+        """Mark an entry fresh again after the site answered 304."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('UPDATE entries SET stored_at = ?, accessed_at = ? WHERE kind = ? AND key = ?',
+                             (now, now, kind, key))
+            self.revalidated += 1
+
+    def delete(self, kind: str, key: str):
+        with self._lock:
+            self._db.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, key))
+
+    def conditional_headers(self, entry: CacheEntryDict | None) -> dict:
+        if entry is None:
+            return {}
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def _evict(self):
+        # called with the lock held
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        rows = self._db.execute('SELECT kind, key, size FROM entries ORDER BY accessed_at').fetchall()
+        for kind, key, size in rows:
+            if freed >= target:
+                break
+            self._db.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, key))
+            freed += size
+        log.debug(f'cache evicted {freed} bytes')
+
+    def clear(self, kind: str | None = None):
+        with self._lock:
+            if kind is None:
+                self._db.execute('DELETE FROM entries')
+            else:
+                self._db.execute('DELETE FROM entries WHERE kind = ?', (kind,))
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'revalidated': self.revalidated}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
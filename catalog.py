@@ -0,0 +1,343 @@
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TypedDict
+from myself import HTTPStatusError, Myself, site_opt
+
+log = logging.getLogger("rich")
+
+CATALOG_NAME = 'catalog.sqlite3'
+
+# seconds a crawled page is trusted before it is requested again
+DEFAULT_MAX_AGE = {
+    'finish_list': 24 * 60 * 60,
+    'finish_page': 24 * 60 * 60,
+    'week': 60 * 60,
+}
+
+
+class CatalogEntryDict(TypedDict):
+    thread_id: int
+    name: str
+    url: str
+    season: str | None
+    weekday: str | None
+    update: str | None
+    image: str | None
+
+
+def thread_id_of(url: str) -> int | None:
+    if match := re.search(r'thread-(\d+)-|tid=(\d+)', url):
+        return int(match.group(1) or match.group(2))
+    return None
+
+
+class RateLimiter:
+    """At most `rate` acquisitions per second across all threads, 0 disables."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Catalog:
+    """
+    Local sqlite index of every anime seen on the finished list, the
+    finished forum pages and the weekly schedule, searchable offline.
+
+    Pages are remembered with their validators and a digest of the body,
+    so a refresh skips pages that are still young, asks the site with a
+    conditional request otherwise, and only re-parses pages that changed.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, CATALOG_NAME)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                digest TEXT,
+                fetched_at REAL NOT NULL,
+                entries INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS anime (
+                thread_id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                name_key TEXT NOT NULL,
+                url TEXT NOT NULL,
+                season TEXT,
+                weekday TEXT,
+                "update" TEXT,
+                image TEXT,
+                seen_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS anime_name_key ON anime (name_key);''')
+        self.fts = self._create_fts()
+
+    def _create_fts(self) -> bool:
+        """
+        Trigram full text index over the names, kept in sync by triggers, so a
+        substring search does not scan every anime. False when this sqlite has
+        no FTS5 or no trigram tokenizer, search then falls back to LIKE.
+        """
+        exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'anime_fts'").fetchone() is not None
+        try:
+            self._db.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS anime_fts USING fts5(
+                    name_key, content='anime', content_rowid='thread_id', tokenize='trigram'
+                );
+                CREATE TRIGGER IF NOT EXISTS anime_fts_insert AFTER INSERT ON anime BEGIN
+                    INSERT INTO anime_fts (rowid, name_key) VALUES (new.thread_id, new.name_key);
+                END;
+                CREATE TRIGGER IF NOT EXISTS anime_fts_delete AFTER DELETE ON anime BEGIN
+                    INSERT INTO anime_fts (anime_fts, rowid, name_key) VALUES ('delete', old.thread_id, old.name_key);
+                END;
+                CREATE TRIGGER IF NOT EXISTS anime_fts_update AFTER UPDATE OF name_key ON anime BEGIN
+                    INSERT INTO anime_fts (anime_fts, rowid, name_key) VALUES ('delete', old.thread_id, old.name_key);
+                    INSERT INTO anime_fts (rowid, name_key) VALUES (new.thread_id, new.name_key);
+                END;''')
+        except sqlite3.OperationalError as e:
+            log.debug(f'catalog: no trigram full text index ({e}), searching with LIKE')
+            return False
+        if not exists:
+            # a catalog crawled before the index existed
+            self._db.execute("INSERT INTO anime_fts (anime_fts) VALUES ('rebuild')")
+        return True
+
+    def page(self, url: str) -> tuple[str | None, str | None, str | None, float, int | None] | None:
+        with self._lock:
+            return self._db.execute('SELECT etag, last_modified, digest, fetched_at, entries FROM pages WHERE url = ?',
+                                    (url,)).fetchone()
+
+    def save_page(self, url: str, etag: str | None, last_modified: str | None, digest: str | None,
+                  entries: int | None = None):
+        """`entries` is how many anime the page listed, so an unchanged page past the last one still ends a crawl."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)',
+                             (url, etag, last_modified, digest, time.time(), entries))
+
+    def upsert(self, entries: list[CatalogEntryDict]):
+        """Insert or update entries, fields that are None keep what is stored."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.executemany('''
+                INSERT INTO anime VALUES (:thread_id, :name, :name_key, :url, :season, :weekday, :update, :image, :seen_at)
+                ON CONFLICT (thread_id) DO UPDATE SET
+                    name = excluded.name,
+                    name_key = excluded.name_key,
+                    url = excluded.url,
+                    season = COALESCE(excluded.season, season),
+                    weekday = COALESCE(excluded.weekday, weekday),
+                    "update" = COALESCE(excluded."update", "update"),
+                    image = COALESCE(excluded.image, image),
+                    seen_at = excluded.seen_at''',
+                [{**entry, 'name_key': entry['name'].casefold(), 'seen_at': now} for entry in entries])
+            self._db.execute('COMMIT')
+
+    def replace_week(self, entries: list[CatalogEntryDict]):
+        """The weekly schedule replaces the previous one, shows that ended lose their weekday."""
+        with self._lock:
+            self._db.execute('UPDATE anime SET weekday = NULL, "update" = NULL WHERE weekday IS NOT NULL')
+        self.upsert(entries)
+
+    def search(self, query: str, limit: int = 20, weekday: str | None = None) -> list[CatalogEntryDict]:
+        """
+        Thread id, name prefix or name substring, case insensitive. Prefix
+        matches come first.
+
+        Queries of three characters or more are answered from the trigram
+        index. Shorter ones, and every query where sqlite lacks FTS5, scan the
+        names with LIKE, which a catalog of a few thousand anime still does in
+        milliseconds.
+        """
+        key = query.strip().casefold()
+        escaped = key.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        thread_id = int(key) if key.isdigit() else -1
+        if self.fts and len(key) >= 3:
+            where = ['thread_id IN (SELECT rowid FROM anime_fts WHERE anime_fts MATCH ? UNION SELECT ?)']
+            params: list = ['"' + key.replace('"', '""') + '"', thread_id]
+        else:
+            where = ["(name_key LIKE ? ESCAPE '\\' OR thread_id = ?)"]
+            params = [f'%{escaped}%', thread_id]
+        if weekday is not None:
+            where.append('weekday = ?')
+            params.append(weekday)
+        with self._lock:
+            rows = self._db.execute(
+                f'''SELECT thread_id, name, url, season, weekday, "update", image FROM anime
+                    WHERE {" AND ".join(where)}
+                    ORDER BY thread_id = ? DESC, name_key LIKE ? ESCAPE '\\' DESC, season DESC, name
+                    LIMIT ?''',
+                params + [thread_id, f'{escaped}%', limit]).fetchall()
+        return [dict(zip(CatalogEntryDict.__annotations__, row)) for row in rows]
+
+    def thread_ids(self) -> list[int]:
+        """Every anime in the catalog, oldest thread first."""
+        with self._lock:
+            return [thread_id for thread_id, in self._db.execute('SELECT thread_id FROM anime ORDER BY thread_id')]
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            anime, = self._db.execute('SELECT COUNT(*) FROM anime').fetchone()
+            airing, = self._db.execute('SELECT COUNT(*) FROM anime WHERE weekday IS NOT NULL').fetchone()
+            pages, = self._db.execute('SELECT COUNT(*) FROM pages').fetchone()
+        return {'anime': anime, 'airing': airing, 'pages': pages}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class CatalogCrawler:
+    """Refreshes a Catalog from the site with `threads` workers and at most `rate` requests per second."""
+
+    def __init__(self,
+                 catalog: Catalog,
+                 threads: int = 4,
+                 rate: float = 2.0,
+                 max_age: dict[str, float] | None = None,
+                 force: bool = False):
+        self.catalog = catalog
+        self.threads = threads
+        self.limiter = RateLimiter(rate)
+        self.max_age = {**DEFAULT_MAX_AGE, **(max_age or {})}
+        self.force = force
+        self.counts = {'skipped': 0, 'unchanged': 0, 'changed': 0, 'failed': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, outcome: str):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def fetch(self, url: str, kind: str) -> tuple[str, str | None, str | None, str] | None:
+        """
+        :return: the page with its ETag, Last-Modified and digest when it
+        changed since the last crawl, None when it is still young, answered
+        304 or has the same digest. The caller saves the page with
+        Catalog.save_page once its entries are stored, so a page that fails
+        to parse is fetched again next time.
+        """
+        stored = self.catalog.page(url)
+        if not self.force and stored is not None and time.time() - stored[3] < self.max_age[kind]:
+            self._count('skipped')
+            return None
+
+        conditional = {}
+        if stored is not None and not self.force:
+            if stored[0]:
+                conditional['If-None-Match'] = stored[0]
+            if stored[1]:
+                conditional['If-Modified-Since'] = stored[1]
+
+        self.limiter.acquire()
+        res = Myself._req(url=url, timeout=(10, 10), extra_headers=conditional or None)
+        if res.status_code == 304:
+            self.catalog.save_page(url, stored[0], stored[1], stored[2], stored[4])
+            self._count('unchanged')
+            return None
+        if not res.ok:
+            raise HTTPStatusError.from_status(res.status_code, res.headers)
+
+        digest = hashlib.sha256(res.content).hexdigest()
+        if not self.force and stored is not None and stored[2] == digest:
+            self.catalog.save_page(url, res.headers.get('ETag'), res.headers.get('Last-Modified'), digest, stored[4])
+            self._count('unchanged')
+            return None
+        self._count('changed')
+        return res.text, res.headers.get('ETag'), res.headers.get('Last-Modified'), digest
+
+    def finish_list(self):
+        url = f"{site_opt['url']}/portal.php?mod=topic&topicid=8"
+        if (page := self.fetch(url, 'finish_list')) is None:
+            return
+        text, *validators = page
+        entries: list[CatalogEntryDict] = []
+        for tab in Myself.parse_finish_list(text=text):
+            for season in tab['data']:
+                for anime in season['data']:
+                    if (thread_id := thread_id_of(anime['url'])) is not None:
+                        entries.append({'thread_id': thread_id, 'name': anime['name'], 'url': anime['url'],
+                                        'season': season['title'], 'weekday': None, 'update': None, 'image': None})
+        self.catalog.upsert(entries)
+        self.catalog.save_page(url, *validators)
+
+    def finish_page(self, page: int) -> bool:
+        """:return: False once past the last page."""
+        url = f"{site_opt['url']}/{site_opt['finish_forum'].format(page=page)}"
+        if (page := self.fetch(url, 'finish_page')) is None:
+            stored = self.catalog.page(url)
+            return stored is None or stored[4] is None or stored[4] > 0
+        text, *validators = page
+        entries: list[CatalogEntryDict] = [{
+            'thread_id': thread_id, 'name': anime['name'], 'url': anime['url'],
+            'season': None, 'weekday': None, 'update': None, 'image': anime['image'],
+        } for anime in Myself.parse_finish_anime_page_data(text=text)
+            if (thread_id := thread_id_of(anime['url'])) is not None]
+        self.catalog.upsert(entries)
+        self.catalog.save_page(url, *validators, len(entries))
+        return len(entries) > 0
+
+    def week(self):
+        url = f"{site_opt['url']}/portal.php"
+        if (page := self.fetch(url, 'week')) is None:
+            return
+        text, *validators = page
+        entries: list[CatalogEntryDict] = []
+        for weekday, animes in Myself.parse_week_anime(text=text).items():
+            for anime in animes:
+                if (thread_id := thread_id_of(anime['url'])) is not None:
+                    entries.append({'thread_id': thread_id, 'name': anime['name'], 'url': anime['url'],
+                                    'season': None, 'weekday': weekday, 'update': anime['update'], 'image': None})
+        self.catalog.replace_week(entries)
+        self.catalog.save_page(url, *validators)
+
+    def refresh(self, pages: int = 100) -> dict[str, int]:
+        """
+        Crawl the finished list, the weekly schedule and up to `pages`
+        finished forum pages, stopping at the first empty page.
+        """
+        from lxml.etree import LxmlError
+
+        def guarded(fn, *args):
+            # a page the parsers choke on is counted and skipped, the others still get crawled
+            try:
+                return fn(*args)
+            except (ValueError, KeyError, IndexError, AttributeError, TypeError, LxmlError) as e:
+                log.warning(f'catalog: {fn.__name__}{args}: {e}')
+                self._count('failed')
+                return True
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            fixed = [executor.submit(guarded, self.finish_list), executor.submit(guarded, self.week)]
+            # pages go out one batch at a time so the crawl stops soon after the last page
+            page = 1
+            while page <= pages:
+                batch = range(page, min(page + self.threads, pages + 1))
+                if not all(executor.map(lambda p: guarded(self.finish_page, p), batch)):
+                    break
+                page = batch[-1] + 1
+            for future in fixed:
+                future.result()
+        return {**self.counts, **self.catalog.stats()}
@@ -0,0 +1,164 @@
+import logging
+import threading
+from typing import Callable
+import m3u8
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from metrics import metrics
+
+log = logging.getLogger("rich")
+
+SUPPORTED_METHODS = ('NONE', 'AES-128')
+
+
+def segment_iv(key: m3u8.Key, media_sequence: int) -> bytes:
+    """The key's IV, or the segment's media sequence number as a 16 byte big-endian integer."""
+    if key.iv:
+        return bytes.fromhex(key.iv[2:] if key.iv[:2].lower() == '0x' else key.iv).rjust(16, b'\0')
+    return media_sequence.to_bytes(16, 'big')
+
+
+class SegmentDecryptor:
+    """
+    Streaming AES-128-CBC decryption of one segment. Feed the body chunk by
+    chunk to `update` and call `finalize` once at the end, which also
+    strips the PKCS#7 padding.
+    """
+
+    def __init__(self, algorithm: algorithms.AES, iv: bytes):
+        self._context = Cipher(algorithm, modes.CBC(iv)).decryptor()
+        self._unpadder = padding.PKCS7(128).unpadder()
+
+    def update(self, data: bytes) -> bytes:
+        return self._unpadder.update(self._context.update(data))
+
+    def finalize(self) -> bytes:
+        # bad padding raises ValueError, so a wrong key or a truncated body is retried like any other failure
+        return self._unpadder.update(self._context.finalize()) + self._unpadder.finalize()
+
+    def decrypt(self, data: bytes) -> bytes:
+        return self.update(data) + self.finalize()
+
+
+class PlaylistKeys:
+    """
+    Keys and EXT-X-MAP init sections of one media playlist.
+
+    Every key and init section uri is fetched once with `fetch`, by
+    whichever worker needs it first, and kept for the rest of the episode.
+    The AES key schedule is set up once per key; each segment only gets a
+    fresh CBC context for its own IV.
+    """
+
+    def __init__(self, playlist: m3u8.M3U8, fetch: Callable[[str], bytes] | None = None):
+        self.fetch = fetch
+        self._segments = playlist.segments
+        self._first_sequence = playlist.media_sequence or 0
+        self._blobs: dict[str, bytes] = {}
+        self._algorithms: dict[str, algorithms.AES] = {}
+        self._inits: dict[tuple[str, str | None], bytes] = {}
+        self._lock = threading.Lock()
+        for segment in self._segments:
+            if segment.key is not None and (segment.key.method or 'NONE') not in SUPPORTED_METHODS:
+                raise ValueError(f'unsupported EXT-X-KEY method {segment.key.method}, '
+                                 f'expected one of {", ".join(SUPPORTED_METHODS)}')
+
+    @staticmethod
+    def _key(segment: m3u8.Segment) -> m3u8.Key | None:
+        if segment.key is None or segment.key.method in (None, 'NONE'):
+            return None
+        return segment.key
+
+    def urls(self) -> list[str]:
+        """Distinct key and init section uris of the playlist that were not fetched yet."""
+        urls: dict[str, None] = {}
+        for segment in self._segments:
+            if (key := self._key(segment)) is not None:
+                urls[key.absolute_uri] = None
+            if segment.init_section is not None:
+                urls[segment.init_section.absolute_uri] = None
+        return [url for url in urls if url not in self._blobs]
+
+    def add(self, url: str, data: bytes):
+        """Hand over a key or init section fetched elsewhere, e.g. on an event loop."""
+        with self._lock:
+            self._blobs[url] = data
+
+    def _blob(self, url: str) -> bytes:
+        with self._lock:
+            if url not in self._blobs:
+                if self.fetch is None:
+                    raise ValueError(f'{url} was not fetched')
+                self._blobs[url] = self.fetch(url)
+                metrics.inc('keys_fetched_total')
+                log.debug(f'fetched {url}')
+            return self._blobs[url]
+
+    def _algorithm(self, key: m3u8.Key) -> algorithms.AES:
+        url = key.absolute_uri
+        if (algorithm := self._algorithms.get(url)) is not None:
+            return algorithm
+        data = self._blob(url)
+        if len(data) != 16:
+            raise ValueError(f'AES-128 key {url} is {len(data)} bytes, expected 16')
+        with self._lock:
+            return self._algorithms.setdefault(url, algorithms.AES(data))
+
+    def _sequence(self, index: int) -> int:
+        sequence = self._segments[index].media_sequence
+        return sequence if sequence is not None else self._first_sequence + index
+
+    def decryptor(self, index: int) -> SegmentDecryptor | None:
+        """A decryptor for the segment at `index`, None when it is not encrypted."""
+        if (key := self._key(self._segments[index])) is None:
+            return None
+        return SegmentDecryptor(self._algorithm(key), segment_iv(key, self._sequence(index)))
+
+    def init_section(self, index: int) -> bytes:
+        """Decrypted EXT-X-MAP init section that applies to the segment at `index`, b'' without one."""
+        segment = self._segments[index]
+        if (init := segment.init_section) is None:
+            return b''
+        cache_key = (init.absolute_uri, init.byterange)
+        if (data := self._inits.get(cache_key)) is not None:
+            return data
+
+        data = self._blob(init.absolute_uri)
+        if init.byterange:
+            length, _, offset = init.byterange.partition('@')
+            data = data[int(offset or 0):int(offset or 0) + int(length)]
+        # an encrypted init section must come with an explicit IV (RFC 8216 4.3.2.5),
+        # without one the key only applies to the media segments
+        if (key := self._key(segment)) is not None and key.iv:
+            data = SegmentDecryptor(self._algorithm(key), segment_iv(key, 0)).decrypt(data)
+        with self._lock:
+            return self._inits.setdefault(cache_key, data)
+
+    def fingerprint(self, index: int) -> str:
+        """
+        What turns the body of the segment at `index` into its standalone
+        file: key uri and IV, init section uri and range. Empty when the file
+        is the body as served.
+        """
+        segment = self._segments[index]
+        parts = []
+        if (key := self._key(segment)) is not None:
+            parts.append(f'{key.absolute_uri}#{segment_iv(key, self._sequence(index)).hex()}')
+        if (init := segment.init_section) is not None:
+            parts.append(f'{init.absolute_uri}#{init.byterange or ""}')
+        return ' '.join(parts)
+
+    def header(self, index: int, standalone: bool = True) -> bytes:
+        """
+        Bytes to put in front of the segment at `index`. A standalone
+        segment file always starts with its init section; in one continuous
+        stream it is only written where the init section changes.
+        """
+        init = self._segments[index].init_section
+        if init is None:
+            return b''
+        if not standalone and index > 0:
+            previous = self._segments[index - 1].init_section
+            if previous is not None and (previous.absolute_uri, previous.byterange) == (init.absolute_uri, init.byterange):
+                return b''
+        return self.init_section(index)
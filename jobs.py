@@ -0,0 +1,353 @@
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, TypedDict
+from metrics import metrics
+from myself import AnimeTotalInfoTableDict
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+log = logging.getLogger("rich")
+
+QUEUE_NAME = 'jobs.sqlite3'
+
+# seconds a leased job stays with its worker without a renewal
+DEFAULT_LEASE = 10 * 60
+# leases a job gets, whether they ended in an error or ran out, before it is failed
+DEFAULT_ATTEMPTS = 5
+# a failed attempt waits RETRY_DELAY * 2 ** (attempts - 1) seconds, at most MAX_RETRY_DELAY
+RETRY_DELAY = 60.0
+MAX_RETRY_DELAY = 60 * 60.0
+
+STATES = ('queued', 'leased', 'done', 'failed')
+
+
+class JobDict(TypedDict):
+    id: int
+    thread_id: int
+    episode_index: int
+    episode_url: str
+    attempts: int
+    anime_info: AnimeTotalInfoTableDict
+
+
+def worker_name() -> str:
+    import socket
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def default_queue_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, QUEUE_NAME)
+
+
+class JobQueue:
+    """
+    Episode jobs of a backfill in sqlite, shared by the coordinator that
+    fills it and every worker on the host. Workers on other machines go
+    through serve_queue and RemoteQueue.
+
+    A worker leases one job at a time for `lease` seconds and renews the
+    lease while the episode downloads. A job whose lease ran out because
+    its worker died or lost the network goes to the next worker that asks.
+    A failed attempt goes back to the queue after a backoff. After
+    `attempts` leases the job is failed for good, until `retry_failed`.
+
+    Every change is a single IMMEDIATE transaction, so any number of
+    processes can share the file and no job is handed out twice while its
+    lease holds.
+    """
+
+    def __init__(self, path: str, attempts: int = DEFAULT_ATTEMPTS):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        # a worker waits for the write lock of another one instead of failing with "database is locked"
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS shows (
+                thread_id INTEGER PRIMARY KEY,
+                info TEXT NOT NULL,
+                added_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                thread_id INTEGER NOT NULL,
+                episode_index INTEGER NOT NULL,
+                episode_url TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                retry_at REAL NOT NULL DEFAULT 0,
+                bytes INTEGER,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                UNIQUE (thread_id, episode_url)
+            );
+            CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);''')
+
+    def add(self, thread_id: int, anime_info: AnimeTotalInfoTableDict, episodes: list[int] | None = None) -> int:
+        """
+        Queue the episodes of a show, all of them by default. Episodes that
+        are already queued, running or done are left alone, so adding a
+        show again only queues what is new.
+
+        :return: number of new jobs.
+        """
+        now = time.time()
+        if episodes is None:
+            episodes = list(range(len(anime_info['video'])))
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('INSERT OR REPLACE INTO shows VALUES (?, ?, ?)',
+                                 (thread_id, json.dumps(anime_info, ensure_ascii=False), now))
+                before, = self._db.execute('SELECT COUNT(*) FROM jobs').fetchone()
+                # the site may renumber episodes, the url is what identifies one
+                self._db.executemany('''
+                    INSERT INTO jobs (thread_id, episode_index, episode_url, state, updated_at)
+                    VALUES (?, ?, ?, 'queued', ?)
+                    ON CONFLICT (thread_id, episode_url) DO UPDATE SET episode_index = excluded.episode_index''',
+                    [(thread_id, e, anime_info['video'][e]['url'], now) for e in episodes])
+                after, = self._db.execute('SELECT COUNT(*) FROM jobs').fetchone()
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return after - before
+
+    def lease(self, worker: str, lease: float = DEFAULT_LEASE) -> JobDict | None:
+        """Hand the next job to `worker` for `lease` seconds, None when nothing can be leased right now."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                # a job whose last lease ran out with no attempts left is not handed out again
+                expired = self._db.execute('''
+                    UPDATE jobs SET state = 'failed', error = 'lease expired', worker = NULL,
+                                    lease_until = NULL, updated_at = ?
+                    WHERE state = 'leased' AND lease_until < ? AND attempts >= ?''',
+                    (now, now, self.attempts)).rowcount
+                row = self._db.execute('''
+                    SELECT id, thread_id, episode_index, episode_url, attempts, state FROM jobs
+                    WHERE state = 'queued' AND retry_at <= ? ORDER BY id LIMIT 1''', (now,)).fetchone()
+                if row is None:
+                    row = self._db.execute('''
+                        SELECT id, thread_id, episode_index, episode_url, attempts, state FROM jobs
+                        WHERE state = 'leased' AND lease_until < ? ORDER BY lease_until LIMIT 1''', (now,)).fetchone()
+                info = None
+                if row is not None:
+                    self._db.execute('''
+                        UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1,
+                                        updated_at = ?
+                        WHERE id = ?''', (worker, now + lease, now, row[0]))
+                    info, = self._db.execute('SELECT info FROM shows WHERE thread_id = ?', (row[1],)).fetchone()
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        if expired:
+            metrics.inc('queue_jobs_total', expired, result='expired')
+        if row is None:
+            return None
+        job_id, thread_id, episode_index, episode_url, attempts, state = row
+        if state == 'leased':
+            log.info(f'job {job_id}: lease of a dead or stuck worker ran out, handed to {worker}')
+            metrics.inc('queue_leases_total', kind='reclaimed')
+        else:
+            metrics.inc('queue_leases_total', kind='queued')
+        return {'id': job_id, 'thread_id': thread_id, 'episode_index': episode_index, 'episode_url': episode_url,
+                'attempts': attempts + 1, 'anime_info': json.loads(info)}
+
+    def renew(self, job_id: int, worker: str, lease: float = DEFAULT_LEASE) -> bool:
+        """Extend the lease, False when `worker` lost it."""
+        now = time.time()
+        with self._lock:
+            return self._db.execute('''
+                UPDATE jobs SET lease_until = ?, updated_at = ?
+                WHERE id = ? AND worker = ? AND state = 'leased' ''', (now + lease, now, job_id, worker)).rowcount == 1
+
+    def complete(self, job_id: int, worker: str, nbytes: int = 0) -> bool:
+        """
+        The episode is downloaded. This is accepted even after the lease was
+        lost, the episode is on disk either way.
+
+        :return: False when the job was already done.
+        """
+        now = time.time()
+        with self._lock:
+            return self._db.execute('''
+                UPDATE jobs SET state = 'done', worker = ?, lease_until = NULL, bytes = ?, error = NULL,
+                                updated_at = ?
+                WHERE id = ? AND state != 'done' ''', (worker, nbytes, now, job_id)).rowcount == 1
+
+    def fail(self, job_id: int, worker: str, error: str) -> str | None:
+        """
+        The attempt failed, queue the job again after a backoff or fail it
+        once it used up its attempts.
+
+        :return: the new state, None when `worker` no longer held the job.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute("SELECT attempts FROM jobs WHERE id = ? AND worker = ? AND state = 'leased'",
+                                       (job_id, worker)).fetchone()
+                state = None
+                if row is not None:
+                    attempts, = row
+                    state = 'failed' if attempts >= self.attempts else 'queued'
+                    retry_at = now + min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+                    self._db.execute('''
+                        UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, retry_at = ?, error = ?,
+                                        updated_at = ?
+                        WHERE id = ?''', (state, retry_at, error, now, job_id))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return state
+
+    def retry_failed(self, thread_ids: list[int] | None = None) -> int:
+        """Queue failed jobs again with fresh attempts, of the given shows or all of them."""
+        now = time.time()
+        query = "UPDATE jobs SET state = 'queued', attempts = 0, retry_at = 0, updated_at = ? WHERE state = 'failed'"
+        params: list = [now]
+        if thread_ids:
+            query += f' AND thread_id IN ({", ".join("?" * len(thread_ids))})'
+            params += thread_ids
+        with self._lock:
+            return self._db.execute(query, params).rowcount
+
+    def stats(self) -> dict[str, int]:
+        """Jobs per state, bytes downloaded and how many leases have run out."""
+        now = time.time()
+        with self._lock:
+            counts = dict(self._db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            nbytes, = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM jobs WHERE state = 'done'").fetchone()
+            expired, = self._db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'leased' AND lease_until < ?",
+                                        (now,)).fetchone()
+            shows, = self._db.execute('SELECT COUNT(*) FROM shows').fetchone()
+        return {**{state: counts.get(state, 0) for state in STATES}, 'bytes': nbytes, 'expired': expired, 'shows': shows}
+
+    def failures(self, limit: int = 20) -> list[dict]:
+        with self._lock:
+            rows = self._db.execute('''
+                SELECT jobs.id, jobs.thread_id, shows.info, jobs.episode_index, jobs.attempts, jobs.error
+                FROM jobs JOIN shows USING (thread_id)
+                WHERE jobs.state = 'failed' ORDER BY jobs.updated_at DESC LIMIT ?''', (limit,)).fetchall()
+        return [{'id': job_id, 'thread_id': thread_id, 'name': json.loads(info)['name'],
+                 'episode_index': episode_index, 'attempts': attempts, 'error': error}
+                for job_id, thread_id, info, episode_index, attempts, error in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# what RemoteQueue may call on the queue behind serve_queue
+REMOTE_METHODS = ('lease', 'renew', 'complete', 'fail', 'stats')
+
+
+def serve_queue(queue: JobQueue, port: int, host: str = '127.0.0.1', token: str | None = None) -> 'ThreadingHTTPServer':
+    """
+    Expose `queue` to workers on other machines as JSON over HTTP, POST
+    /lease, /renew, /complete, /fail and /stats with the keyword arguments
+    as the body. Runs on a background thread until the server is shut down.
+
+    There is no TLS. With `token` every request has to carry it as
+    "Authorization: Bearer <token>", without one anybody who can reach
+    `host` can lease and fail jobs, so only bind a public address with a
+    token on a network you trust.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.strip('/')
+            try:
+                if token is not None and not hmac.compare_digest(self.headers.get('Authorization', ''),
+                                                                 f'Bearer {token}'):
+                    status, body = 401, {'error': 'missing or wrong queue token'}
+                else:
+                    if method not in REMOTE_METHODS:
+                        raise ValueError(f'unknown method {method}')
+                    kwargs = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    status, body = 200, {'result': getattr(queue, method)(**kwargs)}
+            except (ValueError, TypeError) as e:
+                status, body = 400, {'error': str(e)}
+            except Exception as e:
+                # a broken queue file or the like, the worker gets an answer instead of a dropped connection
+                log.exception(f'job queue: {method} failed')
+                status, body = 500, {'error': f'{type(e).__name__}: {e}'}
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f'job queue on http://{host}:{server.server_address[1]}')
+    return server
+
+
+class RemoteQueue:
+    """The worker side of serve_queue, with the same methods as JobQueue."""
+
+    def __init__(self, url: str, timeout: float = 30.0, token: str | None = None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.token = token
+
+    def _call(self, method: str, **kwargs):
+        # urllib is enough for a handful of small JSON requests a minute
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+        headers = {'Content-Type': 'application/json'}
+        if self.token is not None:
+            headers['Authorization'] = f'Bearer {self.token}'
+        request = Request(f'{self.url}/{method}', data=json.dumps(kwargs).encode('utf-8'), headers=headers)
+        try:
+            with urlopen(request, timeout=self.timeout) as res:
+                return json.load(res)['result']
+        except HTTPError as e:
+            raise ValueError(f'job queue refused {method}: {json.load(e).get("error", e.reason)}')
+
+    def lease(self, worker: str, lease: float = DEFAULT_LEASE) -> JobDict | None:
+        return self._call('lease', worker=worker, lease=lease)
+
+    def renew(self, job_id: int, worker: str, lease: float = DEFAULT_LEASE) -> bool:
+        return self._call('renew', job_id=job_id, worker=worker, lease=lease)
+
+    def complete(self, job_id: int, worker: str, nbytes: int = 0) -> bool:
+        return self._call('complete', job_id=job_id, worker=worker, nbytes=nbytes)
+
+    def fail(self, job_id: int, worker: str, error: str) -> str | None:
+        return self._call('fail', job_id=job_id, worker=worker, error=error)
+
+    def stats(self) -> dict[str, int]:
+        return self._call('stats')
+
+    def close(self):
+        pass
+
+
+def open_queue(spec: str, token: str | None = None) -> JobQueue | RemoteQueue:
+    """An http(s):// address of serve_queue, reached with `token`, or the path of a queue file on this host."""
+    if spec.startswith(('http://', 'https://')):
+        return RemoteQueue(spec, token=token)
+    return JobQueue(spec)
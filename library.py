@@ -0,0 +1,215 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from myself import AnimeTotalInfoTableDict
+
+log = logging.getLogger("rich")
+
+LIBRARY_NAME = 'library.sqlite3'
+
+# what an episode is saved as, merged into mp4 or streamed with --stream
+EPISODE_EXTENSIONS = ('.mp4', '.ts')
+
+# the index used by the download engines, None falls back to checking the destination directly
+index: 'LibraryIndex | None' = None
+
+
+class LibraryIndex:
+    """
+    Local sqlite index of the download directories and the episodes saved
+    into them, so deciding what to skip does not stat every episode on a
+    network mount.
+
+    A directory is listed again only when its own mtime changed, which
+    costs one stat per show instead of two per episode. Downloaded episodes
+    are remembered by thread id and episode url together with the file's
+    size, mtime and inode, so a file that was renamed afterwards is still
+    recognised and never mistaken for another episode of the same size.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, LIBRARY_NAME)
+        self.scans = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS directories (
+                directory TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                scanned_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                ino INTEGER,
+                dev INTEGER,
+                PRIMARY KEY (directory, name)
+            );
+            CREATE INDEX IF NOT EXISTS files_size ON files (directory, size);
+            CREATE TABLE IF NOT EXISTS episodes (
+                thread_id INTEGER NOT NULL,
+                episode_url TEXT NOT NULL,
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                downloaded_at REAL NOT NULL,
+                ino INTEGER,
+                dev INTEGER,
+                PRIMARY KEY (thread_id, episode_url)
+            );''')
+        # indexes written before inodes were kept, their rows match by size and mtime only
+        for table in ('files', 'episodes'):
+            columns = {row[1] for row in self._db.execute(f'PRAGMA table_info({table})')}
+            for column in ('ino', 'dev'):
+                if column not in columns:
+                    self._db.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER')
+
+    def refresh(self, directory: str, force: bool = False):
+        """Bring the file list of `directory` up to date from a single listing when it changed."""
+        directory = os.path.abspath(directory)
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            mtime = -1.0
+        with self._lock:
+            row = self._db.execute('SELECT mtime FROM directories WHERE directory = ?', (directory,)).fetchone()
+        if not force and row is not None and row[0] == mtime:
+            return
+
+        files: list[tuple[str, str, int, float, int | None, int | None]] = []
+        if mtime >= 0:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((directory, entry.name, stat.st_size, stat.st_mtime, *_file_id(stat)))
+        log.debug(f'library: listed {directory}, {len(files)} files')
+
+        with self._lock:
+            self.scans += 1
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM files WHERE directory = ?', (directory,))
+            self._db.executemany('INSERT INTO files (directory, name, size, mtime, ino, dev) VALUES (?, ?, ?, ?, ?, ?)', files)
+            self._db.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)', (directory, mtime, time.time()))
+            self._db.execute('COMMIT')
+
+    def is_downloaded(self, thread_id: int, episode_url: str, directory: str, names: list[str]) -> bool:
+        """
+        Whether the episode is already in `directory`, either under one of
+        `names` or as the recorded file under another name. Call refresh first.
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            for name in names:
+                row = self._db.execute('SELECT size, mtime, ino, dev FROM files WHERE directory = ? AND name = ?',
+                                       (directory, name)).fetchone()
+                if row is not None:
+                    self._record(thread_id, episode_url, directory, name, *row)
+                    return True
+
+            episode = self._db.execute('SELECT name, size, mtime, ino, dev FROM episodes '
+                                       'WHERE thread_id = ? AND episode_url = ? AND directory = ?',
+                                       (thread_id, episode_url, directory)).fetchone()
+            if episode is None:
+                return False
+            # a rename keeps the size and the inode, or at least the mtime where there is no inode,
+            # two episodes of the same size never share both
+            name, size, mtime, ino, dev = episode
+            row = self._db.execute('''
+                SELECT name, size, mtime, ino, dev FROM files
+                WHERE directory = ? AND size = ?
+                  AND CASE WHEN ino IS NULL OR ? IS NULL THEN mtime = ? ELSE ino = ? AND dev = ? END
+                ORDER BY name = ? DESC''', (directory, size, ino, mtime, ino, dev, name)).fetchone()
+            if row is None:
+                self._db.execute('DELETE FROM episodes WHERE thread_id = ? AND episode_url = ?', (thread_id, episode_url))
+                return False
+            if row[0] != name:
+                log.info(f'library: {name} was renamed to {row[0]}')
+                self._record(thread_id, episode_url, directory, *row)
+            return True
+
+    def record(self, thread_id: int, episode_url: str, path: str):
+        """Remember a freshly saved episode file."""
+        stat = os.stat(path)
+        directory, name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files (directory, name, size, mtime, ino, dev) VALUES (?, ?, ?, ?, ?, ?)',
+                             (directory, name, stat.st_size, stat.st_mtime, *_file_id(stat)))
+            self._record(thread_id, episode_url, directory, name, stat.st_size, stat.st_mtime, *_file_id(stat))
+
+    def _record(self, thread_id: int, episode_url: str, directory: str, name: str, size: int, mtime: float,
+                ino: int | None = None, dev: int | None = None):
+        self._db.execute('''
+            INSERT OR REPLACE INTO episodes (thread_id, episode_url, directory, name, size, mtime, downloaded_at, ino, dev)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', (thread_id, episode_url, directory, name, size, mtime, time.time(), ino, dev))
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            directories, = self._db.execute('SELECT COUNT(*) FROM directories').fetchone()
+            files, = self._db.execute('SELECT COUNT(*) FROM files').fetchone()
+            episodes, = self._db.execute('SELECT COUNT(*) FROM episodes').fetchone()
+        return {'directories': directories, 'files': files, 'episodes': episodes, 'scans': self.scans}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _file_id(stat: os.stat_result) -> tuple[int | None, int | None]:
+    # some filesystems and Windows' scandir report no inode, those files match by size and mtime
+    return (stat.st_ino, stat.st_dev) if stat.st_ino else (None, None)
+
+
+def episode_downloaded(anime_info: 'AnimeTotalInfoTableDict', 
+                       episode_index: int, 
+                       download_dir: str, 
+                       index: LibraryIndex | None = None, 
+                       thread_id: int | None = None) -> bool:
+    """
+    Whether the episode is in `download_dir` under one of the names the
+    downloader saves it as, merged or streamed (EPISODE_EXTENSIONS). With an
+    index a file renamed since is found as well, without one only those
+    names are checked.
+    """
+    episode_name = anime_info['video'][episode_index]['name']
+    names = [f'{stem}{extension}' for stem in (f'{anime_info["name"]} {episode_name}', episode_name)
+             for extension in EPISODE_EXTENSIONS]
+    if index is not None and thread_id is not None:
+        return index.is_downloaded(thread_id, anime_info['video'][episode_index]['url'], download_dir, names)
+    log.debug(f'testing path {os.path.join(download_dir, names[0])}...')
+    return any(os.path.exists(os.path.join(download_dir, name)) for name in names)
+
+
+def pending_episodes(anime_info: 'AnimeTotalInfoTableDict', 
+                     download_dir: str, 
+                     episode_list: list[int] = [],
+                     thread_id: int | None = None) -> list[int]:
+    """Episodes of a show that still have to be downloaded, `episode_list` when it is given."""
+    if len(episode_list) > 0:
+        return episode_list
+    
+    known = index if thread_id is not None else None
+    if known is not None:
+        # one stat of the show directory, a listing only when it changed since the last run
+        known.refresh(download_dir)
+    
+    download_list: list[int] = []
+    for i in range(len(anime_info['video'])):
+        if episode_downloaded(anime_info, i, download_dir, index=known, thread_id=thread_id):
+            log.info(f'{anime_info["name"]} {anime_info["video"][i]["name"]}.mp4 already downloaded, skipped...')
+            continue
+        
+        log.info(f'{anime_info["video"][i]["name"]} not downloaded, proceed to download')
+        download_list.append(i)
+    
+    return download_list
@@ -1,39 +1,77 @@
 from rich import print
 from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 import concurrent.futures
-import glob
+import hashlib
 import logging
-from rich.logging import RichHandler
-from subprocess import Popen, PIPE, STDOUT
-import m3u8
 import os
-from tqdm import TqdmExperimentalWarning
 import concurrent
 import shutil
 import argparse
-# from tqdm.rich import tqdm_rich as tqdm
-from tqdm.auto import tqdm
-import warnings
-from myself import Myself, AnimeTotalInfoTableDict
+import threading
+import time
+from typing import TYPE_CHECKING
+from myself import Myself, AnimeTotalInfoTableDict, download_opt, parser_opt, session_pool, ws_pool
+from cache import MetadataCache, default_cache_dir
+import library
+import segment_store
+from library import LibraryIndex, episode_downloaded, pending_episodes
+from segment_store import LINK_MODES, SegmentStore
+from catalog import Catalog, CatalogCrawler
+from manifest import SegmentManifest
+from jobs import DEFAULT_LEASE, STATES, JobDict, JobQueue, RemoteQueue, default_queue_path, open_queue, serve_queue, worker_name
+from metrics import metrics
+from progress import PROGRESS_MODES, EpisodeProgress, progress
+from merge import OrderedSegmentWriter, open_stream_sink, remux_opt
+from scheduler import SegmentScheduler, host_of
+from throttle import RATE_HELP, SCHEDULE_HELP, bandwidth, parse_rate, parse_schedule
+from pipeline import MergeJob, PostProcessor, merge_episode
+from retry import DownloadCancelledError, EpisodeSource, IncompleteEpisodeError, RetryPolicy, call_with_retry
+from watch import DAY, WatchSchedule
+from variants import QUALITY_HELP, media_playlist, parse_quality, variant_label, variant_path, variants_of
 
-# ignore tqdm.rich warning about expirimental feature
-warnings.filterwarnings("ignore", category=TqdmExperimentalWarning)
+# rich's console, tables and progress bars, m3u8, the html parsers, requests, websocket and
+# cryptography are imported where they are used, so -h or a run with nothing to fetch
+# does not pay for them; bench/startup_bench.py keeps it that way
+if TYPE_CHECKING:
+    import m3u8
+    from decrypt import PlaylistKeys
 
-# logging settings
+# logging settings, the handler is installed once the arguments are parsed
 FORMAT = "%(message)s"
-logging.basicConfig(
-    level="WARNING", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
-)
 
 log = logging.getLogger("rich")
 
 # helper
-# https://stackoverflow.com/questions/21953835/run-subprocess-and-print-output-to-logging
-def log_subprocess_output(pipe, log_level: int):
-    for line in iter(pipe.readline, b''): # b'\n'-separated lines
-        log.log(log_level, line)
-        
-        
+def ttl_pair(string):
+    kind, _, seconds = string.partition('=')
+    try:
+        return kind, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected KIND=SECONDS, got "{string}"')
+
+
+def rate_spec(string):
+    try:
+        return parse_rate(string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def schedule_spec(string):
+    try:
+        return parse_schedule(string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def quality_spec(string):
+    try:
+        return parse_quality(string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
 def dir_path(string):
     if not os.path.exists(string):
         # check for permission first
@@ -47,10 +85,168 @@ def dir_path(string):
 
 
 
-def download_ts(ts_url: str, directory: str, uri: str):
-    video_content = Myself.get_content(url=ts_url)
-    with open(os.path.join(directory, uri), 'wb') as f:
-        f.write(video_content)
+def download_ts(ts_url: str, 
+                directory: str, 
+                uri: str, 
+                manifest: SegmentManifest | None = None, 
+                keys: 'PlaylistKeys | None' = None, 
+                index: int = 0,
+                episode: EpisodeProgress | None = None) -> int:
+    path = os.path.join(directory, uri)
+    if manifest is not None and manifest.is_complete(uri):
+        return 0
+
+    # the same segment from an earlier download is linked in from the segment store
+    store = segment_store.store
+    tag = keys.fingerprint(index) if keys is not None else ''
+    # a segment re-uploaded under the same url has another length, ask the origin before trusting the entry
+    length = Myself.content_length(ts_url) if store is not None and store.cached(ts_url, tag) else None
+    if store is not None and store.fetch(ts_url, path, tag, length) is not None:
+        if manifest is not None:
+            manifest.record(uri)
+        return 0
+
+    # decrypted in this worker while it is written, every segment file starts with its init section
+    decryptor = keys.decryptor(index) if keys is not None else None
+    header = keys.header(index) if keys is not None else b''
+    # continue a truncated segment with a range request when the server allows it,
+    # a CBC stream or a file with an init section in front has to start over
+    start = manifest.partial_size(uri) if manifest is not None and decryptor is None and not header else 0
+    if start > 0:
+        log.debug(f'resuming {uri} from byte {start}')
+    # hashed on the way to disk, the store does not read the segment back
+    sha256 = hashlib.sha256() if store is not None else None
+    with metrics.span('segment') as span, progress.track(episode):
+        span.bytes = Myself.download_to(url=ts_url, path=path, start=start, decryptor=decryptor, header=header,
+                                        sha256=sha256)
+    if store is not None and sha256 is not None:
+        # the file is what the origin sent unless it was decrypted or has an init section in front
+        store.add(ts_url, path, tag, digest=sha256.hexdigest(), length=span.bytes if start == 0 else None)
+    if manifest is not None:
+        manifest.record(uri)
+    return span.bytes
+
+
+def fetch_ts(source: EpisodeSource, 
+             policy: RetryPolicy, 
+             directory: str, 
+             uri: str, 
+             manifest: SegmentManifest | None = None,
+             keys: 'PlaylistKeys | None' = None,
+             index: int = 0,
+             episode: EpisodeProgress | None = None,
+             cancel: threading.Event | None = None) -> int:
+    return call_with_retry(policy, source, lambda video_url: download_ts(
+        ts_url=source.segment_url(uri, video_url), 
+        directory=directory, 
+        uri=uri, 
+        manifest=manifest,
+        keys=keys,
+        index=index,
+        episode=episode
+    ), cancel=cancel)
+
+
+def segment_executor(video_url: str, threads: int, scheduler: SegmentScheduler | None = None):
+    # with a scheduler all episodes share one adaptive queue, otherwise each gets its own pool
+    if scheduler is not None:
+        return scheduler.for_host(host_of(video_url))
+    return ThreadPoolExecutor(max_workers=threads)
+
+
+def stream_ts(source: EpisodeSource, 
+              policy: RetryPolicy, 
+              uri: str, 
+              index: int, 
+              writer: OrderedSegmentWriter,
+              keys: 'PlaylistKeys | None' = None,
+              episode: EpisodeProgress | None = None,
+              cancel: threading.Event | None = None) -> int:
+    def fetch(video_url: str) -> bytes:
+        with metrics.span('segment') as span, progress.track(episode):
+            content = Myself.get_content(url=source.segment_url(uri, video_url), cached=True)
+            span.bytes = len(content)
+        if keys is not None:
+            if (decryptor := keys.decryptor(index)) is not None:
+                content = decryptor.decrypt(content)
+            # one continuous stream only needs the init section where it changes
+            content = keys.header(index, standalone=False) + content
+        return content
+    
+    try:
+        video_content = call_with_retry(policy, source, fetch, cancel=cancel)
+        writer.put(index, video_content)
+        if episode is not None:
+            # reported from here, the episode only collects results once every segment is queued
+            episode.segment_done(len(video_content))
+        return len(video_content)
+    except BaseException as e:
+        writer.fail(e)
+        raise
+
+
+def stream_episode(source: EpisodeSource,
+                   m3u8_obj: 'm3u8.M3U8',
+                   output: str,
+                   desc: str,
+                   threads: int = 8,
+                   remux: bool = True,
+                   window: int | None = None,
+                   scheduler: SegmentScheduler | None = None,
+                   retry: RetryPolicy | None = None,
+                   cancel: threading.Event | None = None) -> int:
+    # segments are appended to one output in playlist order as they arrive,
+    # so nothing touches ts/ and there is no separate concat pass
+    partial = f'{output}.part'
+    sink = open_stream_sink(partial, remux=remux)
+    writer = OrderedSegmentWriter(sink, window=window or threads * 2)
+    policy = retry or RetryPolicy()
+    from decrypt import PlaylistKeys
+    keys = PlaylistKeys(m3u8_obj, fetch=Myself.get_content)
+    
+    try:
+        with segment_executor(source.video_url, threads, scheduler) as executor, \
+                progress.episode(desc, len(m3u8_obj.segments)) as episode:
+            futures: list[Future] = []
+            for i, m3u8_data in enumerate(m3u8_obj.segments):
+                writer.acquire()
+                futures.append(executor.submit(
+                    stream_ts,
+                    source=source,
+                    policy=policy,
+                    uri=m3u8_data.uri,
+                    index=i,
+                    writer=writer,
+                    keys=keys,
+                    episode=episode,
+                    cancel=cancel
+                ))
+            
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+    except BaseException:
+        writer.fail(RuntimeError('stream aborted'))
+        if remux:
+            sink.abort()
+        else:
+            sink.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    
+    try:
+        # a native remux that failed past its fallback raises here with PyAV's own error
+        code = sink.close()
+        if remux and code != 0:
+            raise RuntimeError(f'ffmpeg exited with {code} while remuxing {output}')
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    
+    log.debug(f'{desc}: streamed {writer.bytes_written} bytes, peak reorder buffer {writer.peak_buffered} bytes')
+    os.replace(partial, output)
+    return writer.bytes_written
 
 
 def download_episode(thread_id: int, 
@@ -58,117 +254,1065 @@ def download_episode(thread_id: int,
                      download_dir: str = '.', 
                      threads: int = 8, 
                      anime_info: AnimeTotalInfoTableDict | None = None, 
-                     bar_position: int | None = None):
+                     resume: bool = True,
+                     checksum: bool = False,
+                     stream: str | None = None,
+                     stream_window: int | None = None,
+                     scheduler: SegmentScheduler | None = None,
+                     episode_urls: tuple[str, str] | None = None,
+                     retry: RetryPolicy | None = None,
+                     failover_after: int = 3,
+                     quality: str = 'best',
+                     probe_segments: int = 2,
+                     post: PostProcessor | None = None,
+                     cancel: threading.Event | None = None) -> int:
 
     if anime_info is None:
         print('fetching anime info...')
-        anime_info = Myself.anime_total_info(url=f'https://Myself-bbs.com/thread-{thread_id}-1-1.html')
+        anime_info = Myself.anime_total_info(url=Myself.thread_url(thread_id))
 
     episode_info = anime_info['video'][episode_index]
     merged_mp4 = f'{anime_info["name"]} {episode_info["name"]}.mp4'
-    video_url, m3u8_url = Myself.parse_episode_url(episode_info['url'])
+    video_url, m3u8_url = episode_urls or Myself.parse_episode_url(episode_info['url'])
 
-    m3u8_obj = m3u8.loads(Myself.get_m3u8_text(m3u8_url))
+    m3u8_obj, media_url, variant = media_playlist(m3u8_url, Myself.get_m3u8_text(m3u8_url), 
+                                                  fetch_text=Myself.get_m3u8_text, 
+                                                  fetch_content=Myself.get_content, 
+                                                  quality=quality, 
+                                                  probe_segments=probe_segments)
+    if (path := variant_path(video_url, media_url)) is not None:
+        source = EpisodeSource(episode_info['url'], video_url, failover_after=failover_after, variant=path)
+    else:
+        # the variant lives on another host, re-resolving the episode would not move it
+        source = EpisodeSource(episode_info['url'], media_url[:media_url.rfind('/')], failover_after=0)
+    policy = retry or RetryPolicy()
+
+    if stream is not None:
+        log.info(f'Streaming {anime_info["name"]}: {episode_info["name"]}...')
+        os.makedirs(download_dir, exist_ok=True)
+        output = os.path.join(download_dir, os.path.splitext(merged_mp4)[0] + f'.{stream}')
+        downloaded = stream_episode(source, m3u8_obj, output,
+                                    desc=os.path.splitext(merged_mp4)[0],
+                                    threads=threads,
+                                    remux=stream == 'mp4',
+                                    window=stream_window,
+                                    scheduler=scheduler,
+                                    retry=policy,
+                                    cancel=cancel)
+        if library.index is not None:
+            library.index.record(thread_id, episode_info['url'], output)
+        log.info(f'{episode_info["name"]} downloaded!')
+        return downloaded
 
     
     ts_dir = os.path.join(os.curdir, 'ts', str(thread_id), str(episode_index))
-    # TODO: make download resume from last launch
-    shutil.rmtree(ts_dir, ignore_errors=True)
-    os.makedirs(ts_dir, exist_ok=True)
+    if variant is not None:
+        # segment names repeat across variants, never resume into another variant's segments
+        ts_dir += f'-{variant_label(variant)}'
+    manifest: SegmentManifest | None = None
+    if resume:
+        os.makedirs(ts_dir, exist_ok=True)
+        # leftovers of an interrupted merge would end up in the concat list
+        for leftover in ('files.txt', merged_mp4):
+            if os.path.exists(os.path.join(ts_dir, leftover)):
+                os.remove(os.path.join(ts_dir, leftover))
+        manifest = SegmentManifest(ts_dir, checksum=checksum)
+        if len(manifest) > 0:
+            log.info(f'{episode_info["name"]}: resuming, {len(manifest)} segments already on disk')
+    else:
+        shutil.rmtree(ts_dir, ignore_errors=True)
+        os.makedirs(ts_dir, exist_ok=True)
 
 
     log.info(f'Downloading {anime_info["name"]}: {episode_info["name"]}...')
     
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures: list[Future] = []
-        for m3u8_data in m3u8_obj.segments:
-            futures.append(executor.submit(
-                download_ts,
-                ts_url=f'{video_url}/{m3u8_data.uri}', 
+    from decrypt import PlaylistKeys
+    keys = PlaylistKeys(m3u8_obj, fetch=Myself.get_content)
+    with segment_executor(source.video_url, threads, scheduler) as executor, \
+            progress.episode(os.path.splitext(merged_mp4)[0], len(m3u8_obj.segments)) as episode:
+        futures: dict[Future, str] = {}
+        for i, m3u8_data in enumerate(m3u8_obj.segments):
+            futures[executor.submit(
+                fetch_ts,
+                source=source,
+                policy=policy,
                 directory=ts_dir, 
-                uri=m3u8_data.uri
-            ))
+                uri=m3u8_data.uri,
+                manifest=manifest,
+                keys=keys,
+                index=i,
+                episode=episode,
+                cancel=cancel
+            )] = m3u8_data.uri
+            metrics.gauge('segments_pending', 1)
         
-        with tqdm(total=len(futures), leave=False, smoothing=0, desc=f'{episode_info["name"]}') as bar:
-            for _ in concurrent.futures.as_completed(futures):
-                bar.update()
+        downloaded = 0
+        failed: list[str] = []
+        for future in concurrent.futures.as_completed(futures):
+            if (error := future.exception()) is None:
+                nbytes = future.result()
+                downloaded += nbytes
+                episode.segment_done(nbytes)
+            else:
+                log.warning(f'{episode_info["name"]}: segment {futures[future]} failed: {error}')
+                failed.append(futures[future])
+                episode.segment_done()
+            metrics.gauge('segments_pending', -1)
     
+    if cancel is not None and cancel.is_set():
+        # someone else owns the episode now, leave the merge and the destination to them
+        raise DownloadCancelledError(f'{episode_info["name"]}: cancelled, not merging')
     
-    log.info(f'{episode_info["name"]} Merging ts files...')
-    
-    ts_files = sorted(glob.glob(root_dir=ts_dir, pathname='*.ts'))
-    with open(os.path.join(ts_dir, 'files.txt'), '+a') as file:
-        file.write('\n'.join(map(lambda s: f'file {s}', ts_files)))
-
-    process = Popen([
-        'ffmpeg', '-y', '-f', 'concat', '-i', 'files.txt', '-c', 'copy', '-bsf:a', 'aac_adtstoasc', merged_mp4
-    ], stdout=PIPE, stderr=STDOUT, cwd=ts_dir)
+    # merging with holes wastes the whole episode, keep ts/ around so the next run resumes instead
+    missing = failed + [uri for uri in futures.values() 
+                        if uri not in failed and not segment_on_disk(ts_dir, uri, manifest)]
+    if missing:
+        raise IncompleteEpisodeError(episode_info['name'], missing)
     
-    if process.stdout is not None:
-        with process.stdout:
-            log_subprocess_output(process.stdout, logging.DEBUG)
-        process.wait()
+    if post is not None:
+        # ffmpeg and the copy to the destination run on the stage workers, this slot moves on
+        post.submit((thread_id, episode_index), 
+                    MergeJob(ts_dir, merged_mp4, download_dir, episode_info['name'], thread_id, episode_info['url'],
+                             tuple(futures.values())))
+        return downloaded
     
+    merge_episode(ts_dir, merged_mp4, download_dir, episode_info['name'], 
+                  thread_id=thread_id, episode_url=episode_info['url'], segments=list(futures.values()))
     
-    log.info(f'{episode_info["name"]} moving file to destination...')
-    os.makedirs(download_dir, exist_ok=True)
-    shutil.move(
-        os.path.join(ts_dir, merged_mp4),
-        os.path.join(download_dir, merged_mp4)
-    )
+    log.info(f'{episode_info["name"]} downloaded!')
+    return downloaded
     
-    log.info(f'{episode_info["name"]} Pruning ts files...')
-    shutil.rmtree(ts_dir)
     
-    log.info(f'{episode_info["name"]} downloaded!')
+def segment_on_disk(ts_dir: str, uri: str, manifest: SegmentManifest | None = None) -> bool:
+    if manifest is not None:
+        return manifest.is_complete(uri)
+    try:
+        return os.path.getsize(os.path.join(ts_dir, uri)) > 0
+    except OSError:
+        return False
     
     
 def download_anime(thread_id: int, 
                    download_dir: str = '.', 
                    threads: int = 8, 
                    e_threads: int = 4,
-                   episode_list: list[int] = []):
+                   episode_list: list[int] = [],
+                   resume: bool = True,
+                   checksum: bool = False,
+                   stream: str | None = None,
+                   stream_window: int | None = None,
+                   adaptive: bool = False,
+                   max_inflight: int | None = None,
+                   retry: RetryPolicy | None = None,
+                   failover_after: int = 3,
+                   quality: str = 'best',
+                   probe_segments: int = 2,
+                   remux_workers: int = 1,
+                   publish_workers: int = 1,
+                   stage_queue: int = 2):
     
     print(f'fetching anime info of {thread_id}...')
-    anime_info = Myself.anime_total_info(url=f'https://Myself-bbs.com/thread-{thread_id}-1-1.html')
-    episodes = len(anime_info['video'])
+    anime_info = Myself.anime_total_info(url=Myself.thread_url(thread_id))
     
     download_dir = os.path.join(download_dir, anime_info['name'])
+    download_list = pending_episodes(anime_info, download_dir, episode_list, thread_id=thread_id)
+    if not download_list:
+        # nothing to resolve or fetch, skip the pools and the progress display
+        print(f'finished downloading {anime_info["name"]}, nothing new')
+        return
+
+    scheduler = SegmentScheduler(max_workers=max_inflight or threads * e_threads,
+                                 initial=threads) if adaptive else None
     
-    download_list: list[int] = []
+    # resolve every episode up front over the pooled websocket
+    resolved = Myself.parse_episode_urls([anime_info['video'][e]['url'] for e in download_list])
     
-    if len(episode_list) > 0:
-        download_list = episode_list
-    else:
-        for i in range(episodes):
-            file_name = f'{anime_info["name"]} {anime_info["video"][i]["name"]}.mp4'
-            file_path = os.path.join(download_dir, file_name)
-            log.debug(f'testing path {file_path}...')
-            
-            if os.path.exists(file_path) or os.path.exists(os.path.join(download_dir, f'{anime_info["video"][i]["name"]}.mp4')):
-                log.info(f'{file_name} already downloaded, skipped...')
-                continue
-            
-            log.info(f'{anime_info["video"][i]["name"]} not downloaded, proceed to download')
-            download_list.append(i)
+    # streamed episodes are written in place, there is nothing to post-process
+    post = PostProcessor(remux_workers, publish_workers, stage_queue) if remux_workers > 0 and stream is None else None
     
-    with ThreadPoolExecutor(max_workers=e_threads) as executor:
+    with ThreadPoolExecutor(max_workers=e_threads) as executor, post or nullcontext(), \
+            progress.run(len(download_list)):
         futures: list[Future] = [executor.submit(download_episode, 
                                                  thread_id, 
                                                  e, 
                                                  download_dir, 
                                                  threads, 
                                                  anime_info=anime_info, 
-                                                 bar_position=i) 
+                                                 resume=resume,
+                                                 checksum=checksum,
+                                                 stream=stream,
+                                                 stream_window=stream_window,
+                                                 scheduler=scheduler,
+                                                 episode_urls=resolved[i],
+                                                 retry=retry,
+                                                 failover_after=failover_after,
+                                                 quality=quality,
+                                                 probe_segments=probe_segments,
+                                                 post=post) 
                                  for i, e in enumerate(download_list)]
         
-        with tqdm(total=len(futures), smoothing=0, desc=f'{anime_info["name"]}') as bar:
-            for _ in concurrent.futures.as_completed(futures):
-                bar.update()
+        failed = 0
+        for future in concurrent.futures.as_completed(futures):
+            if (error := future.exception()) is not None:
+                failed += 1
+                log.error(f'{anime_info["name"]}: {error}')
+    
+    if post is not None:
+        for (_, episode_index), future in post.futures.items():
+            if (error := future.exception()) is not None:
+                failed += 1
+                log.error(f'{anime_info["name"]} {anime_info["video"][episode_index]["name"]}: {error}')
+    
+    if scheduler is not None:
+        scheduler.shutdown()
+        log.debug(f'scheduler stats: {scheduler.stats()}')
+    
+    print(f'finished downloading {anime_info["name"]}' + (f', {failed} episodes failed' if failed else ''))
+    log.debug(f'connection pool stats: {session_pool.stats()}')
+
+
+
+def list_variants(thread_id: int, episode_list: list[int] = []):
+    import m3u8
+    from rich.table import Table
+    anime_info = Myself.anime_total_info(url=Myself.thread_url(thread_id))
+    for episode_index in episode_list or [0]:
+        episode_info = anime_info['video'][episode_index]
+        _, m3u8_url = Myself.parse_episode_url(episode_info['url'])
+        playlist = m3u8.loads(Myself.get_m3u8_text(m3u8_url), uri=m3u8_url)
+        
+        table = Table(title=f'{anime_info["name"]} {episode_info["name"]}')
+        table.add_column('quality')
+        table.add_column('kbit/s', justify='right')
+        table.add_column('resolution')
+        table.add_column('codecs')
+        table.add_column('url')
+        if not playlist.is_variant:
+            table.add_row('-', '-', '-', '-', m3u8_url)
+        for variant in reversed(variants_of(playlist)):
+            resolution = 'x'.join(map(str, variant['resolution'])) if variant['resolution'] else '-'
+            table.add_row(variant_label(variant), str(variant['bandwidth'] // 1000), resolution, 
+                          variant['codecs'] or '-', variant['uri'])
+        print(table)
+
+
+def read_subscriptions(path: str) -> list[int]:
+    # whitespace separated thread ids, "#" starts a comment
+    thread_ids: list[int] = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            for token in line.split('#')[0].split():
+                thread_ids.append(int(token))
+    return list(dict.fromkeys(thread_ids))
+
+
+def sync_subscriptions(subscription_file: str,
+                       download_dir: str = '.',
+                       threads: int = 8,
+                       e_threads: int = 4,
+                       fetch_threads: int = 8,
+                       resume: bool = True,
+                       checksum: bool = False,
+                       stream: str | None = None,
+                       stream_window: int | None = None,
+                       max_inflight: int | None = None,
+                       retry: RetryPolicy | None = None,
+                       failover_after: int = 3,
+                       quality: str = 'best',
+                       probe_segments: int = 2,
+                       remux_workers: int = 1,
+                       publish_workers: int = 1,
+                       stage_queue: int = 2):
+    thread_ids = read_subscriptions(subscription_file)
+    print(f'fetching anime info of {len(thread_ids)} subscriptions...')
+    
+    infos: dict[int, AnimeTotalInfoTableDict] = {}
+    with ThreadPoolExecutor(max_workers=fetch_threads) as executor:
+        info_futures = {executor.submit(Myself.anime_total_info, 
+                                        url=Myself.thread_url(thread_id)): thread_id 
+                        for thread_id in thread_ids}
+        for future in concurrent.futures.as_completed(info_futures):
+            thread_id = info_futures[future]
+            try:
+                anime_info = future.result()
+            except ValueError as e:
+                log.error(f'failed to fetch thread {thread_id}: {e}')
+                continue
+            if not anime_info:
+                log.error(f'thread {thread_id} has no anime info, skipped')
+                continue
+            infos[thread_id] = anime_info
+    
+    # every missing episode of every show goes into one queue
+    jobs: list[tuple[int, int, str]] = []
+    for thread_id in thread_ids:
+        if (anime_info := infos.get(thread_id)) is None:
+            continue
+        show_dir = os.path.join(download_dir, anime_info['name'])
+        jobs.extend((thread_id, e, show_dir) for e in pending_episodes(anime_info, show_dir, thread_id=thread_id))
+    
+    resolved = dict(zip(jobs, Myself.parse_episode_urls(
+        [infos[thread_id]['video'][e]['url'] for thread_id, e, _ in jobs])))
+    
+    summary: dict[int, dict] = {
+        thread_id: {'episodes': 0, 'failed': 0, 'bytes': 0, 'start': None, 'end': None} 
+        for thread_id in thread_ids if thread_id in infos
+    }
+    
+    def run(thread_id: int, episode_index: int, show_dir: str) -> int:
+        start = time.monotonic()
+        stats = summary[thread_id]
+        stats['start'] = start if stats['start'] is None else min(stats['start'], start)
+        return download_episode(thread_id, 
+                                episode_index, 
+                                show_dir, 
+                                threads, 
+                                anime_info=infos[thread_id], 
+                                resume=resume, 
+                                checksum=checksum, 
+                                stream=stream, 
+                                stream_window=stream_window, 
+                                scheduler=scheduler, 
+                                episode_urls=resolved[(thread_id, episode_index, show_dir)], 
+                                retry=retry, 
+                                failover_after=failover_after, 
+                                quality=quality, 
+                                probe_segments=probe_segments, 
+                                post=post)
+    
+    started = time.monotonic()
+    post = PostProcessor(remux_workers, publish_workers, stage_queue) if remux_workers > 0 and stream is None else None
+    with SegmentScheduler(max_workers=max_inflight or threads * e_threads, initial=threads) as scheduler, \
+            post or nullcontext(), \
+            ThreadPoolExecutor(max_workers=e_threads) as executor, \
+            progress.run(len(jobs)):
+        futures = {executor.submit(run, *job): job for job in jobs}
+        
+        for future in concurrent.futures.as_completed(futures):
+            thread_id, episode_index, _ = futures[future]
+            stats = summary[thread_id]
+            stats['end'] = time.monotonic()
+            try:
+                stats['bytes'] += future.result()
+                stats['episodes'] += 1
+            except Exception as e:
+                stats['failed'] += 1
+                log.error(f'{infos[thread_id]["name"]} episode {episode_index} failed: {e}')
+    
+    if post is not None:
+        for (thread_id, episode_index), future in post.futures.items():
+            if (error := future.exception()) is not None:
+                summary[thread_id]['episodes'] -= 1
+                summary[thread_id]['failed'] += 1
+                log.error(f'{infos[thread_id]["name"]} episode {episode_index} failed: {error}')
+    
+    elapsed = time.monotonic() - started
+    log.debug(f'scheduler stats: {scheduler.stats()}')
+    
+    from rich.table import Table
+    table = Table(title=f'sync finished in {elapsed:.0f}s')
+    for column in ('thread', 'name', 'episodes', 'failed', 'MB', 'MB/s'):
+        table.add_column(column, justify='left' if column == 'name' else 'right')
+    for thread_id, stats in summary.items():
+        busy = (stats['end'] - stats['start']) if stats['start'] is not None and stats['end'] is not None else 0
+        table.add_row(str(thread_id), 
+                      infos[thread_id]['name'], 
+                      str(stats['episodes']), 
+                      str(stats['failed']), 
+                      f'{stats["bytes"] / 1e6:.1f}', 
+                      f'{stats["bytes"] / 1e6 / busy:.2f}' if busy > 0 else '-')
+    total = sum(stats['bytes'] for stats in summary.values())
+    table.add_row('', 'total', 
+                  str(sum(stats['episodes'] for stats in summary.values())), 
+                  str(sum(stats['failed'] for stats in summary.values()) + len(thread_ids) - len(infos)), 
+                  f'{total / 1e6:.1f}', 
+                  f'{total / 1e6 / elapsed:.2f}' if elapsed > 0 else '-')
+    print(table)
+
+
+def watch_subscriptions(subscription_file: str,
+                        download_dir: str = '.',
+                        threads: int = 8,
+                        e_threads: int = 4,
+                        fetch_threads: int = 8,
+                        resume: bool = True,
+                        checksum: bool = False,
+                        stream: str | None = None,
+                        stream_window: int | None = None,
+                        max_inflight: int | None = None,
+                        retry: RetryPolicy | None = None,
+                        failover_after: int = 3,
+                        quality: str = 'best',
+                        probe_segments: int = 2,
+                        remux_workers: int = 1,
+                        publish_workers: int = 1,
+                        stage_queue: int = 2,
+                        schedule: WatchSchedule | None = None,
+                        schedule_refresh: float = DAY):
+    # one process for good: the weekly schedule decides which show is looked at when,
+    # and every download goes into the same long lived scheduler, stages and episode pool
+    schedule = schedule or WatchSchedule()
+    subscriptions: set[int] = set()
+    subscriptions_mtime = None
+    week_loaded = 0.0
+    inflight: dict[tuple[int, int], Future] = {}
+    names: dict[int, str] = {}
+    
+    def poll(thread_id: int) -> tuple[AnimeTotalInfoTableDict, list[int]]:
+        anime_info = Myself.anime_total_info(url=Myself.thread_url(thread_id), revalidate=True)
+        if not anime_info:
+            raise ValueError(f'thread {thread_id} has no anime info')
+        show_dir = os.path.join(download_dir, anime_info['name'])
+        return anime_info, pending_episodes(anime_info, show_dir, thread_id=thread_id)
+    
+    def finished(key: tuple[int, int], future: Future) -> bool:
+        # an episode is done once it is published, not when its segments are in
+        if not future.done():
+            return False
+        if future.exception() is None and post is not None and key in post.futures:
+            return post.futures[key].done()
+        return True
+    
+    post = PostProcessor(remux_workers, publish_workers, stage_queue) if remux_workers > 0 and stream is None else None
+    with SegmentScheduler(max_workers=max_inflight or threads * e_threads, initial=threads) as scheduler, \
+            post or nullcontext(), \
+            ThreadPoolExecutor(max_workers=e_threads) as executor, \
+            ThreadPoolExecutor(max_workers=fetch_threads) as fetcher, \
+            progress.run():
+        while True:
+            now = time.time()
+            try:
+                mtime = os.stat(subscription_file).st_mtime
+            except OSError as e:
+                log.error(f'cannot read {subscription_file}: {e}')
+                mtime = subscriptions_mtime
+            if mtime != subscriptions_mtime:
+                try:
+                    current = set(read_subscriptions(subscription_file))
+                except (OSError, ValueError) as e:
+                    # half saved or mistyped, keep watching the previous list until the file changes again
+                    log.error(f'cannot read {subscription_file}: {e}')
+                    current = subscriptions
+                subscriptions_mtime = mtime
+                for thread_id in current - subscriptions:
+                    schedule.add(thread_id, now)
+                for thread_id in subscriptions - current:
+                    schedule.remove(thread_id)
+                log.info(f'watching {len(current)} subscriptions')
+                subscriptions = current
+            
+            if now - week_loaded >= schedule_refresh:
+                try:
+                    schedule.load_week(Myself.week_anime())
+                except Exception as e:
+                    # keep the schedule we have, try again after a poll interval
+                    log.error(f'failed to load the weekly schedule: {e}')
+                    week_loaded = now - schedule_refresh + schedule.poll_interval
+                else:
+                    week_loaded = now
+                    airing = sum(1 for thread_id in subscriptions if thread_id in schedule.airing)
+                    log.info(f'weekly schedule loaded, {airing} of {len(subscriptions)} subscriptions airing')
+            
+            due = schedule.pop_due(now)
+            polls = {fetcher.submit(poll, thread_id): thread_id for thread_id in due}
+            for future in concurrent.futures.as_completed(polls):
+                thread_id = polls[future]
+                try:
+                    anime_info, episodes = future.result()
+                except Exception as e:
+                    # a timeout or a changed page must not end the watch, the show is checked again later
+                    log.error(f'failed to check thread {thread_id}: {e}')
+                    schedule.failed(thread_id, time.time())
+                    continue
+                names[thread_id] = anime_info['name']
+                episodes = [e for e in episodes if (thread_id, e) not in inflight]
+                if not episodes:
+                    log.debug(f'{anime_info["name"]}: nothing new')
+                    schedule.missed(thread_id, time.time())
+                    continue
+                
+                print(f'{anime_info["name"]}: {len(episodes)} new episodes')
+                schedule.found(thread_id, time.time())
+                show_dir = os.path.join(download_dir, anime_info['name'])
+                progress.expect(len(episodes))
+                for episode_index in episodes:
+                    metrics.inc('watch_episodes_total')
+                    inflight[(thread_id, episode_index)] = executor.submit(
+                        download_episode, thread_id, episode_index, show_dir, threads,
+                        anime_info=anime_info, 
+                        resume=resume, 
+                        checksum=checksum, 
+                        stream=stream, 
+                        stream_window=stream_window, 
+                        scheduler=scheduler, 
+                        retry=retry, 
+                        failover_after=failover_after, 
+                        quality=quality, 
+                        probe_segments=probe_segments, 
+                        post=post)
             
+            for key, future in list(inflight.items()):
+                if not finished(key, future):
+                    continue
+                del inflight[key]
+                error = future.exception()
+                if error is None and post is not None and key in post.futures:
+                    error = post.futures.pop(key).exception()
+                if error is None:
+                    print(f'{names[key[0]]} episode {key[1]} downloaded')
+                else:
+                    # a failed episode is picked up again by an earlier check than next week's
+                    log.error(f'{names[key[0]]} episode {key[1]} failed: {error}')
+                    schedule.failed(key[0], time.time())
+            
+            wait = schedule.wait(time.time())
+            # wake up now and then to notice a changed subscription file and finished episodes
+            time.sleep(min(wait if wait is not None else 60, 60 if not inflight else 5))
+
+
+def enqueue_shows(queue: JobQueue, thread_ids: list[int], fetch_threads: int = 8):
+    # the coordinator side: one job per episode, the show's info travels with the jobs
+    print(f'fetching anime info of {len(thread_ids)} shows...')
+    added = shows = 0
+    with ThreadPoolExecutor(max_workers=fetch_threads) as executor:
+        futures = {executor.submit(Myself.anime_total_info, 
+                                   url=Myself.thread_url(thread_id)): thread_id 
+                   for thread_id in thread_ids}
+        for future in concurrent.futures.as_completed(futures):
+            thread_id = futures[future]
+            try:
+                anime_info = future.result()
+            except ValueError as e:
+                log.error(f'failed to fetch thread {thread_id}: {e}')
+                continue
+            if not anime_info:
+                log.error(f'thread {thread_id} has no anime info, skipped')
+                continue
+            added += queue.add(thread_id, anime_info)
+            shows += 1
+    stats = queue.stats()
+    print(f'queued {added} new episodes of {shows} shows, {stats["queued"]} queued, {stats["leased"]} leased, '
+          f'{stats["done"]} done, {stats["failed"]} failed')
+
+
+def print_queue_status(queue: JobQueue):
+    stats = queue.stats()
+    from rich.table import Table
+    table = Table(title=f'job queue of {stats["shows"]} shows')
+    table.add_column('state')
+    table.add_column('jobs', justify='right')
+    for state in STATES:
+        table.add_row(state, str(stats[state]))
+    table.add_row('lease expired', str(stats['expired']))
+    table.add_row('MB done', f'{stats["bytes"] / 1e6:.1f}')
+    print(table)
+    for failure in queue.failures():
+        print(f'failed: {failure["name"]} ({failure["thread_id"]}) episode {failure["episode_index"]} '
+              f'after {failure["attempts"]} attempts: {failure["error"]}')
+
+
+def work_queue(queue: JobQueue | RemoteQueue,
+               download_dir: str = '.',
+               threads: int = 8,
+               e_threads: int = 4,
+               resume: bool = True,
+               checksum: bool = False,
+               stream: str | None = None,
+               stream_window: int | None = None,
+               max_inflight: int | None = None,
+               retry: RetryPolicy | None = None,
+               failover_after: int = 3,
+               quality: str = 'best',
+               probe_segments: int = 2,
+               lease: float = DEFAULT_LEASE,
+               linger: float = 0.0,
+               worker: str | None = None,
+               remux_workers: int = 1,
+               publish_workers: int = 1,
+               stage_queue: int = 2) -> dict[str, int]:
+    # e_threads slots each lease one episode at a time, a heartbeat renews every lease that is
+    # held, so a worker that dies loses its jobs to the others once their leases run out
+    worker = worker or worker_name()
+    # job id -> set once the lease is lost, the episode stops fetching and is not merged
+    held: dict[int, threading.Event] = {}
+    stats = {'done': 0, 'failed': 0, 'lost': 0, 'bytes': 0}
+    lock = threading.Lock()
+    stop = threading.Event()
     
-    print(f'finished downloading {anime_info["name"]}')
+    def heartbeat():
+        while not stop.wait(lease / 3):
+            for job_id, cancel in list(held.items()):
+                try:
+                    if not queue.renew(job_id, worker, lease):
+                        log.warning(f'job {job_id}: lease lost to another worker, stopping it')
+                        cancel.set()
+                except (OSError, ValueError) as e:
+                    log.warning(f'job {job_id}: cannot renew the lease: {e}')
+    
+    def run(job: JobDict, cancel: threading.Event) -> int:
+        anime_info = job['anime_info']
+        show_dir = os.path.join(download_dir, anime_info['name'])
+        if library.index is not None:
+            library.index.refresh(show_dir)
+        if episode_downloaded(anime_info, job['episode_index'], show_dir, index=library.index, thread_id=job['thread_id']):
+            log.info(f'{anime_info["name"]} {anime_info["video"][job["episode_index"]]["name"]} already downloaded')
+            return 0
+        return download_episode(job['thread_id'], 
+                                job['episode_index'], 
+                                show_dir, 
+                                threads, 
+                                anime_info=anime_info, 
+                                resume=resume, 
+                                checksum=checksum, 
+                                stream=stream, 
+                                stream_window=stream_window, 
+                                scheduler=scheduler, 
+                                retry=retry, 
+                                failover_after=failover_after, 
+                                quality=quality, 
+                                probe_segments=probe_segments,
+                                post=post,
+                                cancel=cancel)
+    
+    def finish(job: JobDict, name: str, nbytes: int, error: BaseException | None):
+        # a job is only reported done once the episode is in place, the lease is held until then
+        held.pop(job['id'], None)
+        if isinstance(error, DownloadCancelledError):
+            log.warning(f'{name}: {error}')
+            metrics.inc('queue_jobs_total', result='lost')
+            with lock:
+                stats['lost'] += 1
+            return
+        if error is not None:
+            log.error(f'{name} failed (attempt {job["attempts"]}): {error}')
+            try:
+                state = queue.fail(job['id'], worker, f'{type(error).__name__}: {error}')
+            except (OSError, ValueError) as e:
+                # the lease runs out and the job is retried anyway
+                log.warning(f'job {job["id"]}: cannot report the failure: {e}')
+                state = None
+            metrics.inc('queue_jobs_total', result=state or 'lost')
+            with lock:
+                stats['failed'] += 1
+            return
+        try:
+            if not queue.complete(job['id'], worker, nbytes):
+                log.info(f'{name} was finished by another worker as well')
+        except (OSError, ValueError) as e:
+            log.warning(f'job {job["id"]}: cannot report completion, it will be downloaded again: {e}')
+        metrics.inc('queue_jobs_total', result='done')
+        with lock:
+            stats['done'] += 1
+            stats['bytes'] += nbytes
+    
+    def slot():
+        idle_since = None
+        while not stop.is_set():
+            try:
+                job = queue.lease(worker, lease)
+            except (OSError, ValueError) as e:
+                log.warning(f'cannot lease a job: {e}')
+                job = None
+            if job is None:
+                try:
+                    remaining = queue.stats()
+                except (OSError, ValueError):
+                    remaining = None
+                now = time.monotonic()
+                if remaining is not None and remaining['queued'] == 0 and remaining['leased'] == 0:
+                    idle_since = idle_since or now
+                    if now - idle_since >= linger:
+                        return
+                else:
+                    # leases of other workers may still run out, jobs in backoff come due
+                    idle_since = None
+                stop.wait(min(5, lease / 3))
+                continue
+            
+            idle_since = None
+            name = f'{job["anime_info"]["name"]} {job["anime_info"]["video"][job["episode_index"]]["name"]}'
+            held[job['id']] = threading.Event()
+            progress.expect(1)
+            try:
+                nbytes = run(job, held[job['id']])
+            except Exception as e:
+                finish(job, name, 0, e)
+                continue
+            staged = post.futures.pop((job['thread_id'], job['episode_index']), None) if post is not None else None
+            if staged is None:
+                finish(job, name, nbytes, None)
+            else:
+                # merged and published on the stage workers, this slot leases the next job meanwhile
+                staged.add_done_callback(lambda future, job=job, name=name, nbytes=nbytes:
+                                         finish(job, name, nbytes, future.exception()))
+    
+    print(f'worker {worker} started')
+    renewer = threading.Thread(target=heartbeat, name='lease-heartbeat', daemon=True)
+    post = PostProcessor(remux_workers, publish_workers, stage_queue) if remux_workers > 0 and stream is None else None
+    with SegmentScheduler(max_workers=max_inflight or threads * e_threads, initial=threads) as scheduler, \
+            ThreadPoolExecutor(max_workers=e_threads) as executor, \
+            progress.run():
+        renewer.start()
+        try:
+            for future in [executor.submit(slot) for _ in range(e_threads)]:
+                future.result()
+        finally:
+            if post is not None:
+                # episodes still in the stages keep their leases until they are published
+                post.close()
+            stop.set()
+            renewer.join()
+    
+    lost = f', {stats["lost"]} lost to other workers' if stats['lost'] else ''
+    print(f'worker {worker} finished: {stats["done"]} episodes done, {stats["failed"]} failed{lost}, '
+          f'{stats["bytes"] / 1e6:.1f} MB')
+    return stats
+
+
+def update_catalog(catalog: Catalog, 
+                   threads: int = 4, 
+                   rate: float = 2.0, 
+                   pages: int = 100, 
+                   max_age: dict[str, float] | None = None, 
+                   force: bool = False):
+    print('crawling the finished list, the weekly schedule and the finished forum pages...')
+    started = time.monotonic()
+    result = CatalogCrawler(catalog, threads=threads, rate=rate, max_age=max_age, force=force).refresh(pages=pages)
+    print(f'catalog updated in {time.monotonic() - started:.1f}s: {result["anime"]} anime ({result["airing"]} airing), '
+          f'pages {result["changed"]} changed, {result["unchanged"]} unchanged, {result["skipped"]} still fresh, {result["failed"]} failed')
+
+
+def search_catalog(catalog: Catalog, query: str, limit: int = 20, weekday: str | None = None):
+    started = time.perf_counter()
+    entries = catalog.search(query, limit=limit, weekday=weekday)
+    elapsed = time.perf_counter() - started
+    if not entries and catalog.stats()['anime'] == 0:
+        print('the catalog is empty, run "catalog update" first')
+        return
+    
+    from rich.table import Table
+    table = Table(title=f'{len(entries)} matches for "{query}" in {elapsed * 1000:.1f}ms')
+    table.add_column('thread', justify='right')
+    table.add_column('name')
+    table.add_column('season')
+    table.add_column('airing')
+    for entry in entries:
+        airing = f'{entry["weekday"]} {entry["update"] or ""}'.strip() if entry['weekday'] else '-'
+        table.add_row(str(entry['thread_id']), entry['name'], entry['season'] or '-', airing)
+    print(table)
+
+
+def print_metrics_summary():
+    from rich.table import Table
+    elapsed = time.time() - metrics.started
+    table = Table(title=f'run summary, {elapsed:.1f}s wall')
+    table.add_column('phase')
+    table.add_column('count', justify='right')
+    table.add_column('time (s)', justify='right')
+    table.add_column('avg (ms)', justify='right')
+    table.add_column('MB', justify='right')
+    table.add_column('errors', justify='right')
+    for phase, row in metrics.summary().items():
+        # summed over concurrent workers, so segment time can exceed the wall time
+        table.add_row(phase, str(int(row['count'])), f'{row["seconds"]:.1f}', 
+                      f'{row["seconds"] / row["count"] * 1000:.0f}' if row['count'] else '-', 
+                      f'{row["bytes"] / 1e6:.1f}', str(int(row['errors'])))
+    print(table)
+    
+    retries = sum(metrics.counters.get('retries_total', {}).values())
+    failovers = sum(metrics.counters.get('failovers_total', {}).values())
+    statuses = {dict(key)['status']: int(n) for key, n in metrics.counters.get('http_requests_total', {}).items()}
+    print(f'retries: {int(retries)}, failovers: {int(failovers)}, http: {statuses}')
+    if segment_store.store is not None:
+        stats = segment_store.store.stats()
+        print(f'segment store: {stats["hits"]} hits, {stats["misses"]} misses, {stats["saved_bytes"] / 1e6:.1f} MB not downloaded, '
+              f'{stats["blobs"]} segments in {stats["bytes"] / 1e6:.1f} MB')
+
+
+def _add_download_options(parser):
+    parser.add_argument('-t', '--threads',
+                        type=int,
+                        required=False,
+                        default=8,
+                        help='number of concurrent download threads per episode (Default: 8)')
+    parser.add_argument('-c',
+                        type=int,
+                        required=False,
+                        default=4,
+                        help='number of episodes downloaded at a time (Default: 4)')
+    parser.add_argument('-d', '--download-path',
+                        type=dir_path,
+                        required=False,
+                        default='./download',
+                        help='specify the download directory (default: "./download")')
+    parser.add_argument('--resume',
+                        action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='keep finished segments in ts/ and only fetch missing or truncated ones (Default: on)')
+    parser.add_argument('--checksum',
+                        action='store_true',
+                        help='record and verify sha256 of finished segments when resuming')
+    parser.add_argument('--stream',
+                        choices=['mp4', 'ts'],
+                        required=False,
+                        default=None,
+                        help='append segments in order straight into the output instead of going through ts/ and a concat pass; "mp4" remuxes through ffmpeg stdin, "ts" writes the raw stream (ignores --resume)')
+    parser.add_argument('--stream-window',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='max segments in flight or waiting in the reorder buffer per episode, bounds memory when streaming (Default: threads * 2)')
+    parser.add_argument('--max-inflight',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='segments in flight across all episodes with --engine async, --adaptive or sync (Default: threads * c)')
+    parser.add_argument('--retries',
+                        type=int,
+                        required=False,
+                        default=5,
+                        help='attempts per segment before giving up on it (Default: 5)')
+    parser.add_argument('--retry-backoff',
+                        type=float,
+                        required=False,
+                        default=0.5,
+                        help='base of the exponential backoff between attempts in seconds, with jitter; Retry-After wins when longer (Default: 0.5)')
+    parser.add_argument('--retry-max-delay',
+                        type=float,
+                        required=False,
+                        default=30.0,
+                        help='upper bound of a single backoff in seconds (Default: 30)')
+    parser.add_argument('--failover-after',
+                        type=int,
+                        required=False,
+                        default=3,
+                        help='consecutive segment failures on a host before the episode url is resolved again, 0 disables (Default: 3)')
+    parser.add_argument('--quality',
+                        type=quality_spec,
+                        required=False,
+                        default='best',
+                        help=f'variant to download when the episode has a master playlist: {QUALITY_HELP} (Default: best)')
+    parser.add_argument('--probe-segments',
+                        type=int,
+                        required=False,
+                        default=2,
+                        help='segments fetched to measure the link for --quality auto, once per host and run (Default: 2)')
+    parser.add_argument('--chunk-size',
+                        type=int,
+                        required=False,
+                        default=download_opt['chunk_size'] // 1024,
+                        help=f'KiB read at a time while writing a segment to disk, bounds memory per segment in flight (Default: {download_opt["chunk_size"] // 1024})')
+    parser.add_argument('--remuxer',
+                        choices=['auto', 'native', 'ffmpeg'],
+                        required=False,
+                        default=remux_opt['remuxer'],
+                        help='turn segments into mp4 in-process with PyAV or with the ffmpeg binary, auto uses PyAV when installed and falls back to ffmpeg if it fails (Default: auto)')
+    parser.add_argument('--remux-workers',
+                        type=int,
+                        required=False,
+                        default=1,
+                        help='ffmpeg merges running behind the downloads, 0 merges and moves inside the download slot like before (Default: 1)')
+    parser.add_argument('--publish-workers',
+                        type=int,
+                        required=False,
+                        default=1,
+                        help='merged episodes copied to the destination at a time (Default: 1)')
+    parser.add_argument('--stage-queue',
+                        type=int,
+                        required=False,
+                        default=2,
+                        help='episodes waiting in front of the remux and publish stages before downloads pause (Default: 2)')
+    parser.add_argument('--limit-rate',
+                        type=rate_spec,
+                        required=False,
+                        default=0,
+                        help=f'cap on segment download speed across all episodes and threads, {RATE_HELP} (Default: 0)')
+    parser.add_argument('--limit-schedule',
+                        type=schedule_spec,
+                        required=False,
+                        default=None,
+                        help=f'time of day caps, {SCHEDULE_HELP}')
+    parser.add_argument('--pool-size',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='keep-alive connections kept per host (Default: threads * c)')
+    parser.add_argument('--pool-block',
+                        action='store_true',
+                        help='wait for a free pooled connection instead of opening a throwaway one')
+    parser.add_argument('--progress',
+                        choices=PROGRESS_MODES,
+                        required=False,
+                        default='auto',
+                        help='"bar" draws a bar per episode and a total with byte throughput and ETA, "log" prints a summary line every --progress-interval seconds for cron logs, "auto" picks bar on a terminal and log otherwise (Default: auto)')
+    parser.add_argument('--progress-interval',
+                        type=float,
+                        required=False,
+                        default=60,
+                        help='seconds between summary lines with --progress log (Default: 60)')
+
 
+def _build_sync_parser(subcmd):
+    sync_parser = subcmd.add_parser('sync',
+                                    help='download every missing episode of the subscribed anime in one run')
+    sync_parser.add_argument('subscription_file',
+                             nargs='?',
+                             default='./subscribed.txt',
+                             help='file with thread ids separated by whitespace, "#" starts a comment (Default: "./subscribed.txt")')
+    sync_parser.add_argument('--fetch-threads',
+                             type=int,
+                             required=False,
+                             default=8,
+                             help='number of thread pages fetched at a time (Default: 8)')
+    _add_download_options(sync_parser)
+
+
+def _build_watch_parser(subcmd):
+    watch_parser = subcmd.add_parser('watch',
+                                     help='keep running and download new episodes of the subscribed anime as the weekly schedule says they come out')
+    watch_parser.add_argument('subscription_file',
+                              nargs='?',
+                              default='./subscribed.txt',
+                              help='file with thread ids separated by whitespace, "#" starts a comment, re-read when it changes (Default: "./subscribed.txt")')
+    watch_parser.add_argument('--fetch-threads',
+                              type=int,
+                              required=False,
+                              default=8,
+                              help='number of thread pages checked at a time (Default: 8)')
+    watch_parser.add_argument('--poll-interval',
+                              type=float,
+                              required=False,
+                              default=15,
+                              help='minutes between the first checks of a show on its update day, doubles while nothing turns up (Default: 15)')
+    watch_parser.add_argument('--max-poll-interval',
+                              type=float,
+                              required=False,
+                              default=240,
+                              help='upper bound of the minutes between checks (Default: 240)')
+    watch_parser.add_argument('--grace-days',
+                              type=float,
+                              required=False,
+                              default=2,
+                              help='days after the start of the update day a show is still checked before waiting for next week (Default: 2)')
+    watch_parser.add_argument('--idle-interval',
+                              type=float,
+                              required=False,
+                              default=24,
+                              help='hours between checks of shows that are not on the weekly schedule (Default: 24)')
+    _add_download_options(watch_parser)
+
+
+def _build_catalog_parser(subcmd):
+    catalog_parser = subcmd.add_parser('catalog',
+                                       help='search thread ids offline in a local catalog of the site')
+    catalog_cmd = catalog_parser.add_subparsers(dest='catalog_cmd', metavar='ACTION')
+    catalog_cmd.required = True
+    
+    update_parser = catalog_cmd.add_parser('update',
+                                           help='crawl the finished list, the weekly schedule and the finished forum pages, only pages that changed are parsed again')
+    update_parser.add_argument('--threads',
+                               type=int,
+                               required=False,
+                               default=4,
+                               help='pages fetched at a time (Default: 4)')
+    update_parser.add_argument('--rate',
+                               type=float,
+                               required=False,
+                               default=2.0,
+                               help='requests per second at most, 0 is unlimited (Default: 2)')
+    update_parser.add_argument('--pages',
+                               type=int,
+                               required=False,
+                               default=100,
+                               help='finished forum pages crawled at most, the crawl stops at the first empty page (Default: 100)')
+    update_parser.add_argument('--max-age',
+                               type=ttl_pair,
+                               action='append',
+                               default=[],
+                               metavar='KIND=SECONDS',
+                               help='how long a crawled page is trusted without asking the site, KIND is finish_list, finish_page or week, can be repeated')
+    update_parser.add_argument('--force',
+                               action='store_true',
+                               help='fetch and parse every page again')
+    
+    search_parser = catalog_cmd.add_parser('search',
+                                           help='find anime by thread id, name prefix or substring')
+    search_parser.add_argument('query',
+                               help='part of the name or a thread id')
+    search_parser.add_argument('-n', '--limit',
+                               type=int,
+                               required=False,
+                               default=20,
+                               help='matches shown at most (Default: 20)')
+    search_parser.add_argument('--weekday',
+                               choices=['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
+                               default=None,
+                               help='only anime airing on this day')
+
+
+def _build_queue_parser(subcmd):
+    queue_parser = subcmd.add_parser('queue',
+                                     help='coordinate a backfill: fill and inspect the job queue that "worker" processes on this or other machines download from')
+    queue_cmd = queue_parser.add_subparsers(dest='queue_cmd', metavar='ACTION')
+    queue_cmd.required = True
+    
+    add_parser = queue_cmd.add_parser('add',
+                                      help='queue every episode of the given shows, episodes already in the queue are left alone')
+    add_parser.add_argument('thread_id',
+                            type=int,
+                            nargs='*',
+                            help='thread ids of the shows')
+    add_parser.add_argument('--subscriptions',
+                            default=None,
+                            metavar='FILE',
+                            help='also queue the shows of a subscription file')
+    add_parser.add_argument('--catalog',
+                            action='store_true',
+                            help='also queue every show of the local catalog, run "catalog update" first')
+    add_parser.add_argument('--fetch-threads',
+                            type=int,
+                            required=False,
+                            default=8,
+                            help='number of thread pages fetched at a time (Default: 8)')
+    
+    queue_cmd.add_parser('status',
+                         help='jobs per state and the latest failures')
+    
+    retry_parser = queue_cmd.add_parser('retry',
+                                        help='queue failed jobs again with fresh attempts')
+    retry_parser.add_argument('thread_id',
+                              type=int,
+                              nargs='*',
+                              help='only the failed jobs of these shows (Default: all)')
+    
+    serve_parser = queue_cmd.add_parser('serve',
+                                        help='serve the queue over HTTP to workers on other machines until interrupted')
+    serve_parser.add_argument('--host',
+                              default='127.0.0.1',
+                              help='address to listen on, 0.0.0.0 for every interface (Default: 127.0.0.1)')
+    serve_parser.add_argument('--port',
+                              type=int,
+                              default=8765,
+                              help='(Default: 8765)')
+
+
+def _build_worker_parser(subcmd):
+    worker_parser = subcmd.add_parser('worker',
+                                      help='download episodes leased from the job queue until it is empty')
+    worker_parser.add_argument('--lease',
+                               type=float,
+                               required=False,
+                               default=DEFAULT_LEASE,
+                               help=f'seconds a job stays with this worker between heartbeats, a dead worker\'s jobs go to the others after that long (Default: {DEFAULT_LEASE})')
+    worker_parser.add_argument('--linger',
+                               type=float,
+                               required=False,
+                               default=0,
+                               help='seconds to keep polling an empty queue before exiting, for workers started before the queue is filled (Default: 0)')
+    worker_parser.add_argument('--name',
+                               default=None,
+                               help='how this worker shows up in the queue (Default: host:pid)')
+    _add_download_options(worker_parser)
 
 
 def _build_dl_parser(subcmd):
@@ -183,21 +1327,17 @@ def _build_dl_parser(subcmd):
                            default=[],
                            nargs='+',
                            help='episode index, if not specified, downloads the whole anime series')
-    dl_parser.add_argument('-t', '--threads',
-                           type=int,
-                           required=False,
-                           default=8,
-                           help='number of concurrent download threads per episode (Default: 8)')
-    dl_parser.add_argument('-c',
-                           type=int,
-                           required=False,
-                           default=4,
-                           help='number of episodes downloaded at a time (Default: 4)')
-    dl_parser.add_argument('-d', '--download-path',
-                           type=dir_path,
-                           required=False,
-                           default='./download',
-                           help='specify the download directory (default: "./download")')
+    _add_download_options(dl_parser)
+    dl_parser.add_argument('--engine',
+                           choices=['threaded', 'async'],
+                           default='threaded',
+                           help='"threaded" runs a thread pool per episode, "async" runs every segment on one asyncio loop with a shared budget (Default: threaded)')
+    dl_parser.add_argument('--adaptive',
+                           action='store_true',
+                           help='threaded engine: share one segment queue across episodes and tune concurrency per host from throughput and errors (AIMD), starting at --threads per host')
+    dl_parser.add_argument('--list-variants',
+                           action='store_true',
+                           help='print the variants of the selected episodes (default: the first one) and exit without downloading')
 
 def _build_parser():
     parser = argparse.ArgumentParser(description='Download anime from Myself-bbs.com')
@@ -213,6 +1353,86 @@ def _build_parser():
         help="Be verbose",
         action="store_const", dest="loglevel", const=logging.INFO,
     )
+    parser.add_argument(
+        '--parser',
+        help='HTML parser backend, "lxml" skips BeautifulSoup and is several times faster (Default: bs4)',
+        choices=['bs4', 'lxml'], default=parser_opt['backend'],
+    )
+    parser.add_argument(
+        '--ws-pool-size',
+        help='websocket connections kept open for resolving episode urls, 0 opens one per episode (Default: 2)',
+        type=int, default=2,
+    )
+    parser.add_argument(
+        '--cache',
+        help='cache parsed thread pages and resolved episode urls on disk (Default: on)',
+        action=argparse.BooleanOptionalAction, default=True,
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help=f'where the metadata cache lives (Default: "{default_cache_dir()}")',
+        default=None,
+    )
+    parser.add_argument(
+        '--library',
+        help='keep a local index of downloaded episodes in the cache directory instead of checking the destination for every episode (Default: on)',
+        action=argparse.BooleanOptionalAction, default=True,
+    )
+    parser.add_argument(
+        '--segment-cache',
+        help='keep finished segments in a content-addressed store in the cache directory and reuse them when an episode is downloaded again (Default: off)',
+        action=argparse.BooleanOptionalAction, default=False,
+    )
+    parser.add_argument(
+        '--segment-cache-size',
+        help='segment store size limit in MB, least recently used segments are evicted (Default: 20480)',
+        type=int, default=20480,
+    )
+    parser.add_argument(
+        '--segment-link',
+        help='how segments move between the store and ts/, "auto" hardlinks and copies across filesystems, "reflink" clones on btrfs or xfs, "copy" always copies (Default: auto)',
+        choices=LINK_MODES, default='auto',
+    )
+    parser.add_argument(
+        '--queue',
+        help=f'job queue of "queue" and "worker", a sqlite file shared on this host or the http:// address of "queue serve" (Default: "{default_queue_path(default_cache_dir())}")',
+        default=None, metavar='PATH_OR_URL',
+    )
+    parser.add_argument(
+        '--queue-token',
+        help='shared secret between "queue serve" and workers on other machines, read from $MYSELF_QUEUE_TOKEN when not given so it stays out of the process list',
+        default=os.environ.get('MYSELF_QUEUE_TOKEN'), metavar='TOKEN',
+    )
+    parser.add_argument(
+        '--trace-file',
+        help='append every timed phase (metadata, resolve, playlist, segment, merge, move) and a run summary as JSON lines',
+        default=None, metavar='PATH',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='write counters and phase histograms in the Prometheus text format when the run ends, e.g. for the node_exporter textfile collector',
+        default=None, metavar='PATH',
+    )
+    parser.add_argument(
+        '--metrics-port',
+        help='serve the same metrics on http://127.0.0.1:PORT/metrics while running',
+        type=int, default=None, metavar='PORT',
+    )
+    parser.add_argument(
+        '--stats',
+        help='print time, bytes and errors per phase when the run ends',
+        action='store_true',
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        help='override how long a kind of entry stays fresh, e.g. thread=600 or episode=21600, can be repeated',
+        type=ttl_pair, action='append', default=[], metavar='KIND=SECONDS',
+    )
+    parser.add_argument(
+        '--cache-size',
+        help='cache size limit in MB, least recently used entries are evicted (Default: 64)',
+        type=int, default=64,
+    )
     
     # sub commands
     subcmd = parser.add_subparsers(
@@ -220,6 +1440,11 @@ def _build_parser():
     subcmd.required = True
 
     _build_dl_parser(subcmd)
+    _build_sync_parser(subcmd)
+    _build_watch_parser(subcmd)
+    _build_queue_parser(subcmd)
+    _build_worker_parser(subcmd)
+    _build_catalog_parser(subcmd)
 
     return parser
 
@@ -228,13 +1453,182 @@ def _build_parser():
 if __name__ == '__main__':
     parser = _build_parser()
     args = parser.parse_args()
-    logging.getLogger().setLevel(level=args.loglevel)
+    if args.subcmd == 'download' and args.engine == 'async' and args.adaptive:
+        parser.error('--adaptive tunes the threaded engine\'s scheduler, the async engine shares --max-inflight instead')
+    from rich.logging import RichHandler
+    logging.basicConfig(
+        level=args.loglevel, format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
+    )
     
     log.debug(args)
     
-    if args.subcmd == 'download':
-        download_anime(args.thread_id, 
-                       download_dir=args.download_path, 
-                       threads=args.threads, 
-                       e_threads=args.c, 
-                       episode_list=args.episode_index)
+    parser_opt['backend'] = args.parser
+    ws_pool.configure(args.ws_pool_size)
+    if args.cache:
+        Myself.cache = MetadataCache(args.cache_dir, 
+                                     ttl=dict(args.cache_ttl), 
+                                     max_bytes=args.cache_size * 1024 * 1024)
+    
+    if args.library:
+        library.index = LibraryIndex(args.cache_dir or default_cache_dir())
+    
+    if args.segment_cache:
+        segment_store.store = SegmentStore(args.cache_dir or default_cache_dir(), 
+                                           max_bytes=args.segment_cache_size * 1024 * 1024, 
+                                           link=args.segment_link)
+    
+    if args.subcmd in ('download', 'sync', 'watch', 'worker'):
+        session_pool.configure(pool_maxsize=args.pool_size or args.threads * args.c,
+                               pool_block=args.pool_block)
+        download_opt['chunk_size'] = args.chunk_size * 1024
+        bandwidth.configure(args.limit_rate, args.limit_schedule)
+        progress.configure(args.progress, interval=args.progress_interval)
+        remux_opt['remuxer'] = args.remuxer
+        retry = RetryPolicy(attempts=args.retries, 
+                            backoff=args.retry_backoff, 
+                            max_delay=args.retry_max_delay)
+    
+    if args.trace_file:
+        metrics.trace_to(args.trace_file)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    
+    try:
+        if args.subcmd == 'catalog':
+            catalog = Catalog(args.cache_dir or default_cache_dir())
+            if args.catalog_cmd == 'update':
+                update_catalog(catalog, 
+                               threads=args.threads, 
+                               rate=args.rate, 
+                               pages=args.pages, 
+                               max_age=dict(args.max_age), 
+                               force=args.force)
+            else:
+                search_catalog(catalog, args.query, limit=args.limit, weekday=args.weekday)
+        elif args.subcmd == 'queue':
+            queue = open_queue(args.queue or default_queue_path(args.cache_dir or default_cache_dir()))
+            if not isinstance(queue, JobQueue):
+                raise SystemExit('the queue is managed where its file is, not through "queue serve"')
+            if args.queue_cmd == 'add':
+                thread_ids = list(args.thread_id)
+                if args.subscriptions:
+                    thread_ids += read_subscriptions(args.subscriptions)
+                if args.catalog:
+                    thread_ids += Catalog(args.cache_dir or default_cache_dir()).thread_ids()
+                enqueue_shows(queue, list(dict.fromkeys(thread_ids)), fetch_threads=args.fetch_threads)
+            elif args.queue_cmd == 'status':
+                print_queue_status(queue)
+            elif args.queue_cmd == 'retry':
+                print(f'queued {queue.retry_failed(args.thread_id)} failed jobs again')
+            else:
+                if args.queue_token is None and args.host not in ('127.0.0.1', 'localhost', '::1'):
+                    log.warning(f'serving the queue on {args.host} without --queue-token, anybody who reaches it can take jobs')
+                serve_queue(queue, args.port, host=args.host, token=args.queue_token)
+                print(f'serving {queue.path} on http://{args.host}:{args.port}, workers use --queue http://HOST:{args.port}')
+                threading.Event().wait()
+        elif args.subcmd == 'worker':
+            work_queue(open_queue(args.queue or default_queue_path(args.cache_dir or default_cache_dir()), args.queue_token),
+                       download_dir=args.download_path,
+                       threads=args.threads,
+                       e_threads=args.c,
+                       resume=args.resume,
+                       checksum=args.checksum,
+                       stream=args.stream,
+                       stream_window=args.stream_window,
+                       max_inflight=args.max_inflight,
+                       retry=retry,
+                       failover_after=args.failover_after,
+                       quality=args.quality,
+                       probe_segments=args.probe_segments,
+                       lease=args.lease,
+                       linger=args.linger,
+                       worker=args.name,
+                       remux_workers=args.remux_workers,
+                       publish_workers=args.publish_workers,
+                       stage_queue=args.stage_queue)
+        elif args.subcmd == 'download' and args.list_variants:
+            list_variants(args.thread_id, args.episode_index)
+        elif args.subcmd == 'sync':
+            sync_subscriptions(args.subscription_file,
+                               download_dir=args.download_path,
+                               threads=args.threads,
+                               e_threads=args.c,
+                               fetch_threads=args.fetch_threads,
+                               resume=args.resume,
+                               checksum=args.checksum,
+                               stream=args.stream,
+                               stream_window=args.stream_window,
+                               max_inflight=args.max_inflight,
+                               retry=retry,
+                               failover_after=args.failover_after,
+                               quality=args.quality,
+                               probe_segments=args.probe_segments,
+                               remux_workers=args.remux_workers,
+                               publish_workers=args.publish_workers,
+                               stage_queue=args.stage_queue)
+        elif args.subcmd == 'watch':
+            watch_subscriptions(args.subscription_file,
+                                download_dir=args.download_path,
+                                threads=args.threads,
+                                e_threads=args.c,
+                                fetch_threads=args.fetch_threads,
+                                resume=args.resume,
+                                checksum=args.checksum,
+                                stream=args.stream,
+                                stream_window=args.stream_window,
+                                max_inflight=args.max_inflight,
+                                retry=retry,
+                                failover_after=args.failover_after,
+                                quality=args.quality,
+                                probe_segments=args.probe_segments,
+                                remux_workers=args.remux_workers,
+                                publish_workers=args.publish_workers,
+                                stage_queue=args.stage_queue,
+                                schedule=WatchSchedule(poll_interval=args.poll_interval * 60,
+                                                       max_interval=args.max_poll_interval * 60,
+                                                       grace=args.grace_days * DAY,
+                                                       idle_interval=args.idle_interval * 60 * 60))
+        elif args.subcmd == 'download' and args.engine == 'async':
+            import asyncio
+            from async_engine import download_anime_async
+            if args.stream is not None:
+                log.warning('--stream is not supported by the async engine, ignored')
+            asyncio.run(download_anime_async(args.thread_id,
+                                             download_dir=args.download_path,
+                                             max_inflight=args.max_inflight or args.threads * args.c,
+                                             e_concurrency=args.c,
+                                             episode_list=args.episode_index,
+                                             resume=args.resume,
+                                             checksum=args.checksum,
+                                             retry=retry,
+                                             failover_after=args.failover_after,
+                                             quality=args.quality,
+                                             probe_segments=args.probe_segments,
+                                             remux_workers=args.remux_workers,
+                                             publish_workers=args.publish_workers,
+                                             stage_queue=args.stage_queue))
+        elif args.subcmd == 'download':
+            download_anime(args.thread_id, 
+                           download_dir=args.download_path, 
+                           threads=args.threads, 
+                           e_threads=args.c, 
+                           episode_list=args.episode_index,
+                           resume=args.resume,
+                           checksum=args.checksum,
+                           stream=args.stream,
+                           stream_window=args.stream_window,
+                           adaptive=args.adaptive,
+                           max_inflight=args.max_inflight,
+                           retry=retry,
+                           failover_after=args.failover_after,
+                           quality=args.quality,
+                           probe_segments=args.probe_segments,
+                           remux_workers=args.remux_workers,
+                           publish_workers=args.publish_workers,
+                           stage_queue=args.stage_queue)
+    finally:
+        metrics.close()
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
+        if args.stats:
+            print_metrics_summary()
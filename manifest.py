@@ -0,0 +1,89 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import TypedDict
+
+log = logging.getLogger("rich")
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+class SegmentEntryDict(TypedDict, total=False):
+    uri: str
+    size: int
+    sha256: str
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SegmentManifest:
+    """
+    Append-only record of completed segments of one episode, kept next to the
+    ts files so an interrupted download can pick up where it left off.
+    One JSON object per line; the last entry for a uri wins.
+    """
+
+    def __init__(self, directory: str, checksum: bool = False):
+        self.directory = directory
+        self.checksum = checksum
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._entries: dict[str, SegmentEntryDict] = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry: SegmentEntryDict = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line from a killed process
+                    continue
+                self._entries[entry['uri']] = entry
+        log.debug(f'loaded {len(self._entries)} manifest entries from {self.path}')
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_complete(self, uri: str) -> bool:
+        """A segment is complete when it is recorded and the file on disk still matches."""
+        entry = self._entries.get(uri)
+        if entry is None:
+            return False
+        path = os.path.join(self.directory, uri)
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return False
+        except OSError:
+            return False
+        if 'sha256' in entry and self.checksum:
+            return file_sha256(path) == entry['sha256']
+        return True
+
+    def partial_size(self, uri: str) -> int:
+        """Bytes already on disk for a segment that is not complete yet."""
+        try:
+            return os.path.getsize(os.path.join(self.directory, uri))
+        except OSError:
+            return 0
+
+    def record(self, uri: str):
+        path = os.path.join(self.directory, uri)
+        entry: SegmentEntryDict = {'uri': uri, 'size': os.path.getsize(path)}
+        if self.checksum:
+            entry['sha256'] = file_sha256(path)
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._entries[uri] = entry
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
@@ -0,0 +1,337 @@
+import glob
+import importlib.util
+import io
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from subprocess import Popen, PIPE, STDOUT
+from typing import BinaryIO, Iterable
+
+log = logging.getLogger("rich")
+
+remux_opt = {
+    'remuxer': 'auto',  # native remuxes in-process with PyAV, ffmpeg runs the binary, auto tries native first
+}
+
+# ffmpeg's last lines, kept for the error message when it fails
+TAIL_LINES = 20
+
+
+# https://stackoverflow.com/questions/21953835/run-subprocess-and-print-output-to-logging
+def log_subprocess_output(pipe, log_level: int, tail: deque | None = None):
+    # formatting every line through rich is expensive, skip it when nobody would see it
+    enabled = log.isEnabledFor(log_level)
+    for line in iter(pipe.readline, b''): # b'\n'-separated lines
+        if enabled:
+            log.log(log_level, line)
+        if tail is not None:
+            tail.append(line)
+
+
+def native_remux_available() -> bool:
+    return importlib.util.find_spec('av') is not None
+
+
+# a segment starting this many seconds before the end of the previous one is a timestamp reset
+DISCONTINUITY = 1.0
+
+# segments a streamed native remux keeps for replaying into ffmpeg when PyAV fails on them
+REPLAY_SEGMENTS = 3
+
+
+def remux_segments(segments: Iterable[str | BinaryIO], output: str):
+    """
+    Copy the audio and video packets of MPEG-TS segments, in order, into
+    one mp4 with PyAV: one pass and no subprocess. The mp4 muxer inserts
+    aac_adtstoasc on its own.
+
+    HLS segments normally carry continuous timestamps and are copied as
+    they are. When a segment jumps back in time (a discontinuity, or the
+    same segment repeated) everything after it is shifted to continue
+    where the output ended, like the concat demuxer does, and the odd
+    packet that would still go backwards is dropped.
+    """
+    import av
+    mp4 = None
+    outputs: dict[tuple[str, int], av.stream.Stream] = {}
+    last_dts: dict[tuple[str, int], int] = {}
+    offset = 0.0
+    end: float | None = None
+    try:
+        for segment in segments:
+            with av.open(segment, format='mpegts') as ts:
+                if mp4 is None:
+                    mp4 = av.open(output, 'w', format='mp4')
+                # streams are matched by kind and position, pids may change between segments
+                inputs: dict[int, tuple[str, int]] = {}
+                for stream in ts.streams:
+                    if stream.type in ('video', 'audio'):
+                        key = (stream.type, sum(1 for k in inputs.values() if k[0] == stream.type))
+                        if key not in outputs and not last_dts:
+                            outputs[key] = mp4.add_stream_from_template(stream)
+                        if key in outputs:
+                            inputs[stream.index] = key
+
+                start = ts.start_time / av.time_base if ts.start_time is not None else 0.0
+                if end is not None and start + offset < end - DISCONTINUITY:
+                    offset = end - start
+
+                for packet in ts.demux(*(ts.streams[i] for i in inputs)):
+                    # the demuxer ends every stream with an empty flush packet
+                    if packet.dts is None:
+                        continue
+                    key = inputs[packet.stream.index]
+                    shift = round(offset / packet.time_base)
+                    packet.dts += shift
+                    if packet.pts is not None:
+                        packet.pts += shift
+                    if key in last_dts and packet.dts <= last_dts[key]:
+                        continue
+                    last_dts[key] = packet.dts
+                    end = max(end or 0.0, float((packet.dts + packet.duration) * packet.time_base))
+                    packet.stream = outputs[key]
+                    mp4.mux(packet)
+    finally:
+        if mp4 is not None:
+            mp4.close()
+    if mp4 is None:
+        raise ValueError(f'no segments to remux into {output}')
+
+
+def concat_ts_dir(ts_dir: str, merged_mp4: str, segments: list[str] | None = None):
+    """
+    Concat `segments` in playlist order, or every *.ts in ts_dir by name,
+    into ts_dir/merged_mp4, in-process with PyAV or with ffmpeg depending
+    on remux_opt['remuxer'].
+    """
+    ts_files = segments or sorted(glob.glob(root_dir=ts_dir, pathname='*.ts'))
+    remuxer = remux_opt['remuxer']
+    if remuxer == 'native' or (remuxer == 'auto' and native_remux_available()):
+        try:
+            remux_segments((os.path.join(ts_dir, name) for name in ts_files), os.path.join(ts_dir, merged_mp4))
+            return
+        except Exception as e:
+            if remuxer == 'native':
+                raise
+            log.warning(f'native remux of {ts_dir} failed ({e}), falling back to ffmpeg')
+
+    with open(os.path.join(ts_dir, 'files.txt'), 'w') as file:
+        file.write('\n'.join(map(lambda s: f'file {s}', ts_files)))
+
+    process = Popen([
+        'ffmpeg', '-hide_banner', '-nostats', '-y', '-f', 'concat', '-i', 'files.txt', 
+        '-c', 'copy', '-bsf:a', 'aac_adtstoasc', merged_mp4
+    ], stdout=PIPE, stderr=STDOUT, cwd=ts_dir)
+    
+    tail: deque[bytes] = deque(maxlen=TAIL_LINES)
+    if process.stdout is not None:
+        with process.stdout:
+            log_subprocess_output(process.stdout, logging.DEBUG, tail)
+    if (code := process.wait()) != 0:
+        raise RuntimeError(f'ffmpeg exited with {code} while merging {ts_dir}: '
+                           + b''.join(tail).decode('utf-8', 'replace').strip())
+
+
+class OrderedSegmentWriter:
+    """
+    Reorder buffer that appends segments to `sink` strictly in playlist order.
+
+    Segments may finish in any order; out of order ones are held until every
+    earlier index has been written. `window` caps how many segments can be
+    fetched or buffered at once, callers take a slot with `acquire()` before
+    starting segment i and the slot is handed back once it hits the sink.
+    As long as slots are taken in index order the next segment to write is
+    always in flight, so the window cannot deadlock.
+    """
+
+    def __init__(self, sink: BinaryIO, window: int = 16):
+        self.sink = sink
+        self.window = window
+        self.written = 0
+        self.bytes_written = 0
+        self.peak_buffered = 0
+        self._buffered = 0
+        self._next = 0
+        self._buffer: dict[int, bytes] = {}
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(window)
+        self._error: BaseException | None = None
+
+    def acquire(self):
+        self._slots.acquire()
+        if self._error is not None:
+            self._slots.release()
+            raise self._error
+
+    def put(self, index: int, data: bytes):
+        with self._lock:
+            if self._error is not None:
+                return
+            self._buffer[index] = data
+            self._buffered += len(data)
+            self.peak_buffered = max(self.peak_buffered, self._buffered)
+            try:
+                while (chunk := self._buffer.pop(self._next, None)) is not None:
+                    self._buffered -= len(chunk)
+                    self.sink.write(chunk)
+                    self.bytes_written += len(chunk)
+                    self._next += 1
+                    self.written += 1
+                    self._slots.release()
+            except BaseException as e:
+                self._fail(e)
+                raise
+
+    def fail(self, error: BaseException):
+        """Stop accepting segments and wake up everyone waiting for a slot."""
+        with self._lock:
+            self._fail(error)
+
+    def _fail(self, error: BaseException):
+        # called with the lock held, so a put in progress never sees half of it
+        if self._error is None:
+            self._error = error
+            self._buffer.clear()
+            self._buffered = 0
+            for _ in range(self.window):
+                self._slots.release()
+
+
+class FfmpegRemuxSink:
+    """Write side of `ffmpeg -f mpegts -i pipe:0 -c copy` remuxing into an mp4."""
+
+    def __init__(self, output: str, log_level: int = logging.DEBUG):
+        self.output = output
+        self.process = Popen([
+            'ffmpeg', '-hide_banner', '-nostats', '-y', '-f', 'mpegts', '-i', 'pipe:0',
+            '-c', 'copy', '-bsf:a', 'aac_adtstoasc', '-f', 'mp4', output
+        ], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        # ffmpeg blocks once its output pipe fills up, keep draining it
+        self._drain = threading.Thread(target=self._log_output, args=(log_level,), daemon=True)
+        self._drain.start()
+
+    def _log_output(self, log_level: int):
+        assert self.process.stdout is not None
+        with self.process.stdout:
+            log_subprocess_output(self.process.stdout, log_level)
+
+    def write(self, data: bytes):
+        assert self.process.stdin is not None
+        self.process.stdin.write(data)
+
+    def close(self) -> int:
+        if self.process.stdin is not None and not self.process.stdin.closed:
+            self.process.stdin.close()
+        code = self.process.wait()
+        self._drain.join()
+        return code
+
+    def abort(self):
+        self.process.kill()
+        self.close()
+
+
+class NativeRemuxSink:
+    """
+    Same interface as FfmpegRemuxSink, remuxing with PyAV on a thread.
+    Every write has to be one whole segment, which is how
+    OrderedSegmentWriter hands them over.
+
+    With `fallback` the first REPLAY_SEGMENTS segments are kept until PyAV
+    got through them. Should it fail by then, which is where unsupported
+    streams fail, they are replayed into ffmpeg and the rest of the stream
+    goes there too. A failure later on is raised from close.
+    """
+
+    def __init__(self, output: str, queue_size: int = 2, fallback: bool = False):
+        self.output = output
+        self.error: BaseException | None = None
+        self.remuxer = 'native'
+        self._ffmpeg: FfmpegRemuxSink | None = None
+        self._replay: list[bytes] | None = [] if fallback else None
+        self._pulled = 0
+        self._queue: queue.Queue[bytes | None] = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._remux, daemon=True)
+        self._thread.start()
+
+    def _segments(self) -> Iterable[BinaryIO]:
+        for data in iter(self._queue.get, None):
+            self._pulled += 1
+            yield io.BytesIO(data)
+
+    def _remux(self):
+        try:
+            remux_segments(self._segments(), self.output)
+        except Exception as e:
+            self.error = e
+
+    def _put(self, item: bytes | None):
+        # never block on a full queue once the remuxer is gone
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        if item is not None:
+            raise RuntimeError(f'native remux of {self.output} stopped: {self.error}')
+
+    def _fall_back(self) -> bool:
+        """Hand the stream to ffmpeg if the segments PyAV saw are all still there."""
+        if self._replay is None:
+            return False
+        self._thread.join()
+        log.warning(f'native remux of {self.output} failed ({self.error}), falling back to ffmpeg')
+        self._ffmpeg = FfmpegRemuxSink(self.output)
+        self.remuxer = 'ffmpeg'
+        for data in self._replay:
+            self._ffmpeg.write(data)
+        self._replay = None
+        return True
+
+    def write(self, data: bytes):
+        if self._ffmpeg is not None:
+            self._ffmpeg.write(data)
+            return
+        if self._replay is not None:
+            # PyAV is through the first segments and on its way, stop keeping a copy
+            if self._pulled > REPLAY_SEGMENTS:
+                self._replay = None
+            else:
+                self._replay.append(data)
+        try:
+            self._put(data)
+        except RuntimeError as e:
+            if not self._fall_back():
+                raise e from self.error
+
+    def close(self) -> int:
+        """0 once the mp4 is complete, ffmpeg's exit code after a fallback, raises when PyAV failed for good."""
+        if self._ffmpeg is None:
+            self._put(None)
+            self._thread.join()
+            if self.error is None:
+                return 0
+            if not self._fall_back():
+                raise RuntimeError(f'native remux of {self.output} failed: {self.error}') from self.error
+        assert self._ffmpeg is not None
+        return self._ffmpeg.close()
+
+    def abort(self):
+        if self._ffmpeg is not None:
+            self._ffmpeg.abort()
+            return
+        self._put(None)
+        self._thread.join()
+
+
+def open_stream_sink(output: str, remux: bool) -> BinaryIO | FfmpegRemuxSink | NativeRemuxSink:
+    """Either a plain .ts file or a remuxer writing an mp4, in-process or through ffmpeg."""
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    if not remux:
+        return open(output, 'wb')
+    if remux_opt['remuxer'] == 'native' or (remux_opt['remuxer'] == 'auto' and native_remux_available()):
+        return NativeRemuxSink(output, fallback=remux_opt['remuxer'] == 'auto')
+    return FfmpegRemuxSink(output)
@@ -0,0 +1,216 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import IO, TYPE_CHECKING, Iterator
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+log = logging.getLogger("rich")
+
+# phases a download goes through, in the order they happen
+PHASES = ('metadata', 'resolve', 'playlist', 'segment', 'merge', 'move')
+
+# upper bounds of the duration histograms in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+def _key(labels: dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Span:
+    """One timed phase, set `bytes` before it ends to account transferred data."""
+
+    def __init__(self, phase: str, labels: dict[str, object]):
+        self.phase = phase
+        self.labels = labels
+        self.bytes = 0
+        self.started = time.time()
+
+
+class Metrics:
+    """
+    In-process counters, gauges and duration histograms for the download
+    pipeline. Every `span` feeds the histograms and, with a trace file,
+    is also written out as one JSON line.
+
+    Everything is kept in memory and cheap enough to stay on; the exporters
+    only run when asked for.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: dict[str, dict[LabelKey, float]] = {}
+        self.gauges: dict[str, dict[LabelKey, float]] = {}
+        self.histograms: dict[str, dict[LabelKey, list[float]]] = {}
+        self.started = time.time()
+        self._trace: IO[str] | None = None
+        self._server: 'ThreadingHTTPServer | None' = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def gauge(self, name: str, delta: float, **labels):
+        """Move a gauge by `delta`, e.g. +1 when a segment is queued and -1 when it is done."""
+        key = _key(labels)
+        with self._lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + delta
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(labels)
+        with self._lock:
+            # bucket counts followed by sum and count
+            series = self.histograms.setdefault(name, {})
+            values = series.setdefault(key, [0.0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    values[i] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    @contextmanager
+    def span(self, phase: str, **labels) -> Iterator[Span]:
+        span = Span(phase, labels)
+        start = time.perf_counter()
+        error: BaseException | None = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('phase_seconds', elapsed, phase=phase)
+            if span.bytes:
+                self.inc('phase_bytes_total', span.bytes, phase=phase)
+            if error is not None:
+                self.inc('phase_errors_total', phase=phase, error=type(error).__name__)
+            if self._trace is not None:
+                self._write({
+                    'type': 'span',
+                    'phase': phase,
+                    'start': round(span.started, 6),
+                    'seconds': round(elapsed, 6),
+                    'bytes': span.bytes,
+                    'error': None if error is None else f'{type(error).__name__}: {error}',
+                    **labels,
+                })
+
+    def timed(self, phase: str):
+        """Decorator running every call of a function or coroutine function inside a span."""
+        def decorator(fn):
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def wrapper(*args, **kwargs):
+                    with self.span(phase):
+                        return await fn(*args, **kwargs)
+            else:
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    with self.span(phase):
+                        return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Time, count, bytes and errors per phase since the start of the run."""
+        with self._lock:
+            phases: dict[str, dict[str, float]] = {}
+            for key, values in self.histograms.get('phase_seconds', {}).items():
+                phases[dict(key)['phase']] = {'seconds': values[-2], 'count': values[-1], 'bytes': 0, 'errors': 0}
+            for key, value in self.counters.get('phase_bytes_total', {}).items():
+                phases.setdefault(dict(key)['phase'], {'seconds': 0, 'count': 0, 'bytes': 0, 'errors': 0})['bytes'] += value
+            for key, value in self.counters.get('phase_errors_total', {}).items():
+                phases.setdefault(dict(key)['phase'], {'seconds': 0, 'count': 0, 'bytes': 0, 'errors': 0})['errors'] += value
+        order = {phase: i for i, phase in enumerate(PHASES)}
+        return dict(sorted(phases.items(), key=lambda item: order.get(item[0], len(order))))
+
+    def prometheus(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        def labels(key: LabelKey, extra: str = '') -> str:
+            parts = [f'{k}="{v}"' for k, v in key] + ([extra] if extra else [])
+            return '{' + ','.join(parts) + '}' if parts else ''
+
+        lines = []
+        with self._lock:
+            for name, series in self.counters.items():
+                lines.append(f'# TYPE myself_{name} counter')
+                lines += [f'myself_{name}{labels(key)} {value}' for key, value in series.items()]
+            for name, series in self.gauges.items():
+                lines.append(f'# TYPE myself_{name} gauge')
+                lines += [f'myself_{name}{labels(key)} {value}' for key, value in series.items()]
+            for name, series in self.histograms.items():
+                lines.append(f'# TYPE myself_{name} histogram')
+                for key, values in series.items():
+                    for bound, count in zip(BUCKETS, values):
+                        le = f'le="{bound}"'
+                        lines.append(f'myself_{name}_bucket{labels(key, le)} {count}')
+                    le = 'le="+Inf"'
+                    lines.append(f'myself_{name}_bucket{labels(key, le)} {values[-1]}')
+                    lines.append(f'myself_{name}_sum{labels(key)} {values[-2]}')
+                    lines.append(f'myself_{name}_count{labels(key)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        # node_exporter's textfile collector may read at any time, never let it see half a file
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def trace_to(self, path: str):
+        """Append every span and the final summary to `path` as JSON lines."""
+        self._trace = open(path, 'a', encoding='utf-8')
+
+    def _write(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._trace is not None:
+                self._trace.write(line)
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """Expose /metrics on a background thread for as long as the process runs."""
+        # http.server pulls in email and html, only load it when someone asks for the endpoint
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        log.info(f'metrics on http://{host}:{self._server.server_address[1]}/metrics')
+
+    def close(self):
+        if self._trace is not None:
+            self._write({'type': 'summary', 'seconds': round(time.time() - self.started, 3), 'phases': self.summary()})
+            with self._lock:
+                self._trace.close()
+                self._trace = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+
+metrics = Metrics()
@@ -1,12 +1,27 @@
 import json
-import ssl
-import requests
-import websocket
+import logging
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from functools import reduce
-from typing import TypedDict, List, Tuple
-from bs4 import BeautifulSoup, Tag
+from typing import TYPE_CHECKING, TypedDict, List, Tuple
 from rich import print
+import segment_store
+from cache import MetadataCache
+from metrics import metrics
+from progress import progress
+from throttle import bandwidth
+
+# requests、websocket、bs4 與 lxml 用到時才載入，只看說明或不用連網的執行不必付這些 import 的時間
+if TYPE_CHECKING:
+    import requests
+    import websocket
+    from bs4 import BeautifulSoup
+
+log = logging.getLogger("rich")
 
 # http settings
 headers = {
@@ -15,6 +30,29 @@ headers = {
     'User-Agent': 'Mozilla/5.0 (X11; Linux i686; rv:125.0) Gecko/20100101 Firefox/125.0',
 }
 
+# 網站設定
+site_opt = {
+    'url': 'https://myself-bbs.com',
+    'finish_forum': 'forum-113-{page}.html',  # 完結動畫的分頁
+}
+
+# 連線池設定，可透過 session_pool.configure() 調整
+pool_opt = {
+    'pool_connections': 4,  # 保留連線的 host 數量
+    'pool_maxsize': 32,  # 每個 host 保留的 keep-alive 連線數量
+    'pool_block': False,  # 連線用完時是否等待，而不是建立暫時連線
+}
+
+# 下載設定，影片以 chunk 為單位邊下載邊寫入檔案，記憶體用量只跟 chunk_size 有關
+download_opt = {
+    'chunk_size': 256 * 1024,
+}
+
+# 網頁解析設定，'bs4' 或 'lxml'（直接用 lxml.html 與預先編譯的 XPath，較快）
+parser_opt = {
+    'backend': 'bs4',
+}
+
 # websocket 設定
 ws_opt = {
     'header': headers,
@@ -99,6 +137,38 @@ class FinishListDict(TypedDict):
     data: List[FinishListDataDict]
 
 
+class PoolStatsDict(TypedDict):
+    hosts: int
+    connections: int
+    requests: int
+    reused: int
+
+
+class HTTPStatusError(ValueError):
+    """
+    官網回應非 2xx，保留狀態碼與 Retry-After 讓呼叫端決定要不要重試或降速。
+    """
+
+    def __init__(self, status: int, retry_after: float | None = None):
+        super().__init__(f'掛了: HTTP {status}')
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self) -> bool:
+        return self.status in (429, 503)
+
+    @classmethod
+    def from_status(cls, status: int, res_headers) -> 'HTTPStatusError':
+        retry_after = None
+        if (value := res_headers.get('Retry-After')) is not None:
+            try:
+                retry_after = float(value)
+            except ValueError:
+                pass
+        return cls(status, retry_after)
+
+
 # helper functions
 def bad_name(name: str) -> str:
     """
@@ -111,13 +181,328 @@ def bad_name(name: str) -> str:
     return reduce(lambda x, y: x + y if y not in ban else x + ' ', name).strip()
 
 
+def _has_class(name: str) -> str:
+    # 同 bs4 的 class_='name'，class 中任一個等於 name
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+class _XPath:
+    """
+    第一次用到時才編譯的 etree.XPath，編譯後直接換掉類別上的這個屬性。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        from lxml import etree
+        xpath = etree.XPath(self.path)
+        setattr(owner, self.name, xpath)
+        return xpath
+
+
+class LxmlParser:
+    """
+    直接用 lxml.html 解析，輸出與 BeautifulSoup 版本相同。
+
+    XPath 都預先編譯好；class 含空白的條件跟 bs4 一樣比對整個 class 字串。
+    """
+    _parser = None
+
+    _title = _XPath('//title')
+    _info_info = _XPath(f'//div[{_has_class("info_info")}]')
+    _li = _XPath('.//li')
+    _p = _XPath('.//p')
+    _info_img = _XPath("//div[@class='info_img_box fl']//img")
+    _main_list_a = _XPath(f"//ul[{_has_class('main_list')}]//a[@href='javascript:;']")
+    _display_li = _XPath(f'.//ul[{_has_class("display_none")}]//li')
+    _first_a = _XPath('(.//a)[1]')
+    _site_a = _XPath(".//a[contains(@data-href, 'v.myself-bbs.com')][1]")
+    _tab_title = _XPath("//div[@class='tab-title title column cl']")
+    _block = _XPath(".//div[@class='block move-span']")
+    _titletext = _XPath(f'(.//span[{_has_class("titletext")}])[1]')
+    _a = _XPath('.//a')
+    _c_cl = _XPath("//div[@class='c cl']")
+    _first_img = _XPath('(.//img)[1]')
+
+    @classmethod
+    def _root(cls, text: str):
+        from lxml import html as lxml_html
+        if cls._parser is None:
+            cls._parser = lxml_html.HTMLParser(encoding='utf-8')
+        return lxml_html.fromstring(text.encode('utf-8'), parser=cls._parser)
+
+    @classmethod
+    def anime_info_video_data(cls, root) -> List[AnimeInfoVideoDataDict]:
+        data = []
+        for a in cls._main_list_a(root):
+            name = a.text_content()
+            for display in cls._display_li(a.getparent()):
+                if cls._first_a(display)[0].text_content() == '站內':
+                    video_url = cls._site_a(display)[0].get('data-href').replace(
+                        'player/play',
+                        'vpx',
+                    ).replace(
+                        '\r',
+                        '',
+                    ).replace('\n', '')
+                    data.append({
+                        'name': bad_name(name=name),
+                        'url': video_url,
+                    })
+
+        return data
+
+    @classmethod
+    def anime_info_table(cls, root) -> AnimeInfoTableDict:
+        data = {}
+        for elements in cls._info_info(root):
+            for element in cls._li(elements):
+                key, value = element.text_content().split(': ')
+                data.update({anime_table[key]: value})
+
+            for element in cls._p(elements):
+                data.update({'synopsis': element.text_content()})
+
+        for element in cls._info_img(root):
+            data.update({'image': element.get('src')})
+
+        return data
+
+    @classmethod
+    def anime_total_info(cls, url: str, text: str) -> AnimeTotalInfoTableDict:
+        data = {}
+        root = cls._root(text)
+        if title := cls._title(root):
+            data.update(cls.anime_info_table(root))
+            data.update({
+                'url': url,
+                'name': bad_name(title[0].text_content().split('【')[0]),
+                'video': cls.anime_info_video_data(root)
+            })
+
+        return data
+
+    @classmethod
+    def finish_list(cls, text: str) -> List[FinishListDict]:
+        data = []
+        for elements in cls._tab_title(cls._root(text)):
+            year_list = []
+            for element in cls._block(elements):
+                year_month_title = cls._titletext(element)[0].text_content()
+                season_list = []
+                for k in cls._a(element):
+                    season_list.append({'name': k.get('title'), 'url': f"https://myself-bbs.com/{k.get('href')}"})
+
+                year_list.append({'title': year_month_title, 'data': season_list})
+
+            data.append({'data': year_list})
+
+        return data
+
+    @classmethod
+    def finish_anime_page_data(cls, text: str) -> list[FinishAnimePageDataDict]:
+        data = []
+        for elements in cls._c_cl(cls._root(text)):
+            a = cls._first_a(elements)[0]
+            data.append({
+                'url': f"https://myself-bbs.com/{a.get('href')}",
+                'name': bad_name(a.get('title')),
+                'image': f"https://myself-bbs.com/{cls._first_img(a)[0].get('src')}"
+            })
+
+        return data
+
+
+class SessionPool:
+    """
+    共用的 requests.Session，讓所有執行緒共用 keep-alive 連線，避免每個 ts 都重新握手。
+    """
+
+    def __init__(self, **opt):
+        self._lock = threading.Lock()
+        self._opt = {**pool_opt, **opt}
+        self._session: 'requests.Session | None' = None
+
+    def _new_session(self) -> 'requests.Session':
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.headers.update(headers)
+        adapter = HTTPAdapter(**self._opt)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @property
+    def session(self) -> 'requests.Session':
+        if (session := self._session) is None:
+            with self._lock:
+                if (session := self._session) is None:
+                    session = self._session = self._new_session()
+        return session
+
+    def configure(self, **opt):
+        """
+        調整連線池大小，已存在的連線會被關閉。
+
+        :param opt: 參考 pool_opt。
+        """
+        with self._lock:
+            self._opt.update(opt)
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def stats(self) -> PoolStatsDict:
+        """
+        :return: 連線池統計，reused 為重複使用 keep-alive 連線的請求數。
+        """
+        hosts = connections = reqs = 0
+        if (session := self._session) is not None:
+            adapters = {id(a): a for a in session.adapters.values()}.values()
+            for adapter in adapters:
+                for key in list(adapter.poolmanager.pools.keys()):
+                    if (pool := adapter.poolmanager.pools.get(key)) is None:
+                        continue
+                    hosts += 1
+                    connections += pool.num_connections
+                    reqs += pool.num_requests
+        return {
+            'hosts': hosts,
+            'connections': connections,
+            'requests': reqs,
+            'reused': max(reqs - connections, 0),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+session_pool = SessionPool()
+
+
+class WebsocketPool:
+    """
+    保持連線的 websocket，讓多集的 {'tid', 'vid', 'id'} 查詢共用少數幾條連線。
+
+    每條連線同時只處理一個請求，回應一定對應到剛送出的請求。
+    連線斷掉時會重連一次，SSL 憑證問題的設定只記在這個 pool 內，不改動全域的 ws_opt。
+    """
+
+    def __init__(self, size: int = 2, **opt):
+        self.size = size
+        self.requests = 0
+        self.connects = 0
+        self._lock = threading.Lock()
+        self._opt = {**ws_opt, **opt}
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._permits = threading.BoundedSemaphore(max(size, 1))
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def configure(self, size: int, **opt):
+        """
+        :param size: 最多同時保持的連線數量，0 代表不使用連線池。
+        :param opt: 覆蓋 ws_opt 的設定。
+        """
+        self.close()
+        self.size = size
+        self._opt = {**ws_opt, **opt}
+        self._permits = threading.BoundedSemaphore(max(size, 1))
+
+    def _connect(self) -> 'websocket.WebSocket':
+        import ssl
+        import websocket
+        opt = self._opt
+        try:
+            ws = websocket.create_connection(**opt)
+        except ssl.SSLCertVerificationError:
+            if 'sslopt' in opt:
+                raise
+            # 有些人電腦會有 SSL 問題，這個 pool 之後的連線都不驗證憑證。
+            print('ssl 憑證有問題，websocket 連線池改為不驗證憑證')
+            opt = {**opt, 'sslopt': {'cert_reqs': ssl.CERT_NONE}}
+            ws = websocket.create_connection(**opt)
+            with self._lock:
+                self._opt = opt
+        with self._lock:
+            self.connects += 1
+        return ws
+
+    def request(self, payload: dict) -> str:
+        """
+        :param payload: 要送出的資料。
+        :return: 官網的回應。
+        """
+        import websocket
+        with self._permits:
+            for attempt in range(2):
+                try:
+                    ws = self._idle.get_nowait()
+                except queue.Empty:
+                    ws = self._connect()
+                try:
+                    ws.send(json.dumps(payload))
+                    recv = ws.recv()
+                except (websocket.WebSocketException, OSError):
+                    ws.close()
+                    # 閒置太久被伺服器關掉的連線，重連一次
+                    if attempt:
+                        raise
+                    continue
+                with self._lock:
+                    self.requests += 1
+                self._idle.put(ws)
+                return recv
+        raise ValueError('不知道發生什麼錯誤了!')
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+ws_pool = WebsocketPool()
+
+
 class Myself:
+    # 設定後會快取動漫頁面與集數的 m3u8 網址
+    cache: MetadataCache | None = None
+
     @staticmethod
-    def _req(url: str, timeout: tuple = (5, 5)) -> requests.Response:
+    def _req(url: str, timeout: tuple = (5, 5), extra_headers: dict | None = None, stream: bool = False) -> 'requests.Response':
+        import requests
         try:
-            return requests.get(url=url, headers=headers, timeout=timeout)
+            res = session_pool.session.get(
+                url=url,
+                headers={**headers, **extra_headers} if extra_headers else headers,
+                timeout=timeout,
+                stream=stream,
+            )
         except requests.exceptions.RequestException as error:
+            metrics.inc('http_requests_total', status='error')
             raise ValueError(f'請求有錯誤: {error}')
+        metrics.inc('http_requests_total', status=res.status_code)
+        return res
+
+    @staticmethod
+    def thread_url(thread_id: int) -> str:
+        """
+        :param thread_id: 動漫的 thread id。
+        :return: 動漫頁面網址。
+        """
+        return f"{site_opt['url']}/thread-{thread_id}-1-1.html"
 
     @classmethod
     def week_anime(cls) -> WeekAnimeDict:
@@ -137,29 +522,44 @@ class Myself:
             ...
         }
         """
-        res = cls._req(url='https://myself-bbs.com/portal.php')
-        data = {}
+        res = cls._req(url=f"{site_opt['url']}/portal.php")
         if res and res.ok:
-            html = BeautifulSoup(res.text, features='lxml')
-            if (elements := html.find('div', id='tabSuCvYn')) is Tag:
-                for index, elements in enumerate(elements.find_all('div', class_='module cl xl xl1')):
-                    animes = []
-                    for element in elements:
-                        animes.append({
-                            'name': element.find('a')['title'],
-                            'url': f"https://myself-bbs.com/{element.find('a')['href']}",
-                            'update_color': element.find('span').find('font').find('font')['style'],
-                            'update': element.find('span').find('font').text,
-                        })
+            return cls.parse_week_anime(text=res.text)
+        return {}
+
+    @staticmethod
+    def parse_week_anime(text: str) -> WeekAnimeDict:
+        """
+        解析首頁的每週更新表，格式同 week_anime。
 
-                    data.update({
-                        week[index]: animes
+        :param text: 網頁原始碼。
+        """
+        from bs4 import BeautifulSoup, Tag
+        data = {}
+        html = BeautifulSoup(text, features='lxml')
+        if isinstance(elements := html.find('div', id='tabSuCvYn'), Tag):
+            for index, elements in enumerate(elements.find_all('div', class_='module cl xl xl1')):
+                animes = []
+                for element in elements.find_all('li'):
+                    if (a := element.find('a')) is None:
+                        continue
+                    font = element.find('span').find('font') if element.find('span') else None
+                    inner = font.find('font') if font else None
+                    animes.append({
+                        'name': a['title'],
+                        'url': f"https://myself-bbs.com/{a['href']}",
+                        'update_color': inner['style'] if inner and inner.has_attr('style') else '',
+                        'update': font.text if font else '',
                     })
 
+                data.update({
+                    week[index]: animes
+                })
+
         return data
 
     @staticmethod
-    def anime_info_video_data(html: BeautifulSoup) -> List[AnimeInfoVideoDataDict]:
+    def anime_info_video_data(html: 'BeautifulSoup') -> List[AnimeInfoVideoDataDict]:
         """
         取得動漫網頁的影片 Api Url。
 
@@ -188,7 +588,7 @@ class Myself:
         return data
 
     @staticmethod
-    def anime_info_table(html: BeautifulSoup) -> AnimeInfoTableDict:
+    def anime_info_table(html: 'BeautifulSoup') -> AnimeInfoTableDict:
         """
         取得動漫資訊。
 
@@ -220,11 +620,13 @@ class Myself:
         return data
 
     @classmethod
-    def anime_total_info(cls, url: str) -> AnimeTotalInfoTableDict:
+    @metrics.timed('metadata')
+    def anime_total_info(cls, url: str, revalidate: bool = False) -> AnimeTotalInfoTableDict:
         """
         取得動漫頁面全部資訊。
 
         :param url: str -> 要爬的網址。
+        :param revalidate: 快取還沒過期也向網站確認，沒有更新時只花一個 304。
         :return: dict -> 動漫資料。
         {
             url: 網址,
@@ -240,17 +642,51 @@ class Myself:
             image: 圖片網址,
         }
         """
-        res = cls._req(url=url)
-        data = {}
+        if cls.cache is None:
+            res = cls._req(url=url)
+            if res and res.ok:
+                return cls.parse_anime_total_info(url=url, text=res.text)
+            return {}
+
+        entry = cls.cache.get('thread', url)
+        if entry is not None and entry['fresh'] and not revalidate:
+            return entry['value']
+
+        res = cls._req(url=url, extra_headers=cls.cache.conditional_headers(entry))
+        if entry is not None and res.status_code == 304:
+            cls.cache.touch('thread', url)
+            return entry['value']
         if res and res.ok:
-            html = BeautifulSoup(res.text, features='lxml')
-            if (title := html.find('title')) is not None:
-                data.update(cls.anime_info_table(html=html))
-                data.update({
-                    'url': url,
-                    'name': bad_name(title.text.split('【')[0]),
-                    'video': cls.anime_info_video_data(html=html)
-                })
+            data = cls.parse_anime_total_info(url=url, text=res.text)
+            if data:
+                cls.cache.put('thread', url, data,
+                              etag=res.headers.get('ETag'),
+                              last_modified=res.headers.get('Last-Modified'))
+            return data
+        return {}
+
+    @classmethod
+    def parse_anime_total_info(cls, url: str, text: str) -> AnimeTotalInfoTableDict:
+        """
+        解析動漫頁面，格式同 anime_total_info。
+
+        :param url: 網址。
+        :param text: 網頁原始碼。
+        :return: dict -> 動漫資料。
+        """
+        if parser_opt['backend'] == 'lxml':
+            return LxmlParser.anime_total_info(url, text)
+
+        from bs4 import BeautifulSoup
+        data = {}
+        html = BeautifulSoup(text, features='lxml')
+        if (title := html.find('title')) is not None:
+            data.update(cls.anime_info_table(html=html))
+            data.update({
+                'url': url,
+                'name': bad_name(title.text.split('【')[0]),
+                'video': cls.anime_info_video_data(html=html)
+            })
 
         return data
 
@@ -267,21 +703,35 @@ class Myself:
             ]
         }]
         """
-        res = cls._req(url='https://myself-bbs.com/portal.php?mod=topic&topicid=8')
-        data = []
+        res = cls._req(url=f"{site_opt['url']}/portal.php?mod=topic&topicid=8")
         if res and res.ok:
-            html = BeautifulSoup(res.text, features='lxml')
-            for elements in html.find_all('div', {'class': 'tab-title title column cl'}):
-                year_list = []
-                for element in elements.find_all('div', {'class': 'block move-span'}):
-                    year_month_title = element.find('span', {'class': 'titletext'}).text
-                    season_list = []
-                    for k in element.find_all('a'):
-                        season_list.append({'name': k['title'], 'url': f"https://myself-bbs.com/{k['href']}"})
+            return cls.parse_finish_list(text=res.text)
+        return []
+
+    @staticmethod
+    def parse_finish_list(text: str) -> List[FinishListDict]:
+        """
+        解析完結列表頁面，格式同 finish_list。
+
+        :param text: 網頁原始碼。
+        """
+        if parser_opt['backend'] == 'lxml':
+            return LxmlParser.finish_list(text)
+
+        from bs4 import BeautifulSoup
+        data = []
+        html = BeautifulSoup(text, features='lxml')
+        for elements in html.find_all('div', {'class': 'tab-title title column cl'}):
+            year_list = []
+            for element in elements.find_all('div', {'class': 'block move-span'}):
+                year_month_title = element.find('span', {'class': 'titletext'}).text
+                season_list = []
+                for k in element.find_all('a'):
+                    season_list.append({'name': k['title'], 'url': f"https://myself-bbs.com/{k['href']}"})
 
-                    year_list.append({'title': year_month_title, 'data': season_list})
+                year_list.append({'title': year_month_title, 'data': season_list})
 
-                data.append({'data': year_list})
+            data.append({'data': year_list})
 
         return data
 
@@ -294,19 +744,34 @@ class Myself:
         :return: [{'url': 'https://myself-bbs.com/thread-43773-1-1.html', 'name': '白色相簿2'}, {...}]。
         """
         res = cls._req(url=url)
-        data = []
         if res and res.ok:
-            html = BeautifulSoup(res.text, 'lxml')
-            for elements in html.find_all('div', class_='c cl'):
-                data.append({
-                    'url': f"https://myself-bbs.com/{elements.find('a')['href']}",
-                    'name': bad_name(elements.find('a')['title']),
-                    'image': f"https://myself-bbs.com/{elements.find('a').find('img')['src']}"
-                })
+            return cls.parse_finish_anime_page_data(text=res.text)
+        return []
+
+    @staticmethod
+    def parse_finish_anime_page_data(text: str) -> list[FinishAnimePageDataDict]:
+        """
+        解析完結動漫頁面，格式同 finish_anime_page_data。
+
+        :param text: 網頁原始碼。
+        """
+        if parser_opt['backend'] == 'lxml':
+            return LxmlParser.finish_anime_page_data(text)
+
+        from bs4 import BeautifulSoup
+        data = []
+        html = BeautifulSoup(text, 'lxml')
+        for elements in html.find_all('div', class_='c cl'):
+            data.append({
+                'url': f"https://myself-bbs.com/{elements.find('a')['href']}",
+                'name': bad_name(elements.find('a')['title']),
+                'image': f"https://myself-bbs.com/{elements.find('a').find('img')['src']}"
+            })
 
         return data
 
     @classmethod
+    @metrics.timed('playlist')
     def get_m3u8_text(cls, url: str, timeout: tuple = (10, 10)) -> str:
         """
         :param url: m3u8 的 Api Url。
@@ -316,21 +781,155 @@ class Myself:
         res = cls._req(url=url, timeout=timeout)
         if res and res.ok:
             return res.text
-        raise ValueError('掛了')
+        raise HTTPStatusError.from_status(res.status_code, res.headers)
 
     @classmethod
-    def get_content(cls, url: str, timeout: tuple = (30, 30)) -> bytes:
+    def get_content(cls, url: str, timeout: tuple = (30, 30), cached: bool = False) -> bytes:
         """
+        分 chunk 讀取後回傳整段內容，給需要整個片段的串流模式、金鑰與初始化區段用，寫檔請用 download_to。
+
         :param url: 影片或圖片的 Url。
         :param timeout: 請求與讀取時間。
+        :param cached: 影片片段設 True，有 segment_store.store 時先從裡面拿，下載後也存進去。
         :return: 影片或圖片的格式。
         """
-        res = cls._req(url=url, timeout=timeout)
-        if res and res.ok:
-            return res.content
-        raise ValueError('掛了')
+        import requests
+        store = segment_store.store if cached else None
+        if store is not None:
+            # 同一個網址可能換成別的內容，有快取時先比對來源現在的大小
+            length = cls.content_length(url) if store.cached(url) else None
+            if (content := store.read(url, length=length)) is not None:
+                return content
+        res = cls._req(url=url, timeout=timeout, stream=True)
+        with closing(res):
+            if not res.ok:
+                raise HTTPStatusError.from_status(res.status_code, res.headers)
+            expected = cls._expected_length(res)
+            # 跟 download_to 一樣一個 chunk 一個 chunk 讀，限速與進度跟著每個 chunk 走
+            chunks = []
+            try:
+                for chunk in res.iter_content(chunk_size=download_opt['chunk_size']):
+                    bandwidth.consume(len(chunk))
+                    progress.advance(len(chunk))
+                    chunks.append(chunk)
+            except requests.exceptions.RequestException as error:
+                raise ValueError(f'請求有錯誤: {error}')
+
+        content = b''.join(chunks)
+        if expected is not None and len(content) != expected:
+            raise ValueError(f'下載不完整: {url} 收到 {len(content)} / {expected} bytes')
+        if store is not None:
+            store.add_bytes(url, content)
+        return content
+
+    @staticmethod
+    def _expected_length(res: 'requests.Response') -> int | None:
+        # 有壓縮時 Content-Length 是壓縮後的大小，無法拿來比對
+        if 'Content-Length' in res.headers and 'Content-Encoding' not in res.headers:
+            return int(res.headers['Content-Length'])
+        return None
+
+    @classmethod
+    def content_length(cls, url: str, timeout: tuple = (10, 10)) -> int | None:
+        """
+        用 HEAD 問來源現在的大小，片段快取拿來確認同一個網址的片段沒有被換掉。
+
+        :param url: 影片片段的 Url。
+        :param timeout: 請求與讀取時間。
+        :return: 位元組數，請求失敗或來源沒給時為 None，此時照快取的內容用。
+        """
+        import requests
+        try:
+            res = session_pool.session.head(url=url, headers=headers, timeout=timeout, allow_redirects=True)
+        except requests.exceptions.RequestException as error:
+            log.debug(f'HEAD {url} 失敗: {error}')
+            return None
+        with closing(res):
+            return cls._expected_length(res) if res.ok else None
+
+    @staticmethod
+    def open_segment(path: str, append: bool, sha256=None):
+        """
+        開啟要寫入的片段檔案。path 可能是片段快取 blob 的硬連結，直接寫入會改到快取，
+        所以重新下載時先刪掉舊檔，續傳時先複製成獨立的檔案。
+
+        :param path: 要寫入的檔案。
+        :param append: 是否接在已有的內容後面。
+        :param sha256: hashlib 的 sha256，續傳時會先算進已有的內容。
+        :return: 以二進位模式開啟的檔案。
+        """
+        if not append:
+            if os.path.lexists(path):
+                os.remove(path)
+            return open(path, 'wb')
+        if os.stat(path).st_nlink > 1:
+            tmp = f'{path}.{threading.get_ident()}.tmp'
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, path)
+        f = open(path, 'a+b')
+        if sha256 is not None:
+            f.seek(0)
+            while block := f.read(1024 * 1024):
+                sha256.update(block)
+        return f
 
     @classmethod
+    def download_to(cls, url: str, path: str, start: int = 0, timeout: tuple = (30, 30),
+                    chunk_size: int | None = None, decryptor=None, header: bytes = b'', sha256=None) -> int:
+        """
+        邊下載邊寫入檔案，記憶體只需要一個 chunk。
+
+        :param url: 影片的 Url。
+        :param path: 要寫入的檔案。
+        :param start: 已下載的位元組數，大於 0 時用 HTTP Range 接續，伺服器不支援時重新下載。
+        :param timeout: 請求與讀取時間。
+        :param chunk_size: 每次讀取的位元組數，預設為 download_opt['chunk_size']。
+        :param decryptor: 有 update 與 finalize 的解密器，每個 chunk 寫入前先解密，此時 start 必須為 0。
+        :param header: 寫在檔案開頭的位元組，例如 EXT-X-MAP 的初始化區段。
+        :param sha256: hashlib 的 sha256，邊寫邊算整個檔案的雜湊，存進片段快取時不必再讀一次。
+        :return: 這次收到的位元組數。
+        """
+        import requests
+        extra_headers = {'Range': f'bytes={start}-'} if start > 0 else None
+        res = cls._req(url=url, timeout=timeout, extra_headers=extra_headers, stream=True)
+        with closing(res):
+            if res.status_code == 416:
+                # 檔案已經完整
+                if sha256 is not None:
+                    cls.open_segment(path, append=True, sha256=sha256).close()
+                return 0
+            if not res.ok:
+                raise HTTPStatusError.from_status(res.status_code, res.headers)
+
+            expected = cls._expected_length(res)
+
+            written = 0
+            try:
+                with cls.open_segment(path, append=res.status_code == 206, sha256=sha256) as f:
+                    def write(data: bytes):
+                        f.write(data)
+                        if sha256 is not None:
+                            sha256.update(data)
+
+                    if header and res.status_code != 206:
+                        write(header)
+                    for chunk in res.iter_content(chunk_size=chunk_size or download_opt['chunk_size']):
+                        # 全域限速，等待時不讀取，伺服器端會跟著慢下來
+                        bandwidth.consume(len(chunk))
+                        progress.advance(len(chunk))
+                        write(chunk if decryptor is None else decryptor.update(chunk))
+                        written += len(chunk)
+                    if decryptor is not None:
+                        write(decryptor.finalize())
+            except requests.exceptions.RequestException as error:
+                raise ValueError(f'請求有錯誤: {error}')
+
+        if expected is not None and written != expected:
+            raise ValueError(f'下載不完整: {url} 收到 {written} / {expected} bytes')
+        return written
+
+    @classmethod
+    @metrics.timed('resolve')
     def ws_get_host_and_m3u8_url(
             cls,
             tid: str,
@@ -345,45 +944,94 @@ class Myself:
         :param video_id:
         :return: Host, M3U8 的 URL。
         """
-        try:
-            with closing(websocket.create_connection(**ws_opt)) as ws:
-                ws.send(json.dumps({'tid': tid, 'vid': vid, 'id': video_id}))
-                recv = ws.recv()
-                res = json.loads(recv)
-                m3u8_url = f'https:{res["video"]}'
-                if video_id:
-                    video_url = m3u8_url.split('/index.m3u8')[0]
-                else:
-                    video_url = m3u8_url[:m3u8_url.rfind('/')]
-                return video_url, m3u8_url
-        except ssl.SSLCertVerificationError:
-            print(f'ssl 憑證有問題: ws_opt: {ws_opt}')
+        import ssl
+        import websocket
+        if ws_pool.enabled:
+            try:
+                recv = ws_pool.request({'tid': tid, 'vid': vid, 'id': video_id})
+                return cls.parse_ws_response(recv, video_id=video_id)
+            except Exception as e:
+                log.debug(f'websocket 連線池失敗，改用單次連線: {e}')
 
-            if 'sslopt' in ws_opt:
-                raise ValueError('不知道發生什麼錯誤了!')
+        opt = ws_opt
+        for attempt in range(2):
+            try:
+                with closing(websocket.create_connection(**opt)) as ws:
+                    ws.send(json.dumps({'tid': tid, 'vid': vid, 'id': video_id}))
+                    recv = ws.recv()
+                    return cls.parse_ws_response(recv, video_id=video_id)
+            except ssl.SSLCertVerificationError:
+                print(f'ssl 憑證有問題: ws_opt: {opt}')
 
-            # 有些人電腦會有 SSL 問題，加入 sslopt 設定並重新請求一次。
-            ws_opt['sslopt'] = {'cert_reqs': ssl.CERT_NONE}
-            return cls.ws_get_host_and_m3u8_url(
-                tid=tid,
-                vid=vid,
-                video_id=video_id,
-            )
-        except Exception as e:
-            raise ValueError(f'websocket 其餘未捕抓問題: {e}')
+                if 'sslopt' in opt:
+                    raise ValueError('不知道發生什麼錯誤了!')
 
-    @classmethod
-    def parse_episode_url(cls, url: str):
+                # 有些人電腦會有 SSL 問題，只在這次請求加入 sslopt 設定並重新請求一次，不改動全域的 ws_opt。
+                opt = {**ws_opt, 'sslopt': {'cert_reqs': ssl.CERT_NONE}}
+            except Exception as e:
+                raise ValueError(f'websocket 其餘未捕抓問題: {e}')
+        raise ValueError('不知道發生什麼錯誤了!')
+
+    @staticmethod
+    def parse_ws_response(recv: str, video_id: str) -> Tuple[str, str]:
+        """
+        :param recv: Websocket 回應。
+        :param video_id:
+        :return: Host, M3U8 的 URL。
+        """
+        res = json.loads(recv)
+        # 官網回傳 //host/... 這種沒有 scheme 的網址，跟著 websocket 是否加密
+        scheme = 'http' if ws_opt['url'].startswith('ws://') else 'https'
+        m3u8_url = f'{scheme}:{res["video"]}'
+        if video_id:
+            video_url = m3u8_url.split('/index.m3u8')[0]
+        else:
+            video_url = m3u8_url[:m3u8_url.rfind('/')]
+        return video_url, m3u8_url
+
+    @staticmethod
+    def split_episode_url(url: str) -> Tuple[str, str, str]:
+        """
+        :param url: 集數的 Api Url。
+        :return: tid, vid, video_id。
+        """
         s = url.split('/')
 
         # 將需要的資料拆解，url 拆解有兩種模式。
         if s[-1].isdigit():
-            tid, vid, video_id = s[-2], s[-1], ''
-        else:
-            tid, vid, video_id = '', '', s[-1]
+            return s[-2], s[-1], ''
+        return '', '', s[-1]
+
+    @classmethod
+    def parse_episode_urls(cls, urls: List[str]) -> List[Tuple[str, str] | None]:
+        """
+        一次查詢多集，共用 websocket 連線池。
+
+        :param urls: 集數的 Api Url。
+        :return: 每集的 (Host, M3U8 的 URL)，查詢失敗的為 None。
+        """
+        def resolve(url: str) -> Tuple[str, str] | None:
+            try:
+                return cls.parse_episode_url(url)
+            except ValueError as e:
+                log.warning(f'{url} 查詢失敗: {e}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(ws_pool.size, 1)) as executor:
+            return list(executor.map(resolve, urls))
+
+    @classmethod
+    def parse_episode_url(cls, url: str):
+        if cls.cache is not None and (cached := cls.cache.get_fresh('episode', url)) is not None:
+            return tuple(cached)
+
+        tid, vid, video_id = cls.split_episode_url(url)
 
-        return cls.ws_get_host_and_m3u8_url(
+        result = cls.ws_get_host_and_m3u8_url(
             tid=tid,
             vid=vid,
             video_id=video_id,
         )
+        if cls.cache is not None:
+            cls.cache.put('episode', url, result)
+        return result
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import aiohttp
+from typing import Tuple
+from metrics import metrics
+from progress import progress
+from throttle import bandwidth
+from myself import Myself, AnimeTotalInfoTableDict, HTTPStatusError, download_opt, headers, ws_opt
+
+log = logging.getLogger("rich")
+
+
+class AsyncMyself:
+    """
+    Myself 的 asyncio 版本，所有請求共用同一個 aiohttp.ClientSession。
+
+    async with AsyncMyself(limit=32) as client:
+        video_url, m3u8_url = await client.parse_episode_url(url)
+    """
+
+    def __init__(self, limit: int = 32, chunk_size: int | None = None):
+        self.limit = limit
+        self.chunk_size = chunk_size or download_opt['chunk_size']
+        self._session: aiohttp.ClientSession | None = None
+        # 有些人電腦會有 SSL 問題，只在這個 client 內關閉驗證，不動全域的 ws_opt
+        self._ws_ssl: bool = 'sslopt' not in ws_opt
+
+    async def __aenter__(self) -> 'AsyncMyself':
+        self._session = aiohttp.ClientSession(
+            headers=headers,
+            connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit),
+            trace_configs=[_request_metrics()],
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise ValueError('AsyncMyself 必須在 async with 內使用')
+        return self._session
+
+    async def _get_text(self, url: str, timeout: tuple = (5, 5)) -> str:
+        text, _ = await self._get_text_conditional(url=url, timeout=timeout)
+        assert text is not None
+        return text
+
+    async def _get_text_conditional(self,
+                                    url: str,
+                                    timeout: tuple = (5, 5),
+                                    req_headers: dict | None = None) -> Tuple[str | None, dict]:
+        """
+        :return: (網頁原始碼, 回應 headers)，304 時原始碼為 None。
+        """
+        try:
+            async with self.session.get(url, headers=req_headers, timeout=_timeout(timeout)) as res:
+                if res.status == 304:
+                    return None, dict(res.headers)
+                if res.ok:
+                    return await res.text(), dict(res.headers)
+                raise HTTPStatusError.from_status(res.status, res.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise ValueError(f'請求有錯誤: {error}')
+
+    @metrics.timed('metadata')
+    async def anime_total_info(self, url: str) -> AnimeTotalInfoTableDict:
+        """
+        同 Myself.anime_total_info，有設定 Myself.cache 時一樣會快取。
+        """
+        cache = Myself.cache
+        if cache is None:
+            return Myself.parse_anime_total_info(url=url, text=await self._get_text(url=url))
+
+        entry = cache.get('thread', url)
+        if entry is not None and entry['fresh']:
+            return entry['value']
+
+        text, res_headers = await self._get_text_conditional(url=url, req_headers=cache.conditional_headers(entry))
+        if text is None and entry is not None:
+            cache.touch('thread', url)
+            return entry['value']
+        data = Myself.parse_anime_total_info(url=url, text=text or '')
+        if data:
+            cache.put('thread', url, data,
+                      etag=res_headers.get('ETag'),
+                      last_modified=res_headers.get('Last-Modified'))
+        return data
+
+    @metrics.timed('playlist')
+    async def get_m3u8_text(self, url: str, timeout: tuple = (10, 10)) -> str:
+        """
+        :param url: m3u8 的 Api Url。
+        :param timeout: 請求與讀取時間。
+        :return: 官網回應 m3u8 格式。
+        """
+        return await self._get_text(url=url, timeout=timeout)
+
+    async def content_length(self, url: str, timeout: tuple = (10, 10)) -> int | None:
+        """
+        同 Myself.content_length，用 HEAD 問來源現在的大小。
+
+        :param url: 影片片段的 Url。
+        :param timeout: 請求與讀取時間。
+        :return: 位元組數，請求失敗或來源沒給時為 None。
+        """
+        try:
+            async with self.session.head(url, timeout=_timeout(timeout), allow_redirects=True) as res:
+                if not res.ok or 'Content-Encoding' in res.headers:
+                    return None
+                return res.content_length
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            log.debug(f'HEAD {url} 失敗: {error}')
+            return None
+
+    async def get_content(self, url: str, timeout: tuple = (30, 30)) -> bytes:
+        """
+        :param url: 影片或圖片的 Url。
+        :param timeout: 請求與讀取時間。
+        :return: 影片或圖片的格式。
+        """
+        try:
+            async with self.session.get(url, timeout=_timeout(timeout)) as res:
+                if res.ok:
+                    content = await res.read()
+                    await bandwidth.consume_async(len(content))
+                    progress.advance(len(content))
+                    return content
+                raise HTTPStatusError.from_status(res.status, res.headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise ValueError(f'請求有錯誤: {error}')
+
+    async def download_to(self, url: str, path: str, start: int = 0, timeout: tuple = (30, 30),
+                          decryptor=None, header: bytes = b'', sha256=None) -> int:
+        """
+        邊下載邊寫入檔案，記憶體只需要一個 chunk。
+
+        :param url: 影片的 Url。
+        :param path: 要寫入的檔案。
+        :param start: 已下載的位元組數，大於 0 時用 HTTP Range 接續。
+        :param timeout: 請求與讀取時間。
+        :param decryptor: 有 update 與 finalize 的解密器，每個 chunk 寫入前先解密，此時 start 必須為 0。
+        :param header: 寫在檔案開頭的位元組，例如 EXT-X-MAP 的初始化區段。
+        :param sha256: hashlib 的 sha256，邊寫邊算整個檔案的雜湊。
+        :return: 這次收到的位元組數。
+        """
+        req_headers = {'Range': f'bytes={start}-'} if start > 0 else None
+        written = 0
+        try:
+            async with self.session.get(url, headers=req_headers, timeout=_timeout(timeout)) as res:
+                if res.status == 416:
+                    # 檔案已經完整
+                    if sha256 is not None:
+                        f = await asyncio.to_thread(Myself.open_segment, path, True, sha256)
+                        await asyncio.to_thread(f.close)
+                    return 0
+                if not res.ok:
+                    raise HTTPStatusError.from_status(res.status, res.headers)
+                # 有壓縮時 Content-Length 是壓縮後的大小，無法拿來比對
+                expected = res.content_length if 'Content-Encoding' not in res.headers else None
+                # 開檔與寫入都丟到執行緒，磁碟慢時不會卡住 event loop 上其他的傳輸
+                # 片段快取的硬連結不會被寫穿，見 Myself.open_segment
+                f = await asyncio.to_thread(Myself.open_segment, path, res.status == 206, sha256)
+
+                def write(data: bytes, decrypt: bool = True):
+                    # 解密、雜湊與寫入都在執行緒裡做，AES 不會佔住 event loop
+                    if decrypt and decryptor is not None:
+                        data = decryptor.update(data)
+                    f.write(data)
+                    if sha256 is not None:
+                        sha256.update(data)
+
+                def finish():
+                    write(decryptor.finalize(), decrypt=False)
+
+                try:
+                    if header and res.status != 206:
+                        await asyncio.to_thread(write, header, False)
+                    async for chunk in res.content.iter_chunked(self.chunk_size):
+                        await bandwidth.consume_async(len(chunk))
+                        progress.advance(len(chunk))
+                        await asyncio.to_thread(write, chunk)
+                        written += len(chunk)
+                    if decryptor is not None:
+                        await asyncio.to_thread(finish)
+                finally:
+                    await asyncio.to_thread(f.close)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            raise ValueError(f'請求有錯誤: {error}')
+        if expected is not None and written != expected:
+            raise ValueError(f'下載不完整: {url} 收到 {written} / {expected} bytes')
+        return written
+
+    @metrics.timed('resolve')
+    async def ws_get_host_and_m3u8_url(self, tid: str, vid: str, video_id: str) -> Tuple[str, str]:
+        """
+        Websocket 取得 Host 和 M3U8 資料。
+
+        :return: Host, M3U8 的 URL。
+        """
+        try:
+            async with self.session.ws_connect(ws_opt['url'], ssl=None if self._ws_ssl else False) as ws:
+                await ws.send_json({'tid': tid, 'vid': vid, 'id': video_id})
+                recv = await ws.receive_str()
+                return Myself.parse_ws_response(recv, video_id=video_id)
+        except aiohttp.ClientConnectorCertificateError:
+            if not self._ws_ssl:
+                raise ValueError('不知道發生什麼錯誤了!')
+            print('ssl 憑證有問題，關閉驗證後重試')
+            self._ws_ssl = False
+            return await self.ws_get_host_and_m3u8_url(tid=tid, vid=vid, video_id=video_id)
+        except Exception as e:
+            raise ValueError(f'websocket 其餘未捕抓問題: {e}')
+
+    async def parse_episode_url(self, url: str) -> Tuple[str, str]:
+        if Myself.cache is not None and (cached := Myself.cache.get_fresh('episode', url)) is not None:
+            return tuple(cached)
+
+        tid, vid, video_id = Myself.split_episode_url(url)
+        result = await self.ws_get_host_and_m3u8_url(tid=tid, vid=vid, video_id=video_id)
+        if Myself.cache is not None:
+            Myself.cache.put('episode', url, result)
+        return result
+
+
+def _timeout(timeout: tuple) -> aiohttp.ClientTimeout:
+    connect, read = timeout
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+
+def _request_metrics() -> aiohttp.TraceConfig:
+    """與 Myself._req 一樣，依狀態碼計算請求數。"""
+    async def on_request_end(session, context, params):
+        metrics.inc('http_requests_total', status=params.response.status)
+
+    async def on_request_exception(session, context, params):
+        metrics.inc('http_requests_total', status='error')
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
@@ -0,0 +1,156 @@
+import errno
+import logging
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import Future
+from typing import Hashable, NamedTuple
+import library
+from merge import concat_ts_dir
+from metrics import metrics
+
+log = logging.getLogger("rich")
+
+
+class MergeJob(NamedTuple):
+    ts_dir: str
+    merged_mp4: str
+    download_dir: str
+    name: str
+    thread_id: int | None = None
+    episode_url: str | None = None
+    # segment files in playlist order, empty falls back to every *.ts by name
+    segments: tuple[str, ...] = ()
+
+
+def publish(src: str, dest: str) -> int:
+    """
+    Move src to dest so that dest is either absent or complete, never half
+    written. A rename is used when both are on one filesystem, otherwise the
+    file is copied to a hidden temp name next to dest, flushed and renamed.
+
+    :return: bytes published.
+    """
+    size = os.path.getsize(src)
+    dest_dir = os.path.dirname(dest) or '.'
+    os.makedirs(dest_dir, exist_ok=True)
+    try:
+        os.replace(src, dest)
+        return size
+    except OSError as e:
+        # the destination is another mount (the NAS), fall back to copying
+        if e.errno != errno.EXDEV:
+            raise
+
+    tmp = os.path.join(dest_dir, f'.{os.path.basename(dest)}.part')
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.remove(src)
+    return size
+
+
+class PostProcessor:
+    """
+    Remux and publish stages that run behind the downloads.
+
+    A download worker hands its finished ts/ directory over with `submit` and
+    goes on with the next episode while ffmpeg and the copy to the
+    destination run on their own workers. The queues in front of each stage
+    are bounded, so when remuxing or the NAS falls behind `submit` blocks and
+    downloads stop piling up finished episodes in ts/.
+    """
+
+    def __init__(self, remux_workers: int = 1, publish_workers: int = 1, queue_size: int = 2):
+        self.futures: dict[Hashable, Future] = {}
+        self._remux: queue.Queue[tuple[MergeJob, Future] | None] = queue.Queue(maxsize=queue_size)
+        self._publish: queue.Queue[tuple[MergeJob, Future] | None] = queue.Queue(maxsize=queue_size)
+        self._remux_threads = [threading.Thread(target=self._remux_worker, name=f'remux-{i}', daemon=True)
+                               for i in range(max(remux_workers, 1))]
+        self._publish_threads = [threading.Thread(target=self._publish_worker, name=f'publish-{i}', daemon=True)
+                                 for i in range(max(publish_workers, 1))]
+        for thread in self._remux_threads + self._publish_threads:
+            thread.start()
+
+    def submit(self, key: Hashable, job: MergeJob) -> Future:
+        """Queue a downloaded episode, blocks while the remux queue is full."""
+        future: Future = Future()
+        self.futures[key] = future
+        metrics.gauge('stage_queued', 1, stage='remux')
+        self._remux.put((job, future))
+        return future
+
+    def _remux_worker(self):
+        while (item := self._remux.get()) is not None:
+            job, future = item
+            metrics.gauge('stage_queued', -1, stage='remux')
+            try:
+                log.info(f'{job.name} Merging ts files...')
+                with metrics.span('merge'):
+                    concat_ts_dir(job.ts_dir, job.merged_mp4, list(job.segments) or None)
+            except BaseException as e:
+                # ts/ stays for the next run
+                future.set_exception(e)
+                continue
+            metrics.gauge('stage_queued', 1, stage='publish')
+            self._publish.put((job, future))
+
+    def _publish_worker(self):
+        while (item := self._publish.get()) is not None:
+            job, future = item
+            metrics.gauge('stage_queued', -1, stage='publish')
+            try:
+                future.set_result(publish_episode(job))
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+            log.info(f'{job.name} published!')
+
+    def close(self):
+        """Wait until every submitted episode is published or failed."""
+        for _ in self._remux_threads:
+            self._remux.put(None)
+        for thread in self._remux_threads:
+            thread.join()
+        for _ in self._publish_threads:
+            self._publish.put(None)
+        for thread in self._publish_threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def publish_episode(job: MergeJob) -> str:
+    """Publish a merged episode, record it in the library and prune its ts/."""
+    log.info(f'{job.name} moving file to destination...')
+    dest = os.path.join(job.download_dir, job.merged_mp4)
+    with metrics.span('move') as span:
+        span.bytes = publish(os.path.join(job.ts_dir, job.merged_mp4), dest)
+    if library.index is not None and job.thread_id is not None:
+        library.index.record(job.thread_id, job.episode_url, dest)
+
+    log.info(f'{job.name} Pruning ts files...')
+    shutil.rmtree(job.ts_dir)
+    return dest
+
+
+def merge_episode(ts_dir: str, merged_mp4: str, download_dir: str, name: str, 
+                  thread_id: int | None = None, episode_url: str | None = None, segments: list[str] | None = None):
+    """Merge and publish an episode in the calling thread, without the stages."""
+    log.info(f'{name} Merging ts files...')
+    with metrics.span('merge'):
+        concat_ts_dir(ts_dir, merged_mp4, segments)
+    publish_episode(MergeJob(ts_dir, merged_mp4, download_dir, name, thread_id, episode_url, tuple(segments or ())))
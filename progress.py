@@ -0,0 +1,376 @@
+import contextvars
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator, NamedTuple
+
+if TYPE_CHECKING:
+    from rich.progress import Progress, TaskID
+
+log = logging.getLogger("rich")
+
+PROGRESS_MODES = ('auto', 'bar', 'log', 'off')
+
+# seconds of traffic the shown throughput is averaged over
+RATE_WINDOW = 10.0
+
+
+def format_duration(seconds: float | None) -> str:
+    """3725.0 -> '1h02m', None -> '-'."""
+    if seconds is None:
+        return '-'
+    seconds = int(seconds + 0.5)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class RateWindow:
+    """Throughput of a growing byte count over the last `window` seconds."""
+
+    def __init__(self, window: float = RATE_WINDOW):
+        self.window = window
+        self._samples: deque[tuple[float, int]] = deque()
+
+    def update(self, now: float, total: int) -> float:
+        self._samples.append((now, total))
+        # keep one sample older than the window so the rate always spans all of it
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+        then, before = self._samples[0]
+        return (total - before) / (now - then) if now > then else 0.0
+
+
+class ProgressStats(NamedTuple):
+    """What is drawn for one episode, or for the whole run with episodes as `done` and `total`."""
+    name: str
+    received: int
+    done: int
+    total: int
+    fraction: float
+    rate: float
+    remaining: float | None
+    eta: float | None
+
+
+class EpisodeProgress:
+    """
+    Counters of one episode in flight.
+
+    Every thread that reports gets a slot of its own and is the only one
+    writing to it, so the per-chunk path takes no lock and workers never wait on each
+    other or on the renderer, which sums the slots when it draws.
+    """
+
+    def __init__(self, name: str, segments: int):
+        self.name = name
+        self.segments = segments
+        self.rate = RateWindow()
+        # thread ident -> [bytes received, bytes of finished segments, segments downloaded, segments skipped]
+        self._slots: dict[int, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def _slot(self) -> list[int]:
+        ident = threading.get_ident()
+        if (slot := self._slots.get(ident)) is None:
+            with self._lock:
+                slot = self._slots.setdefault(ident, [0, 0, 0, 0])
+        return slot
+
+    def add_bytes(self, nbytes: int):
+        # negative when a failed attempt takes its bytes back
+        self._slot()[0] += nbytes
+
+    def segment_done(self, nbytes: int = 0):
+        """A segment is finished, `nbytes` were downloaded for it, 0 when it was on disk or in the segment store."""
+        slot = self._slot()
+        if nbytes > 0:
+            slot[1] += nbytes
+            slot[2] += 1
+        else:
+            slot[3] += 1
+
+    def totals(self) -> tuple[int, int, int, int]:
+        with self._lock:
+            slots = list(self._slots.values())
+        return tuple(map(sum, zip(*slots))) if slots else (0, 0, 0, 0)
+
+    def estimate(self) -> tuple[int, int, float, float | None, float | None]:
+        """
+        Bytes received, segments done, fraction done, bytes still to come and
+        the expected size of the episode. The last two are None until a
+        segment has been downloaded, then every missing segment is taken to
+        be as large as the downloaded ones were on average, less what already
+        arrived of the segments in flight.
+        """
+        received, finished, downloaded, skipped = self.totals()
+        done = downloaded + skipped
+        if not downloaded:
+            return received, done, done / self.segments if self.segments else 1.0, None, None
+        size = finished / downloaded * self.segments
+        remaining = max((self.segments - done) * finished / downloaded - max(received - finished, 0), 0.0)
+        return received, done, 1.0 - remaining / size if size else 1.0, remaining, size
+
+    def stats(self, now: float) -> ProgressStats:
+        # only the renderer calls this, it owns the rate window
+        received, done, fraction, remaining, _ = self.estimate()
+        rate = self.rate.update(now, received)
+        return ProgressStats(self.name, received, done, self.segments, fraction, rate, remaining,
+                             _eta(remaining, rate))
+
+
+def _eta(remaining: float | None, rate: float) -> float | None:
+    if remaining is None:
+        return None
+    if remaining <= 0:
+        return 0.0
+    return remaining / rate if rate > 0 else None
+
+
+class _Tracked:
+    """The episode a block counts for and how much it counted so far."""
+    __slots__ = ('episode', 'nbytes')
+
+    def __init__(self, episode: EpisodeProgress):
+        self.episode = episode
+        self.nbytes = 0
+
+
+class ProgressTracker:
+    """
+    Byte accurate progress of every episode in flight and of the whole run.
+
+    The fetch layer reports each chunk with `advance`, which counts it for
+    the episode that `track` set for the current thread or asyncio task.
+    One renderer thread samples the counters every `refresh` seconds, so the
+    screen is redrawn at a fixed rate however many chunks arrive. It shows
+    the throughput over the last RATE_WINDOW seconds and an ETA from the
+    bytes still to come, per episode and for the run, where episodes that
+    have not started are taken to be as large as the ones seen so far.
+
+    'bar' draws one row per episode below a total row, 'log' prints a
+    summary line every `interval` seconds for cron and other logs, 'off'
+    only keeps counting.
+    """
+
+    def __init__(self):
+        self.mode = 'off'
+        self.interval = 60.0
+        self.refresh = 0.25
+        self._current: contextvars.ContextVar[_Tracked | None] = \
+            contextvars.ContextVar('progress_episode', default=None)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._runs = 0
+        self._reset()
+
+    def _reset(self):
+        self._active: list[EpisodeProgress] = []
+        self._expected = 0
+        self._started = 0
+        self._finished = 0
+        self._failed = 0
+        self._finished_bytes = 0
+        self._sizes: list[float] = []
+
+    def configure(self, mode: str = 'auto', interval: float = 60.0, refresh: float = 0.25):
+        """
+        :param mode: one of PROGRESS_MODES, auto draws bars on a terminal and logs otherwise.
+        :param interval: seconds between summary lines in log mode.
+        :param refresh: seconds between redraws of the bars.
+        """
+        if mode == 'auto':
+            mode = 'bar' if sys.stdout.isatty() else 'log'
+        self.mode = mode
+        self.interval = interval
+        self.refresh = refresh
+
+    def advance(self, nbytes: int):
+        """`nbytes` just arrived for the episode tracked by this thread or task."""
+        if (tracked := self._current.get()) is not None:
+            tracked.episode.add_bytes(nbytes)
+            tracked.nbytes += nbytes
+
+    @contextmanager
+    def track(self, episode: EpisodeProgress | None) -> Iterator[None]:
+        """
+        Count what the fetch layer receives in this block for `episode`.
+        When the block raises its bytes are taken back, a failed attempt is
+        fetched again and would otherwise be counted twice.
+        """
+        tracked = _Tracked(episode) if episode is not None else None
+        token = self._current.set(tracked)
+        try:
+            yield
+        except BaseException:
+            if tracked is not None and tracked.nbytes:
+                tracked.episode.add_bytes(-tracked.nbytes)
+            raise
+        finally:
+            self._current.reset(token)
+
+    def attempt(self):
+        """track for the episode this thread or task already counts for, around one try of a segment."""
+        tracked = self._current.get()
+        return self.track(tracked.episode if tracked is not None else None)
+
+    @contextmanager
+    def episode(self, name: str, segments: int) -> Iterator[EpisodeProgress]:
+        """Show an episode of `segments` segments while the block downloads it."""
+        episode = EpisodeProgress(name, segments)
+        with self._lock:
+            self._active.append(episode)
+            self._started += 1
+        ok = False
+        try:
+            yield episode
+            ok = True
+        finally:
+            received, _, _, _, size = episode.estimate()
+            with self._lock:
+                self._active.remove(episode)
+                self._finished += 1
+                self._failed += not ok
+                self._finished_bytes += received
+                if size is not None:
+                    self._sizes.append(size)
+
+    def expect(self, episodes: int):
+        """`episodes` more are about to be downloaded, they count towards the total and its ETA."""
+        with self._lock:
+            self._expected += episodes
+
+    @contextmanager
+    def run(self, episodes: int = 0) -> Iterator[None]:
+        """Render while the block runs, nested runs share the renderer of the outermost one."""
+        with self._lock:
+            self._runs += 1
+            self._expected += episodes
+            start = self._runs == 1 and self.mode != 'off'
+        if start:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._render, name='progress', daemon=True)
+            self._thread.start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._runs -= 1
+                last = self._runs == 0
+            if last:
+                if self._thread is not None:
+                    self._stop.set()
+                    self._thread.join()
+                    self._thread = None
+                with self._lock:
+                    self._reset()
+
+    def snapshot(self, rate: RateWindow, now: float) -> tuple[ProgressStats, list[tuple[EpisodeProgress, ProgressStats]]]:
+        with self._lock:
+            active = list(self._active)
+            finished_bytes = self._finished_bytes
+            sizes = list(self._sizes)
+            expected = max(self._expected, self._started)
+            started, finished = self._started, self._finished
+        episodes = [(episode, episode.stats(now)) for episode in active]
+
+        received = finished_bytes + sum(stats.received for _, stats in episodes)
+        sizes += [size for episode in active if (size := episode.estimate()[4]) is not None]
+        average = sum(sizes) / len(sizes) if sizes else None
+        remaining: float | None = 0.0
+        for _, stats in episodes:
+            if stats.remaining is not None:
+                remaining += stats.remaining
+            elif average is not None:
+                remaining += average * (1.0 - stats.fraction)
+            else:
+                remaining = None
+                break
+        if remaining is not None and expected > started:
+            remaining = remaining + average * (expected - started) if average is not None else None
+        # episodes in flight count with how far they got
+        fraction = (finished + sum(stats.fraction for _, stats in episodes)) / expected if expected else 1.0
+        total_rate = rate.update(now, received)
+        total = ProgressStats('total', received, finished, expected, min(fraction, 1.0), total_rate, remaining,
+                              _eta(remaining, total_rate))
+        return total, episodes
+
+    @staticmethod
+    def _describe(stats: ProgressStats, unit: str) -> str:
+        return (f'{stats.done}/{stats.total} {unit}, {stats.received / 1e6:.1f} MB, '
+                f'{stats.rate / 1e6:.2f} MB/s, ETA {format_duration(stats.eta)}')
+
+    def _render(self):
+        rate = RateWindow()
+        started = last_line = time.monotonic()
+        bars = self._open_bars() if self.mode == 'bar' else None
+        ids: dict[EpisodeProgress | None, 'TaskID'] = {}
+        lines = -1
+        try:
+            while not self._stop.wait(self.refresh):
+                now = time.monotonic()
+                total, episodes = self.snapshot(rate, now)
+                if bars is not None:
+                    self._draw(bars, ids, total, episodes)
+                elif now - last_line >= self.interval and (episodes or total.done != lines):
+                    # a watch waiting for the next airing day stays quiet
+                    self._print_line(total, episodes)
+                    last_line, lines = now, total.done
+        except Exception as e:
+            log.error(f'progress display stopped: {e}')
+        finally:
+            now = time.monotonic()
+            total, episodes = self.snapshot(rate, now)
+            if bars is not None:
+                self._draw(bars, ids, total, episodes)
+                bars.stop()
+            elif total.total:
+                elapsed = now - started
+                failed = f' ({self._failed} failed)' if self._failed else ''
+                print(f'progress: {total.done}/{total.total} episodes{failed}, {total.received / 1e6:.1f} MB '
+                      f'in {format_duration(elapsed)}, {total.received / 1e6 / elapsed if elapsed else 0:.2f} MB/s average',
+                      flush=True)
+
+    def _open_bars(self) -> 'Progress':
+        from rich.progress import BarColumn, Progress, TextColumn
+        # redrawn by the renderer only, chunks never touch rich's lock
+        bars = Progress(TextColumn('{task.description}'),
+                        BarColumn(),
+                        TextColumn('{task.percentage:>3.0f}%'),
+                        TextColumn('{task.fields[stats]}'),
+                        auto_refresh=False)
+        bars.start()
+        return bars
+
+    def _draw(self, bars: 'Progress', ids: dict[EpisodeProgress | None, 'TaskID'],
+              total: ProgressStats, episodes: list[tuple[EpisodeProgress, ProgressStats]]):
+        if None not in ids:
+            # the total stays in the first row, episodes come and go below it
+            ids[None] = bars.add_task('total', total=1.0, stats='')
+        bars.update(ids[None], completed=total.fraction, stats=self._describe(total, 'episodes'))
+        current = set()
+        for episode, stats in episodes:
+            current.add(episode)
+            if episode not in ids:
+                ids[episode] = bars.add_task(stats.name, total=1.0, stats='')
+            bars.update(ids[episode], completed=stats.fraction, stats=self._describe(stats, 'segments'))
+        for episode in [episode for episode in ids if episode is not None and episode not in current]:
+            bars.remove_task(ids.pop(episode))
+        bars.refresh()
+
+    def _print_line(self, total: ProgressStats, episodes: list[tuple[EpisodeProgress, ProgressStats]]):
+        # plain print, rich would wrap the line at 80 columns without a terminal
+        parts = [f'progress: {self._describe(total, "episodes")}']
+        parts += [f'{stats.name} {stats.fraction:.0%} {stats.rate / 1e6:.2f} MB/s ETA {format_duration(stats.eta)}'
+                  for _, stats in episodes]
+        print('; '.join(parts), flush=True)
+
+
+# fed by Myself and AsyncMyself, configured from the command line
+progress = ProgressTracker()
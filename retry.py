@@ -0,0 +1,127 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, TypeVar
+from metrics import metrics
+from myself import HTTPStatusError, Myself
+from scheduler import current_slot
+
+log = logging.getLogger("rich")
+
+T = TypeVar('T')
+
+
+class IncompleteEpisodeError(ValueError):
+    def __init__(self, name: str, missing: list[str]):
+        super().__init__(f'{name}: {len(missing)} segments still missing after retries, not merging')
+        self.name = name
+        self.missing = missing
+
+
+class DownloadCancelledError(Exception):
+    """The episode was called off, e.g. a queue worker lost its lease. Never retried."""
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter. A Retry-After from the server
+    overrides the computed delay when it is longer.
+    """
+
+    def __init__(self, attempts: int = 5, backoff: float = 0.5, max_delay: float = 30.0):
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, error: BaseException | None = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.backoff * 2 ** attempt))
+        if isinstance(error, HTTPStatusError) and error.retry_after is not None:
+            delay = max(delay, min(error.retry_after, self.max_delay))
+        return delay
+
+
+class EpisodeSource:
+    """
+    The video host an episode's segments are fetched from.
+
+    After `failover_after` consecutive failures against the same host the
+    episode url is resolved again through the websocket, which may hand
+    out a different host. Only one thread re-resolves; the others pick up
+    the new host on their next attempt.
+
+    `variant` is the path of the chosen variant below video_url when the
+    episode has a master playlist, it is kept across failovers.
+    """
+
+    def __init__(self, episode_url: str, video_url: str, failover_after: int = 3, variant: str = ''):
+        self.episode_url = episode_url
+        self.video_url = video_url
+        self.variant = variant
+        self.failover_after = failover_after
+        self.failovers = 0
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def segment_url(self, uri: str, video_url: str | None = None) -> str:
+        return f'{video_url or self.video_url}{self.variant}/{uri}'
+
+    def report_success(self):
+        self._failures = 0
+
+    def report_failure(self, video_url: str):
+        with self._lock:
+            if video_url != self.video_url:
+                # someone already failed over, this failure was against the old host
+                return
+            self._failures += 1
+            if self.failover_after <= 0 or self._failures < self.failover_after:
+                return
+            self._failures = 0
+            if Myself.cache is not None:
+                Myself.cache.delete('episode', self.episode_url)
+            try:
+                new_video_url, _ = Myself.parse_episode_url(self.episode_url)
+            except ValueError as e:
+                log.warning(f'failed to re-resolve host of {self.episode_url}: {e}')
+                return
+            self.failovers += 1
+            metrics.inc('failovers_total')
+            if new_video_url != self.video_url:
+                log.info(f'switching {self.episode_url} from {self.video_url} to {new_video_url}')
+            self.video_url = new_video_url
+
+
+def call_with_retry(policy: RetryPolicy, source: EpisodeSource, fetch: Callable[[str], T],
+                    cancel: threading.Event | None = None) -> T:
+    """
+    Run fetch(video_url) until it succeeds or the policy runs out of attempts.
+
+    Inside a SegmentScheduler job every failed attempt is reported to the
+    host's limiter and the backoff is slept without holding the host slot.
+    Once `cancel` is set no further attempt is made.
+    """
+    slot = current_slot()
+    for attempt in range(policy.attempts):
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelledError(f'{source.episode_url}: cancelled')
+        video_url = source.video_url
+        try:
+            result = fetch(video_url)
+        except ValueError as e:
+            source.report_failure(video_url)
+            if attempt + 1 >= policy.attempts:
+                raise
+            delay = policy.delay(attempt, e)
+            metrics.inc('retries_total', error=type(e).__name__)
+            log.debug(f'attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s')
+            if slot is None:
+                time.sleep(delay)
+                continue
+            # the last failure is counted by the scheduler when the job raises
+            slot.failed(e)
+            slot.backoff(delay)
+            continue
+        source.report_success()
+        return result
+    raise AssertionError('unreachable')
@@ -0,0 +1,291 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, TypedDict
+from urllib.parse import urlparse
+from myself import HTTPStatusError
+
+log = logging.getLogger("rich")
+
+# the slot of the job a scheduler worker is running, see current_slot
+_running = threading.local()
+
+
+class HostStatsDict(TypedDict):
+    limit: int
+    inflight: int
+    queued: int
+    done: int
+    errors: int
+    throttled: int
+    mbps: float
+
+
+def host_of(url: str) -> str:
+    return urlparse(url).netloc
+
+
+class HostLimiter:
+    """
+    AIMD concurrency limit for one host.
+
+    Every `limit` completions form a window. When a clean window keeps up
+    throughput the limit grows by one, once more connections stop buying
+    throughput it holds where it is. Errors halve the limit, at most once
+    per `cooldown` so a burst of failures from the same congestion event
+    only counts once, and 429/503 also pause the host for Retry-After.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, cooldown: float = 2.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cooldown = cooldown
+        self.inflight = 0
+        # jobs done backing off and waiting for a slot, they get one before queued jobs do
+        self.waiting = 0
+        self.done = 0
+        self.errors = 0
+        self.throttled = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_count = 0
+        self._window_errors = 0
+        self._best_rate = 0.0
+        self._rate = 0.0
+
+    def has_capacity(self, now: float, resuming: bool = False) -> bool:
+        reserved = 0 if resuming else self.waiting
+        return now >= self.paused_until and self.inflight + reserved < int(self.limit)
+
+    def on_success(self, nbytes: int, now: float):
+        self.done += 1
+        self._window_bytes += nbytes
+        self._window_count += 1
+        if self._window_count < int(self.limit):
+            return
+
+        elapsed = max(now - self._window_start, 1e-6)
+        rate = self._window_bytes / elapsed
+        self._rate = rate
+        if self._window_errors == 0 and rate >= self._best_rate * 0.95:
+            self.limit = min(self.limit + 1, self.maximum)
+        self._best_rate = max(rate, self._best_rate * 0.9)
+        self._window_start = now
+        self._window_bytes = self._window_count = self._window_errors = 0
+
+    def on_error(self, error: BaseException, now: float):
+        self.errors += 1
+        self._window_errors += 1
+        if isinstance(error, HTTPStatusError) and error.throttled:
+            self.throttled += 1
+            self.paused_until = max(self.paused_until, now + (error.retry_after or self.cooldown))
+        if now - self._last_decrease >= self.cooldown:
+            self._last_decrease = now
+            self.limit = max(self.limit / 2, self.minimum)
+
+    def stats(self, queued: int) -> HostStatsDict:
+        return {
+            'limit': int(self.limit),
+            'inflight': self.inflight,
+            'queued': queued,
+            'done': self.done,
+            'errors': self.errors,
+            'throttled': self.throttled,
+            'mbps': round(self._rate / 1e6, 3),
+        }
+
+
+class _Job:
+    __slots__ = ('fn', 'args', 'kwargs', 'future')
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future: Future = Future()
+
+
+class SegmentScheduler:
+    """
+    One segment work queue shared by every episode of a run.
+
+    `max_workers` threads pull jobs from per-host queues, round robin over
+    the hosts that are below their AIMD limit. A job returning an int is
+    counted as that many transferred bytes for the throughput estimate.
+    """
+
+    def __init__(self, max_workers: int = 32, initial: int = 8, minimum: int = 1, cooldown: float = 2.0):
+        self.max_workers = max_workers
+        self.initial = initial
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self._hosts: dict[str, HostLimiter] = {}
+        self._queues: dict[str, deque[_Job]] = {}
+        self._order: deque[str] = deque()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._workers = [threading.Thread(target=self._work, daemon=True, name=f'segment-{i}')
+                         for i in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self) -> 'SegmentScheduler':
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def submit(self, host: str, fn: Callable, *args, **kwargs) -> Future:
+        job = _Job(fn, args, kwargs)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('scheduler is shut down')
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(self.initial, self.minimum, self.max_workers, self.cooldown)
+                self._queues[host] = deque()
+                self._order.append(host)
+            self._queues[host].append(job)
+            self._cond.notify()
+        return job.future
+
+    def for_host(self, host: str) -> 'HostExecutor':
+        return HostExecutor(self, host)
+
+    def _next_job(self) -> tuple[str, _Job] | None:
+        # called with the condition held
+        while True:
+            if self._shutdown and not any(self._queues.values()):
+                return None
+            now = time.monotonic()
+            wake_at = None
+            for _ in range(len(self._order)):
+                host = self._order[0]
+                self._order.rotate(-1)
+                limiter = self._hosts[host]
+                if not self._queues[host]:
+                    continue
+                if limiter.has_capacity(now):
+                    limiter.inflight += 1
+                    return host, self._queues[host].popleft()
+                if limiter.paused_until > now:
+                    wake_at = min(wake_at or limiter.paused_until, limiter.paused_until)
+            self._cond.wait(timeout=None if wake_at is None else wake_at - now)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                picked = self._next_job()
+            if picked is None:
+                return
+            host, job = picked
+            if not job.future.set_running_or_notify_cancel():
+                with self._cond:
+                    self._hosts[host].inflight -= 1
+                    self._cond.notify()
+                continue
+
+            _running.slot = HostSlot(self, host)
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except BaseException as e:
+                with self._cond:
+                    limiter = self._hosts[host]
+                    limiter.inflight -= 1
+                    limiter.on_error(e, time.monotonic())
+                    log.debug(f'{host}: {e!r}, concurrency limit now {int(limiter.limit)}')
+                    self._cond.notify_all()
+                job.future.set_exception(e)
+            else:
+                with self._cond:
+                    limiter = self._hosts[host]
+                    limiter.inflight -= 1
+                    limiter.on_success(result if isinstance(result, int) else 0, time.monotonic())
+                    self._cond.notify_all()
+                job.future.set_result(result)
+            finally:
+                _running.slot = None
+
+    def stats(self) -> dict[str, HostStatsDict]:
+        with self._cond:
+            return {host: limiter.stats(len(self._queues[host])) for host, limiter in self._hosts.items()}
+
+    def shutdown(self, wait: bool = True):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+
+class HostSlot:
+    """
+    The host slot held by the job running on a scheduler worker, for jobs
+    that retry on their own: every failed attempt reaches the host's AIMD
+    limit, and the slot is handed back while the job backs off.
+    """
+
+    def __init__(self, scheduler: SegmentScheduler, host: str):
+        self.scheduler = scheduler
+        self.host = host
+
+    def failed(self, error: BaseException):
+        """An attempt failed and will be retried, halve the limit or pause the host like a failed job would."""
+        with self.scheduler._cond:
+            limiter = self.scheduler._hosts[self.host]
+            limiter.on_error(error, time.monotonic())
+            log.debug(f'{self.host}: {error!r}, concurrency limit now {int(limiter.limit)}')
+
+    def backoff(self, delay: float):
+        """Sleep `delay` seconds without the slot, then wait for room on the host, a pause included."""
+        cond = self.scheduler._cond
+        limiter = self.scheduler._hosts[self.host]
+        with cond:
+            limiter.inflight -= 1
+            cond.notify_all()
+        try:
+            time.sleep(delay)
+        finally:
+            with cond:
+                limiter.waiting += 1
+                while not limiter.has_capacity(now := time.monotonic(), resuming=True):
+                    cond.wait(timeout=limiter.paused_until - now if limiter.paused_until > now else None)
+                limiter.waiting -= 1
+                limiter.inflight += 1
+
+
+def current_slot() -> HostSlot | None:
+    """The slot of the scheduler job running in this thread, None outside a SegmentScheduler."""
+    return getattr(_running, 'slot', None)
+
+
+class HostExecutor:
+    """ThreadPoolExecutor look-alike that feeds one host's jobs into a SegmentScheduler."""
+
+    def __init__(self, scheduler: SegmentScheduler, host: str):
+        self.scheduler = scheduler
+        self.host = host
+        self._futures: list[Future] = []
+
+    def __enter__(self) -> 'HostExecutor':
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            for future in self._futures:
+                future.cancel()
+        for future in self._futures:
+            try:
+                future.exception()
+            except BaseException:
+                pass
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        future = self.scheduler.submit(self.host, fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
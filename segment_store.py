@@ -0,0 +1,282 @@
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+from manifest import file_sha256
+from metrics import metrics
+
+log = logging.getLogger("rich")
+
+STORE_NAME = 'segments'
+DEFAULT_MAX_BYTES = 20 * 1024 * 1024 * 1024
+LINK_MODES = ('auto', 'reflink', 'copy')
+
+# linux/fs.h, clone the extents of one file into another on btrfs, xfs and friends
+FICLONE = 0x40049409
+
+# the store used by the segment fetch paths, None downloads every segment
+store: 'SegmentStore | None' = None
+
+
+def link_file(src: str, dest: str, mode: str = 'auto') -> str:
+    """
+    Make `dest` a file with the content of `src`: a hardlink for auto, a
+    reflink for reflink, a copy when those are not possible or for copy.
+
+    :return: what was made, 'hardlink', 'reflink' or 'copy'.
+    """
+    if mode == 'auto':
+        try:
+            os.link(src, dest)
+            return 'hardlink'
+        except OSError:
+            # another filesystem or one without hardlinks
+            pass
+    elif mode == 'reflink':
+        try:
+            import fcntl
+            with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except (ImportError, OSError):
+            pass
+    shutil.copyfile(src, dest)
+    return 'copy'
+
+
+class SegmentStore:
+    """
+    Content-addressed cache of finished segments shared by every episode
+    and every run, so a re-uploaded show or a re-download after a metadata
+    change does not fetch the same segments again.
+
+    A segment is looked up by its url without the host, which changes on
+    failover but not between mirrors, and a tag for what was done to the
+    body on the way to disk (key and init section of an encrypted
+    segment). An entry is only trusted while its blob still has the
+    recorded size and, when the caller asked the origin, while the origin
+    still sends a body of the length it was stored from, so a segment
+    re-uploaded under the same url is downloaded again. Blobs are named
+    after the sha256 of their content, so segments that moved to new urls
+    are stored once.
+
+    Blobs go into ts/ and back as hardlinks where the filesystem allows, or
+    as reflinks when asked for, so neither the download nor the merge copies
+    them. The least recently used blobs are dropped once the store outgrows
+    `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES, link: str = 'auto'):
+        self.directory = os.path.join(directory, STORE_NAME)
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{STORE_NAME}.sqlite3')
+        self.max_bytes = max_bytes
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed_at);
+            CREATE TABLE IF NOT EXISTS segments (
+                key TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                PRIMARY KEY (key, tag)
+            );
+            CREATE INDEX IF NOT EXISTS segments_digest ON segments (digest);''')
+        # stores written before the origin length was kept, their entries are not checked against it
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(segments)')}
+        if 'length' not in columns:
+            self._db.execute('ALTER TABLE segments ADD COLUMN length INTEGER')
+
+    @staticmethod
+    def key_of(url: str) -> str:
+        parts = urlsplit(url)
+        return f'{parts.path}?{parts.query}' if parts.query else parts.path
+
+    def _blob(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _miss(self):
+        self.misses += 1
+        metrics.inc('segment_cache_total', result='miss')
+
+    def _hit(self, size: int):
+        self.hits += 1
+        self.saved_bytes += size
+        metrics.inc('segment_cache_total', result='hit')
+        metrics.inc('segment_cache_bytes_total', size)
+
+    def _forget(self, digest: str):
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('DELETE FROM segments WHERE digest = ?', (digest,))
+            self._db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            self._db.execute('COMMIT')
+
+    def cached(self, url: str, tag: str = '') -> bool:
+        """Whether `url` has an entry, so the caller only asks the origin for its length when it is worth it."""
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM segments WHERE key = ? AND tag = ?',
+                                    (self.key_of(url), tag)).fetchone() is not None
+
+    def lookup(self, url: str, tag: str = '', length: int | None = None) -> tuple[str, int] | None:
+        """
+        Path and size of the blob cached for `url`, None when there is none,
+        it was damaged or `length`, the size of the body the origin sends
+        now, is not the one it was stored from.
+        """
+        key = self.key_of(url)
+        with self._lock:
+            row = self._db.execute('SELECT digest, size, length FROM segments WHERE key = ? AND tag = ?',
+                                   (key, tag)).fetchone()
+        if row is None:
+            return None
+        digest, size, stored_length = row
+        if length is not None and stored_length is not None and length != stored_length:
+            log.debug(f'segment store: {url} is {length} bytes now, {stored_length} when stored, dropped')
+            # only this entry, the blob may be the content of other urls
+            with self._lock:
+                self._db.execute('DELETE FROM segments WHERE key = ? AND tag = ?', (key, tag))
+            return None
+        path = self._blob(digest)
+        try:
+            intact = os.path.getsize(path) == size
+        except OSError:
+            intact = False
+        if not intact:
+            log.debug(f'segment store: blob of {url} is gone or truncated, dropped')
+            self._forget(digest)
+            return None
+        with self._lock:
+            self._db.execute('UPDATE blobs SET accessed_at = ? WHERE digest = ?', (time.time(), digest))
+        return path, size
+
+    def fetch(self, url: str, dest: str, tag: str = '', length: int | None = None) -> int | None:
+        """
+        Put the cached segment of `url` at `dest`, replacing what is there.
+        `length` is checked as in lookup.
+
+        :return: its size, None when it is not cached.
+        """
+        if (found := self.lookup(url, tag, length)) is None:
+            self._miss()
+            return None
+        blob, size = found
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            link_file(blob, dest, self.link)
+        except FileNotFoundError:
+            # evicted by another process in between
+            self._miss()
+            return None
+        self._hit(size)
+        return size
+
+    def read(self, url: str, tag: str = '', length: int | None = None) -> bytes | None:
+        """Content of the cached segment of `url`, None when it is not cached."""
+        if (found := self.lookup(url, tag, length)) is None:
+            self._miss()
+            return None
+        try:
+            with open(found[0], 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._miss()
+            return None
+        self._hit(len(data))
+        return data
+
+    def add(self, url: str, path: str, tag: str = '', digest: str | None = None, length: int | None = None) -> str:
+        """
+        Remember the finished segment file at `path` as the content of `url`.
+        `digest` is its sha256 when the caller hashed it on the way to disk,
+        otherwise the file is read once more. `length` is the size of the
+        body the origin sent when the file is not that body as is, a
+        decrypted segment or one with an init section in front.
+
+        :return: sha256 of the content.
+        """
+        digest = digest or file_sha256(path)
+        blob = self._blob(digest)
+        if not os.path.exists(blob):
+            tmp = self._tmp(blob)
+            link_file(path, tmp, self.link)
+            os.replace(tmp, blob)
+        size = os.path.getsize(blob)
+        self._index(url, tag, digest, size, size if length is None else length)
+        return digest
+
+    def add_bytes(self, url: str, data: bytes, tag: str = '') -> str:
+        """Same as add for a segment that is only in memory."""
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self._blob(digest)
+        if not os.path.exists(blob):
+            tmp = self._tmp(blob)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, blob)
+        self._index(url, tag, digest, len(data), len(data))
+        return digest
+
+    def _tmp(self, blob: str) -> str:
+        # unique per writer, several threads and processes may store the same blob at once
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        return f'{blob}.{os.getpid()}-{threading.get_ident()}.tmp'
+
+    def _index(self, url: str, tag: str, digest: str, size: int, length: int):
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            self._db.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', (digest, size, now))
+            self._db.execute('INSERT OR REPLACE INTO segments (key, tag, digest, size, stored_at, length) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (self.key_of(url), tag, digest, size, now, length))
+            self._db.execute('COMMIT')
+            self._evict()
+
+    def _evict(self):
+        # called with the lock held
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        rows = self._db.execute('SELECT digest, size FROM blobs ORDER BY accessed_at').fetchall()
+        for digest, size in rows:
+            if freed >= target:
+                break
+            self._db.execute('DELETE FROM segments WHERE digest = ?', (digest,))
+            self._db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            try:
+                # a hardlink in some ts/ keeps the data until that episode is merged
+                os.remove(self._blob(digest))
+            except FileNotFoundError:
+                pass
+            freed += size
+        log.debug(f'segment store evicted {freed} bytes')
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            blobs, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+            segments, = self._db.execute('SELECT COUNT(*) FROM segments').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'saved_bytes': self.saved_bytes,
+                'blobs': blobs, 'segments': segments, 'bytes': size}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
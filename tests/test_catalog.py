@@ -0,0 +1,123 @@
+import sqlite3
+import pytest
+import catalog
+from catalog import Catalog, thread_id_of
+
+
+def entry(thread_id: int, name: str, weekday: str | None = None, season: str | None = None) -> dict:
+    return {'thread_id': thread_id, 'name': name, 'url': f'https://myself-bbs.com/thread-{thread_id}-1-1.html',
+            'season': season, 'weekday': weekday, 'update': None, 'image': None}
+
+
+@pytest.fixture(params=[True, False], ids=['fts', 'like'])
+def filled(request, tmp_path):
+    store = Catalog(str(tmp_path))
+    if not request.param:
+        store.fts = False
+    store.upsert([
+        entry(100, 'Attack on Titan', season='2013'),
+        entry(200, 'Titan Academy', weekday='Monday'),
+        entry(300, '進擊的巨人 The Final Season', weekday='Sunday'),
+        entry(400, '白色相簿2'),
+    ])
+    yield store
+    store.close()
+
+
+def names(entries) -> list[str]:
+    return [e['name'] for e in entries]
+
+
+def test_substring_is_case_insensitive_and_prefixes_come_first(filled):
+    assert names(filled.search('TITAN')) == ['Titan Academy', 'Attack on Titan']
+
+
+def test_cjk_substring(filled):
+    assert names(filled.search('的巨人')) == ['進擊的巨人 The Final Season']
+
+
+def test_short_queries_still_match(filled):
+    assert names(filled.search('巨人')) == ['進擊的巨人 The Final Season']
+    assert names(filled.search('2')) == ['白色相簿2']
+
+
+def test_thread_id_comes_first(filled):
+    assert filled.search('300')[0]['thread_id'] == 300
+
+
+def test_weekday_filter(filled):
+    assert names(filled.search('titan', weekday='Monday')) == ['Titan Academy']
+
+
+def test_quotes_in_the_query_are_literal(filled):
+    assert filled.search('"titan') == []
+
+
+def test_renamed_anime_is_found_under_the_new_name(filled):
+    filled.upsert([entry(100, 'Shingeki no Kyojin')])
+    assert names(filled.search('kyojin')) == ['Shingeki no Kyojin']
+    assert names(filled.search('attack')) == []
+
+
+def test_long_queries_do_not_scan_the_table(tmp_path):
+    store = Catalog(str(tmp_path))
+    if not store.fts:
+        pytest.skip('sqlite without fts5 trigram')
+    plan = ' '.join(row[-1] for row in store._db.execute(
+        'EXPLAIN QUERY PLAN SELECT thread_id FROM anime WHERE thread_id IN '
+        '(SELECT rowid FROM anime_fts WHERE anime_fts MATCH ? UNION SELECT ?)', ('"titan"', -1)))
+    assert 'SCAN anime ' not in plan + ' '
+
+
+def test_index_is_built_for_a_catalog_crawled_before_it(tmp_path):
+    db = sqlite3.connect(tmp_path / catalog.CATALOG_NAME)
+    db.executescript('''
+        CREATE TABLE anime (thread_id INTEGER PRIMARY KEY, name TEXT NOT NULL, name_key TEXT NOT NULL,
+                            url TEXT NOT NULL, season TEXT, weekday TEXT, "update" TEXT, image TEXT,
+                            seen_at REAL NOT NULL);
+        INSERT INTO anime VALUES (1, 'Old Show', 'old show', 'u', NULL, NULL, NULL, NULL, 0);''')
+    db.commit()
+    db.close()
+    store = Catalog(str(tmp_path))
+    assert names(store.search('old show')) == ['Old Show']
+
+
+def test_thread_id_of():
+    assert thread_id_of('https://myself-bbs.com/thread-47717-1-1.html') == 47717
+    assert thread_id_of('https://myself-bbs.com/forum.php?mod=viewthread&tid=46195') == 46195
+    assert thread_id_of('https://myself-bbs.com/portal.php') is None
+
+
+class FakeResponse:
+    status_code = 200
+    ok = True
+
+    def __init__(self, text: str):
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.headers = {'ETag': '"v1"'}
+
+
+def test_page_that_fails_to_parse_is_crawled_again(tmp_path, monkeypatch):
+    store = Catalog(str(tmp_path))
+    monkeypatch.setattr(catalog.Myself, '_req', staticmethod(lambda url, **kwargs: FakeResponse('<html></html>')))
+    anime = [{'name': 'Attack on Titan', 'url': 'https://myself-bbs.com/thread-100-1-1.html', 'image': None}]
+    parsed = iter([KeyError('name'), anime])
+
+    def parse(text):
+        if isinstance(result := next(parsed), Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(catalog.Myself, 'parse_finish_anime_page_data', staticmethod(parse))
+    crawler = catalog.CatalogCrawler(store, rate=1000, force=True)
+    with pytest.raises(KeyError):
+        crawler.finish_page(1)
+    url = f"{catalog.site_opt['url']}/{catalog.site_opt['finish_forum'].format(page=1)}"
+    assert store.page(url) is None
+    # the same body again is not mistaken for an unchanged page
+    crawler.force = False
+    assert crawler.finish_page(1)
+    assert names(store.search('titan')) == ['Attack on Titan']
+    assert store.page(url)[4] == 1
+    store.close()
@@ -0,0 +1,89 @@
+import m3u8
+import pytest
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from decrypt import PlaylistKeys, SegmentDecryptor, segment_iv
+
+KEY = bytes(range(16))
+BASE = 'https://v.example/stream/'
+
+
+def encrypt(data: bytes, iv: bytes, key: bytes = KEY) -> bytes:
+    padder = padding.PKCS7(128).padder()
+    padded = padder.update(data) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(padded) + encryptor.finalize()
+
+
+def playlist(text: str) -> m3u8.M3U8:
+    return m3u8.loads('#EXTM3U\n#EXT-X-TARGETDURATION:10\n' + text, uri=BASE + 'index.m3u8')
+
+
+def test_segment_iv():
+    key = m3u8.Key('AES-128', BASE, 'key.bin', iv='0x0A')
+    assert segment_iv(key, 5) == b'\0' * 15 + b'\x0a'
+    assert segment_iv(m3u8.Key('AES-128', BASE, 'key.bin'), 258) == b'\0' * 14 + b'\x01\x02'
+
+
+@pytest.mark.parametrize('size', [0, 15, 16, 1000])
+def test_decryptor_strips_the_padding_in_chunks(size):
+    data = bytes(i % 251 for i in range(size))
+    iv = b'\x07' * 16
+    body = encrypt(data, iv)
+    decryptor = SegmentDecryptor(algorithms.AES(KEY), iv)
+    out = b''.join(decryptor.update(body[i:i + 7]) for i in range(0, len(body), 7)) + decryptor.finalize()
+    assert out == data
+
+
+def test_wrong_key_is_a_value_error():
+    body = encrypt(b'segment', b'\0' * 16)
+    with pytest.raises(ValueError):
+        SegmentDecryptor(algorithms.AES(b'\xff' * 16), b'\0' * 16).decrypt(body)
+
+
+def test_keys_are_fetched_once_and_ivs_follow_the_media_sequence():
+    fetched = []
+
+    def fetch(url):
+        fetched.append(url)
+        return KEY
+
+    keys = PlaylistKeys(playlist('#EXT-X-MEDIA-SEQUENCE:7\n#EXT-X-KEY:METHOD=AES-128,URI="key.bin"\n'
+                                 '#EXTINF:10,\n0.ts\n#EXTINF:10,\n1.ts\n'), fetch=fetch)
+    assert keys.urls() == [BASE + 'key.bin']
+    for index in range(2):
+        iv = (7 + index).to_bytes(16, 'big')
+        assert keys.decryptor(index).decrypt(encrypt(b'segment %d' % index, iv)) == b'segment %d' % index
+    assert fetched == [BASE + 'key.bin']
+    assert keys.urls() == []
+    assert keys.fingerprint(1) == f'{BASE}key.bin#{(8).to_bytes(16, "big").hex()}'
+
+
+def test_plain_segments_have_no_decryptor():
+    keys = PlaylistKeys(playlist('#EXTINF:10,\n0.ts\n'))
+    assert keys.decryptor(0) is None
+    assert keys.fingerprint(0) == ''
+    assert keys.header(0) == b''
+
+
+def test_unsupported_method_is_rejected():
+    with pytest.raises(ValueError, match='SAMPLE-AES'):
+        PlaylistKeys(playlist('#EXT-X-KEY:METHOD=SAMPLE-AES,URI="key.bin"\n#EXTINF:10,\n0.ts\n'))
+
+
+def test_short_key_is_rejected():
+    keys = PlaylistKeys(playlist('#EXT-X-KEY:METHOD=AES-128,URI="key.bin"\n#EXTINF:10,\n0.ts\n'),
+                        fetch=lambda url: b'short')
+    with pytest.raises(ValueError, match='expected 16'):
+        keys.decryptor(0)
+
+
+def test_init_section_byterange_and_stream_header():
+    keys = PlaylistKeys(playlist('#EXT-X-MAP:URI="init.mp4",BYTERANGE="4@2"\n'
+                                 '#EXTINF:10,\n0.ts\n#EXTINF:10,\n1.ts\n'))
+    keys.add(BASE + 'init.mp4', b'..INIT..')
+    assert keys.init_section(0) == b'INIT'
+    assert keys.header(1) == b'INIT'
+    # a continuous stream only repeats it where it changes
+    assert keys.header(0, standalone=False) == b'INIT'
+    assert keys.header(1, standalone=False) == b''
@@ -0,0 +1,107 @@
+import hashlib
+import http.server
+import os
+import threading
+import pytest
+import myself
+from myself import HTTPStatusError, Myself
+
+BODY = bytes(range(256)) * 1000
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/missing.ts':
+            self.send_error(404)
+            return
+        body = BODY
+        status = 200
+        if (spec := self.headers.get('Range')) is not None and self.path != '/no-range.ts':
+            start = int(spec.removeprefix('bytes=').rstrip('-'))
+            body, status = BODY[start:], 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(BODY) if self.path == '/truncated.ts' else len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2] if self.path == '/truncated.ts' else body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def site():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setitem(myself.download_opt, 'chunk_size', 4096)
+
+
+def test_get_content_reads_the_whole_body(site):
+    assert Myself.get_content(f'{site}/1.ts') == BODY
+
+
+def test_get_content_rejects_a_truncated_body(site):
+    with pytest.raises(ValueError):
+        Myself.get_content(f'{site}/truncated.ts')
+
+
+def test_get_content_raises_the_status(site):
+    with pytest.raises(HTTPStatusError) as error:
+        Myself.get_content(f'{site}/missing.ts')
+    assert error.value.status == 404
+
+
+def test_download_to_resumes_with_a_range_request(site, tmp_path):
+    path = tmp_path / '1.ts'
+    path.write_bytes(BODY[:1000])
+    assert Myself.download_to(f'{site}/1.ts', str(path), start=1000) == len(BODY) - 1000
+    assert path.read_bytes() == BODY
+
+
+def test_download_to_starts_over_without_range_support(site, tmp_path):
+    path = tmp_path / '1.ts'
+    path.write_bytes(BODY[:1000])
+    assert Myself.download_to(f'{site}/no-range.ts', str(path), start=1000) == len(BODY)
+    assert path.read_bytes() == BODY
+
+
+def test_download_to_writes_the_header_first(site, tmp_path):
+    path = tmp_path / '1.ts'
+    Myself.download_to(f'{site}/1.ts', str(path), header=b'init')
+    assert path.read_bytes() == b'init' + BODY
+
+
+def test_download_to_never_writes_through_a_hardlink(site, tmp_path):
+    blob, path = tmp_path / 'blob', tmp_path / '1.ts'
+    blob.write_bytes(b'cached')
+    os.link(blob, path)
+    Myself.download_to(f'{site}/1.ts', str(path))
+    assert path.read_bytes() == BODY
+    assert blob.read_bytes() == b'cached'
+
+
+def test_download_to_resume_breaks_a_hardlink(site, tmp_path):
+    blob, path = tmp_path / 'blob', tmp_path / '1.ts'
+    blob.write_bytes(BODY[:1000])
+    os.link(blob, path)
+    Myself.download_to(f'{site}/1.ts', str(path), start=1000)
+    assert path.read_bytes() == BODY
+    assert blob.read_bytes() == BODY[:1000]
+
+
+def test_download_to_hashes_what_it_writes(site, tmp_path):
+    path = tmp_path / '1.ts'
+    sha256 = hashlib.sha256()
+    Myself.download_to(f'{site}/1.ts', str(path), header=b'init', sha256=sha256)
+    assert sha256.hexdigest() == hashlib.sha256(b'init' + BODY).hexdigest()
+
+    # a resumed file is hashed from its first byte
+    path.write_bytes(BODY[:1000])
+    sha256 = hashlib.sha256()
+    Myself.download_to(f'{site}/1.ts', str(path), start=1000, sha256=sha256)
+    assert sha256.hexdigest() == hashlib.sha256(BODY).hexdigest()
@@ -0,0 +1,77 @@
+"""Whole episodes through each engine against bench/fake_server.py, with injected errors and encryption."""
+import argparse
+import asyncio
+import glob
+import os
+import shutil
+import pytest
+import async_engine
+import main
+import myself
+import pipeline
+from bench.download_bench import _start_server
+from bench.fake_server import add_server_arguments
+from retry import RetryPolicy
+
+EPISODES = 2
+SEGMENTS = 6
+SEGMENT_SIZE = 4096
+
+
+@pytest.fixture(scope='module')
+def site():
+    parser = argparse.ArgumentParser()
+    add_server_arguments(parser)
+    args = parser.parse_args(['--episodes', str(EPISODES), '--segments', str(SEGMENTS),
+                              '--segment-size', str(SEGMENT_SIZE), '--error-rate', '0.1', '--encrypt'])
+    server, url = _start_server(args)
+    yield url
+    server.kill()
+    server.wait()
+
+
+@pytest.fixture
+def workdir(site, tmp_path, monkeypatch):
+    monkeypatch.setitem(myself.site_opt, 'url', site)
+    monkeypatch.setitem(myself.ws_opt, 'url', site.replace('http://', 'ws://') + '/ws')
+    monkeypatch.setitem(myself.ws_opt, 'host', site.split('://')[1])
+    monkeypatch.setattr(myself, 'ws_pool', myself.WebsocketPool(size=1))
+    monkeypatch.setattr(myself.Myself, 'cache', None)
+
+    # the fake segments are not video, concatenate them instead of remuxing
+    def concat(ts_dir, merged_mp4, segments=None):
+        with open(os.path.join(ts_dir, merged_mp4), 'wb') as out:
+            for name in segments:
+                with open(os.path.join(ts_dir, name), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+    monkeypatch.setattr(pipeline, 'concat_ts_dir', concat)
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    myself.ws_pool.close()
+
+
+def episodes(directory, extension: str) -> list[int]:
+    return sorted(os.path.getsize(path) for path in glob.glob(os.path.join(directory, 'download', '*', f'*.{extension}')))
+
+
+RETRY = RetryPolicy(attempts=8, backoff=0.01, max_delay=0.05)
+
+
+def test_threaded_engine(workdir):
+    main.download_anime(1, download_dir='download', threads=4, e_threads=2, retry=RETRY)
+    assert episodes(workdir, 'mp4') == [SEGMENTS * SEGMENT_SIZE] * EPISODES
+    # a second run finds everything on disk
+    main.download_anime(1, download_dir='download', threads=4, e_threads=2, retry=RETRY)
+    assert episodes(workdir, 'mp4') == [SEGMENTS * SEGMENT_SIZE] * EPISODES
+
+
+def test_adaptive_stream(workdir):
+    main.download_anime(1, download_dir='download', threads=4, e_threads=2, stream='ts', adaptive=True, retry=RETRY)
+    assert episodes(workdir, 'ts') == [SEGMENTS * SEGMENT_SIZE] * EPISODES
+
+
+def test_async_engine(workdir):
+    asyncio.run(async_engine.download_anime_async(1, download_dir='download', max_inflight=8, e_concurrency=2,
+                                                  retry=RETRY))
+    assert episodes(workdir, 'mp4') == [SEGMENTS * SEGMENT_SIZE] * EPISODES
@@ -0,0 +1,112 @@
+import pytest
+import jobs
+from jobs import JobQueue
+
+SHOW = {'name': 'Show', 'url': 'thread-1-1-1.html',
+        'video': [{'name': f'第 {i:02d} 話', 'url': f'play/1/{i}'} for i in range(1, 4)]}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'), attempts=2)
+    queue.add(1, SHOW)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(jobs.time, 'time', lambda: now[0])
+    return now
+
+
+def test_add_only_queues_new_episodes(queue):
+    assert queue.add(1, SHOW) == 0
+    more = {**SHOW, 'video': SHOW['video'] + [{'name': '第 04 話', 'url': 'play/1/4'}]}
+    assert queue.add(1, more) == 1
+    assert queue.stats()['queued'] == 4
+
+
+def test_jobs_are_leased_once_in_order(queue):
+    first, second = queue.lease('a'), queue.lease('b')
+    assert (first['episode_index'], second['episode_index']) == (0, 1)
+    assert first['anime_info'] == SHOW
+    assert first['attempts'] == 1
+    assert queue.stats()['leased'] == 2
+
+
+def test_expired_lease_goes_to_the_next_worker(queue, clock):
+    for _ in range(3):
+        queue.lease('a', lease=10)
+    clock[0] += 5
+    assert queue.renew(1, 'a', lease=10)
+    clock[0] += 6
+    # jobs 2 and 3 ran out, job 1 was renewed
+    job = queue.lease('b', lease=10)
+    assert job['id'] == 2 and job['attempts'] == 2
+    assert not queue.renew(2, 'a')
+    assert queue.fail(2, 'a', 'too late') is None
+
+
+def test_lease_that_ran_out_of_attempts_is_failed(queue, clock):
+    queue.lease('a', lease=10)
+    clock[0] += 1
+    queue.lease('a', lease=10)
+    queue.lease('a', lease=10)
+    clock[0] += 9.5
+    assert queue.lease('b', lease=10)['id'] == 1
+    clock[0] += 11
+    # job 1 used its two leases, the next one to run out goes instead
+    assert queue.lease('c', lease=10)['id'] == 2
+    assert queue.stats()['failed'] == 1
+    assert queue.failures()[0]['error'] == 'lease expired'
+
+
+def test_failed_attempt_backs_off_then_fails_for_good(queue, clock):
+    job = queue.lease('a')
+    assert queue.fail(job['id'], 'a', 'boom') == 'queued'
+    # the other jobs come first while this one waits out its backoff
+    assert queue.lease('a')['id'] == 2
+    clock[0] += jobs.RETRY_DELAY
+    job = queue.lease('a')
+    assert job['id'] == 1 and job['attempts'] == 2
+    assert queue.fail(job['id'], 'a', 'boom') == 'failed'
+    assert queue.failures()[0]['error'] == 'boom'
+    assert queue.retry_failed() == 1
+    assert queue.lease('a')['id'] == 1
+
+
+def test_complete_is_accepted_after_the_lease_was_lost(queue, clock):
+    queue.lease('a', lease=10)
+    clock[0] += 11
+    queue.lease('b', lease=10)
+    assert queue.complete(1, 'a', 100)
+    assert not queue.complete(1, 'b', 100)
+    assert queue.stats()['done'] == 1
+    assert queue.stats()['bytes'] == 100
+
+
+@pytest.fixture
+def served(queue):
+    server = jobs.serve_queue(queue, 0, token='secret')
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_remote_queue_needs_the_token(served):
+    assert jobs.RemoteQueue(served, token='secret').lease('a')['episode_index'] == 0
+    with pytest.raises(ValueError, match='token'):
+        jobs.RemoteQueue(served).lease('b')
+    with pytest.raises(ValueError, match='token'):
+        jobs.RemoteQueue(served, token='guess').stats()
+
+
+def test_handler_error_is_answered_with_500(served, queue, monkeypatch):
+    def broken(**kwargs):
+        raise RuntimeError('database disk image is malformed')
+
+    monkeypatch.setattr(queue, 'stats', broken)
+    with pytest.raises(ValueError, match='RuntimeError: database disk image is malformed'):
+        jobs.RemoteQueue(served, token='secret').stats()
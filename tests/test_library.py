@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import library
+from library import LibraryIndex, pending_episodes
+
+NAMES = ['Show 01.mp4']
+
+
+def write(path, data: bytes, mtime: float | None = None):
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_finds_an_episode_by_name(tmp_path):
+    index = LibraryIndex(str(tmp_path / 'cache'))
+    show = tmp_path / 'Show'
+    show.mkdir()
+    write(show / 'Show 01.mp4', b'x' * 10)
+    index.refresh(str(show))
+    assert index.is_downloaded(1, 'ep1', str(show), NAMES)
+    assert not index.is_downloaded(1, 'ep2', str(show), ['Show 02.mp4'])
+
+
+def test_recognises_a_renamed_episode(tmp_path):
+    index = LibraryIndex(str(tmp_path / 'cache'))
+    show = tmp_path / 'Show'
+    show.mkdir()
+    write(show / 'Show 01.mp4', b'x' * 10)
+    index.record(1, 'ep1', str(show / 'Show 01.mp4'))
+
+    os.rename(show / 'Show 01.mp4', show / 'Show - S01E01.mp4')
+    index.refresh(str(show))
+    assert index.is_downloaded(1, 'ep1', str(show), NAMES)
+
+
+def test_another_file_of_the_same_size_is_not_the_episode(tmp_path):
+    index = LibraryIndex(str(tmp_path / 'cache'))
+    show = tmp_path / 'Show'
+    show.mkdir()
+    write(show / 'Show 01.mp4', b'x' * 10, mtime=1_000_000)
+    write(show / 'Show 02.mp4', b'y' * 10, mtime=1_000_000)
+    index.record(1, 'ep1', str(show / 'Show 01.mp4'))
+    index.record(1, 'ep2', str(show / 'Show 02.mp4'))
+
+    # episode 1 is deleted, episode 2 is as large and as old but a different file
+    os.remove(show / 'Show 01.mp4')
+    index.refresh(str(show))
+    assert not index.is_downloaded(1, 'ep1', str(show), NAMES)
+    assert index.is_downloaded(1, 'ep2', str(show), ['Show 02.mp4'])
+
+
+def test_rows_without_inode_match_by_size_and_mtime(tmp_path):
+    index = LibraryIndex(str(tmp_path / 'cache'))
+    show = tmp_path / 'Show'
+    show.mkdir()
+    write(show / 'renamed.mp4', b'x' * 10, mtime=2_000_000)
+    write(show / 'other.mp4', b'y' * 10, mtime=3_000_000)
+    index.refresh(str(show))
+    with index._lock:
+        index._db.execute('UPDATE files SET ino = NULL, dev = NULL')
+        index._record(1, 'ep1', str(show), 'Show 01.mp4', 10, 2_000_000.0)
+    assert index.is_downloaded(1, 'ep1', str(show), NAMES)
+    with index._lock:
+        name, = index._db.execute('SELECT name FROM episodes WHERE episode_url = ?', ('ep1',)).fetchone()
+    assert name == 'renamed.mp4'
+
+
+def test_opens_an_index_written_before_inodes(tmp_path):
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    db = sqlite3.connect(cache / library.LIBRARY_NAME)
+    db.executescript('''
+        CREATE TABLE files (directory TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL,
+                            mtime REAL NOT NULL, PRIMARY KEY (directory, name));
+        CREATE TABLE episodes (thread_id INTEGER NOT NULL, episode_url TEXT NOT NULL, directory TEXT NOT NULL,
+                               name TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL,
+                               downloaded_at REAL NOT NULL, PRIMARY KEY (thread_id, episode_url));''')
+    db.close()
+    show = tmp_path / 'Show'
+    show.mkdir()
+    write(show / 'Show 01.mp4', b'x')
+    index = LibraryIndex(str(cache))
+    index.record(1, 'ep1', str(show / 'Show 01.mp4'))
+    assert index.stats()['episodes'] == 1
+
+
+def test_pending_episodes_skips_what_is_on_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr(library, 'index', LibraryIndex(str(tmp_path / 'cache')))
+    show = tmp_path / 'Show'
+    show.mkdir()
+    write(show / 'Show 01.mp4', b'x')
+    anime_info = {'name': 'Show', 'url': '', 'video': [{'name': '01', 'url': 'ep1'}, {'name': '02', 'url': 'ep2'}]}
+    assert pending_episodes(anime_info, str(show), thread_id=1) == [1]
+    assert pending_episodes(anime_info, str(show), [0], thread_id=1) == [0]
+
+
+def test_streamed_episode_counts_with_and_without_the_index(tmp_path, monkeypatch):
+    show = tmp_path / 'Show'
+    show.mkdir()
+    write(show / 'Show 02.ts', b'x')
+    anime_info = {'name': 'Show', 'url': '', 'video': [{'name': '01', 'url': 'ep1'}, {'name': '02', 'url': 'ep2'}]}
+    monkeypatch.setattr(library, 'index', None)
+    assert pending_episodes(anime_info, str(show), thread_id=1) == [0]
+    monkeypatch.setattr(library, 'index', LibraryIndex(str(tmp_path / 'cache')))
+    assert pending_episodes(anime_info, str(show), thread_id=1) == [0]
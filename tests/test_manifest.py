@@ -0,0 +1,49 @@
+import hashlib
+from manifest import MANIFEST_NAME, SegmentManifest, file_sha256
+
+
+def test_file_sha256(tmp_path):
+    path = tmp_path / '1.ts'
+    path.write_bytes(b'x' * 3000)
+    assert file_sha256(str(path), chunk_size=1024) == hashlib.sha256(b'x' * 3000).hexdigest()
+
+
+def test_recorded_segments_survive_a_restart(tmp_path):
+    (tmp_path / '1.ts').write_bytes(b'segment')
+    SegmentManifest(str(tmp_path)).record('1.ts')
+    manifest = SegmentManifest(str(tmp_path))
+    assert len(manifest) == 1
+    assert manifest.is_complete('1.ts')
+    assert not manifest.is_complete('2.ts')
+
+
+def test_changed_file_is_not_complete(tmp_path):
+    (tmp_path / '1.ts').write_bytes(b'segment')
+    manifest = SegmentManifest(str(tmp_path))
+    manifest.record('1.ts')
+    (tmp_path / '1.ts').write_bytes(b'seg')
+    assert not manifest.is_complete('1.ts')
+    assert manifest.partial_size('1.ts') == 3
+    (tmp_path / '1.ts').unlink()
+    assert not manifest.is_complete('1.ts')
+    assert manifest.partial_size('1.ts') == 0
+
+
+def test_checksum_catches_same_size_corruption(tmp_path):
+    (tmp_path / '1.ts').write_bytes(b'segment')
+    manifest = SegmentManifest(str(tmp_path), checksum=True)
+    manifest.record('1.ts')
+    (tmp_path / '1.ts').write_bytes(b'SEGMENT')
+    assert not manifest.is_complete('1.ts')
+    # without --checksum only the size is compared
+    assert SegmentManifest(str(tmp_path)).is_complete('1.ts')
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    (tmp_path / '1.ts').write_bytes(b'segment')
+    SegmentManifest(str(tmp_path)).record('1.ts')
+    with open(tmp_path / MANIFEST_NAME, 'a', encoding='utf-8') as f:
+        f.write('{"uri": "2.ts", "si')
+    manifest = SegmentManifest(str(tmp_path))
+    assert len(manifest) == 1
+    assert manifest.is_complete('1.ts')
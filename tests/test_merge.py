@@ -0,0 +1,120 @@
+import io
+import threading
+import pytest
+import merge
+from merge import NativeRemuxSink, OrderedSegmentWriter
+
+
+def test_writer_puts_segments_in_order():
+    sink = io.BytesIO()
+    writer = OrderedSegmentWriter(sink, window=4)
+    for _ in range(3):
+        writer.acquire()
+    writer.put(2, b'c')
+    writer.put(1, b'b')
+    assert sink.getvalue() == b''
+    assert writer.peak_buffered == 2
+    writer.put(0, b'a')
+    assert sink.getvalue() == b'abc'
+    assert (writer.written, writer.bytes_written) == (3, 3)
+
+
+def test_writer_window_blocks_until_the_next_segment_is_written():
+    writer = OrderedSegmentWriter(io.BytesIO(), window=2)
+    writer.acquire()
+    writer.acquire()
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (writer.acquire(), acquired.set()))
+    waiter.start()
+    writer.put(1, b'b')
+    assert not acquired.wait(0.1)
+    writer.put(0, b'a')
+    assert acquired.wait(1)
+    waiter.join()
+
+
+def test_writer_fail_wakes_up_waiters():
+    writer = OrderedSegmentWriter(io.BytesIO(), window=1)
+    writer.acquire()
+    errors = []
+
+    def acquire():
+        try:
+            writer.acquire()
+        except RuntimeError as e:
+            errors.append(e)
+
+    waiter = threading.Thread(target=acquire)
+    waiter.start()
+    writer.fail(RuntimeError('stream aborted'))
+    waiter.join(1)
+    assert [str(e) for e in errors] == ['stream aborted']
+    # late segments are dropped
+    writer.put(0, b'a')
+    assert writer.written == 0
+
+
+def test_writer_sink_error_fails_the_stream():
+    class Broken(io.BytesIO):
+        def write(self, data):
+            raise OSError('disk full')
+
+    writer = OrderedSegmentWriter(Broken(), window=2)
+    writer.acquire()
+    with pytest.raises(OSError):
+        writer.put(0, b'a')
+    with pytest.raises(OSError):
+        writer.acquire()
+
+
+# not MPEG-TS, PyAV gives up on the first segment
+GARBAGE = b'\x00' * 4096
+
+
+class FakeFfmpegSink:
+    def __init__(self, output: str):
+        self.output = output
+        self.data = b''
+
+    def write(self, data: bytes):
+        self.data += data
+
+    def close(self) -> int:
+        return 0
+
+    def abort(self):
+        pass
+
+
+@pytest.fixture
+def ffmpeg(monkeypatch):
+    pytest.importorskip('av')
+    sinks: list[FakeFfmpegSink] = []
+
+    def open_sink(output):
+        sinks.append(FakeFfmpegSink(output))
+        return sinks[-1]
+
+    monkeypatch.setattr(merge, 'FfmpegRemuxSink', open_sink)
+    return sinks
+
+
+def test_native_sink_falls_back_to_ffmpeg(tmp_path, ffmpeg):
+    sink = NativeRemuxSink(str(tmp_path / 'out.mp4.part'), fallback=True)
+    segments = [GARBAGE + bytes([i]) for i in range(5)]
+    for data in segments:
+        sink.write(data)
+    assert sink.close() == 0
+    assert sink.remuxer == 'ffmpeg'
+    assert isinstance(sink.error, Exception)
+    # the segments PyAV already took are replayed, none is lost or doubled
+    assert ffmpeg[0].data == b''.join(segments)
+
+
+def test_native_sink_without_fallback_raises_its_own_error(tmp_path, ffmpeg):
+    sink = NativeRemuxSink(str(tmp_path / 'out.mp4.part'))
+    with pytest.raises(RuntimeError, match='native remux'):
+        for _ in range(5):
+            sink.write(GARBAGE)
+        sink.close()
+    assert ffmpeg == []
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from progress import EpisodeProgress, ProgressTracker, RateWindow, format_duration
+
+
+@pytest.mark.parametrize('seconds, text', [(None, '-'), (0.4, '0s'), (59.6, '1m00s'), (3725.0, '1h02m')])
+def test_format_duration(seconds, text):
+    assert format_duration(seconds) == text
+
+
+def test_rate_window():
+    rate = RateWindow(window=10)
+    assert rate.update(0.0, 0) == 0.0
+    assert rate.update(5.0, 500) == 100.0
+    assert rate.update(20.0, 3500) == 200.0
+
+
+def test_estimate_extrapolates_from_finished_segments():
+    episode = EpisodeProgress('ep', segments=4)
+    episode.add_bytes(150)
+    episode.segment_done(100)
+    received, done, fraction, remaining, size = episode.estimate()
+    assert (received, done, size) == (150, 1, 400)
+    # three segments of 100 bytes to go, 50 of them already arrived
+    assert remaining == 250
+    assert fraction == pytest.approx(1 - 250 / 400)
+
+
+def test_failed_attempt_takes_its_bytes_back():
+    tracker = ProgressTracker()
+    episode = EpisodeProgress('ep', segments=2)
+    with pytest.raises(ValueError):
+        with tracker.track(episode):
+            tracker.advance(100)
+            raise ValueError('connection reset')
+    with tracker.track(episode):
+        tracker.advance(100)
+    episode.segment_done(100)
+    assert episode.totals()[0] == 100
+    assert episode.estimate()[3] == 100
+
+
+def test_attempt_counts_for_the_tracked_episode():
+    tracker = ProgressTracker()
+    episode = EpisodeProgress('ep', segments=2)
+
+    async def segment(fail: bool):
+        with tracker.attempt():
+            tracker.advance(10)
+            await asyncio.sleep(0)
+            if fail:
+                raise ValueError('timeout')
+
+    async def main():
+        with tracker.track(episode):
+            tasks = [asyncio.create_task(segment(fail)) for fail in (False, True)]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run(main())
+    assert episode.totals()[0] == 10
+
+
+def test_untracked_bytes_are_ignored():
+    tracker = ProgressTracker()
+    with tracker.attempt():
+        tracker.advance(10)
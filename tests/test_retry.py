@@ -0,0 +1,142 @@
+import threading
+import pytest
+import retry
+from myself import HTTPStatusError, Myself
+from retry import DownloadCancelledError, EpisodeSource, RetryPolicy, call_with_retry
+from scheduler import SegmentScheduler
+
+
+def test_delay_is_jittered_below_the_exponential_bound():
+    policy = RetryPolicy(attempts=5, backoff=0.5, max_delay=30.0)
+    for attempt in range(5):
+        for _ in range(50):
+            assert 0 <= policy.delay(attempt) <= 0.5 * 2 ** attempt
+
+
+def test_delay_is_capped_by_max_delay():
+    policy = RetryPolicy(backoff=10.0, max_delay=3.0)
+    assert all(policy.delay(10) <= 3.0 for _ in range(50))
+
+
+def test_retry_after_wins_when_longer_but_stays_capped():
+    policy = RetryPolicy(backoff=0.001, max_delay=30.0)
+    assert policy.delay(0, HTTPStatusError(429, retry_after=7)) == 7
+    assert policy.delay(0, HTTPStatusError(503, retry_after=120)) == 30.0
+
+
+def test_failover_resolves_again_after_consecutive_failures(monkeypatch):
+    calls = []
+    monkeypatch.setattr(Myself, 'cache', None)
+    monkeypatch.setattr(Myself, 'parse_episode_url',
+                        lambda url: calls.append(url) or ('http://b.example/video', 'm3u8'))
+    source = EpisodeSource('episode', 'http://a.example/video', failover_after=2, variant='/720p')
+
+    source.report_failure('http://a.example/video')
+    assert calls == []
+    source.report_failure('http://a.example/video')
+    assert calls == ['episode']
+    assert source.video_url == 'http://b.example/video'
+    assert source.failovers == 1
+    assert source.segment_url('1.ts') == 'http://b.example/video/720p/1.ts'
+
+    # a late failure against the old host does not count against the new one
+    source.report_failure('http://a.example/video')
+    source.report_failure('http://b.example/video')
+    assert calls == ['episode']
+
+
+def test_success_resets_the_failure_count(monkeypatch):
+    monkeypatch.setattr(Myself, 'parse_episode_url', lambda url: pytest.fail('should not fail over'))
+    source = EpisodeSource('episode', 'http://a.example/video', failover_after=2)
+    source.report_failure('http://a.example/video')
+    source.report_success()
+    source.report_failure('http://a.example/video')
+
+
+def test_call_with_retry_sleeps_between_attempts(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(retry.time, 'sleep', sleeps.append)
+    attempts = iter([ValueError('reset'), ValueError('reset'), 'ok'])
+
+    def fetch(video_url):
+        if isinstance(result := next(attempts), Exception):
+            raise result
+        return result
+
+    source = EpisodeSource('episode', 'http://a.example/video', failover_after=0)
+    assert call_with_retry(RetryPolicy(attempts=3, backoff=0.01), source, fetch) == 'ok'
+    assert len(sleeps) == 2
+
+
+def test_call_with_retry_gives_up_after_the_last_attempt(monkeypatch):
+    monkeypatch.setattr(retry.time, 'sleep', lambda delay: None)
+    source = EpisodeSource('episode', 'http://a.example/video', failover_after=0)
+    with pytest.raises(ValueError, match='down'):
+        call_with_retry(RetryPolicy(attempts=2), source, lambda video_url: (_ for _ in ()).throw(ValueError('down')))
+
+
+def test_call_with_retry_stops_once_cancelled(monkeypatch):
+    monkeypatch.setattr(retry.time, 'sleep', lambda delay: None)
+    cancel = threading.Event()
+    calls = []
+
+    def fetch(video_url):
+        calls.append(video_url)
+        cancel.set()
+        raise ValueError('reset')
+
+    source = EpisodeSource('episode', 'http://a.example/video', failover_after=0)
+    with pytest.raises(DownloadCancelledError):
+        call_with_retry(RetryPolicy(attempts=5), source, fetch, cancel=cancel)
+    assert len(calls) == 1
+
+
+def test_failed_attempts_in_a_scheduler_job_reach_the_host_limit():
+    source = EpisodeSource('episode', 'http://a.example/video', failover_after=0)
+    attempts = iter([HTTPStatusError(503), HTTPStatusError(503), 100])
+    seen_inflight = []
+
+    def fetch(video_url):
+        result = next(attempts)
+        if isinstance(result, Exception):
+            raise result
+        seen_inflight.append(scheduler._hosts['a.example'].inflight)
+        return result
+
+    with SegmentScheduler(max_workers=8, initial=8, cooldown=0) as scheduler:
+        future = scheduler.submit('a.example', call_with_retry, RetryPolicy(attempts=3, backoff=0.001), source, fetch)
+        assert future.result(timeout=5) == 100
+        stats = scheduler.stats()['a.example']
+    # both retried 503s halved the limit, the successful attempt ran with its slot taken back
+    assert stats['errors'] == 2
+    assert stats['throttled'] == 2
+    assert stats['limit'] == 2
+    assert stats['inflight'] == 0
+    assert seen_inflight == [1]
+
+
+def test_backoff_frees_the_slot_for_other_jobs():
+    source = EpisodeSource('episode', 'http://a.example/video', failover_after=0)
+    backing_off = threading.Event()
+    other_ran = threading.Event()
+    attempts = iter([ValueError('reset'), 0])
+
+    def flaky(video_url):
+        result = next(attempts)
+        if isinstance(result, Exception):
+            backing_off.set()
+            raise result
+        return result
+
+    def other():
+        assert backing_off.wait(5)
+        other_ran.set()
+        return 0
+
+    # one slot on the host: the second job only gets to run while the first one backs off
+    with SegmentScheduler(max_workers=2, initial=1, cooldown=0) as scheduler:
+        first = scheduler.submit('a.example', call_with_retry, RetryPolicy(attempts=2, backoff=0.2), source, flaky)
+        second = scheduler.submit('a.example', other)
+        second.result(timeout=5)
+        first.result(timeout=5)
+    assert other_ran.is_set()
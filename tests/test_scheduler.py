@@ -0,0 +1,94 @@
+from myself import HTTPStatusError
+from scheduler import HostLimiter, SegmentScheduler, host_of
+
+
+def finish_window(limiter: HostLimiter, nbytes: int, start: float, seconds: float) -> float:
+    """Complete one window of `limit` jobs moving `nbytes` each over `seconds`, return its end."""
+    count = int(limiter.limit)
+    for i in range(1, count + 1):
+        limiter.on_success(nbytes, start + seconds * i / count)
+    return start + seconds
+
+
+def test_host_of():
+    assert host_of('https://v.example.com:8443/a/b.ts') == 'v.example.com:8443'
+
+
+def test_initial_limit_is_clamped():
+    assert HostLimiter(100, maximum=8).limit == 8
+    assert HostLimiter(0, minimum=2).limit == 2
+
+
+def test_clean_window_that_keeps_up_grows_the_limit():
+    limiter = HostLimiter(4)
+    limiter._window_start = 0.0
+    now = finish_window(limiter, 1000, 0.0, 1.0)
+    assert limiter.limit == 5
+    # more connections, more throughput
+    finish_window(limiter, 1000, now, 1.0)
+    assert limiter.limit == 6
+
+
+def test_limit_holds_once_throughput_stops_growing():
+    limiter = HostLimiter(4)
+    limiter._window_start = 0.0
+    now = finish_window(limiter, 1000, 0.0, 1.0)
+    assert limiter.limit == 5
+    # the same bytes per window now take twice as long
+    finish_window(limiter, 1000, now, 2.5)
+    assert limiter.limit == 5
+
+
+def test_window_with_an_error_does_not_grow():
+    limiter = HostLimiter(4, cooldown=0)
+    limiter._window_start = 0.0
+    limiter.on_error(ValueError('reset'), 0.0)
+    assert limiter.limit == 2
+    finish_window(limiter, 1000, 0.0, 1.0)
+    assert limiter.limit == 2
+
+
+def test_errors_halve_once_per_cooldown():
+    limiter = HostLimiter(16, cooldown=2.0)
+    limiter.on_error(ValueError('reset'), 10.0)
+    limiter.on_error(ValueError('reset'), 11.0)
+    assert limiter.limit == 8
+    limiter.on_error(ValueError('reset'), 12.0)
+    assert limiter.limit == 4
+    for t in range(13, 30, 2):
+        limiter.on_error(ValueError('reset'), float(t))
+    assert limiter.limit == limiter.minimum
+    assert limiter.errors == 12
+
+
+def test_throttling_pauses_the_host_for_retry_after():
+    limiter = HostLimiter(4, cooldown=2.0)
+    limiter.on_error(HTTPStatusError(429, retry_after=30), 100.0)
+    assert limiter.throttled == 1
+    assert not limiter.has_capacity(120.0)
+    assert limiter.has_capacity(130.0)
+    # without Retry-After the pause is the cooldown
+    limiter.on_error(HTTPStatusError(503), 200.0)
+    assert not limiter.has_capacity(201.0)
+    assert limiter.has_capacity(202.0)
+    # other statuses only count as errors
+    limiter.on_error(HTTPStatusError(500), 300.0)
+    assert limiter.throttled == 2
+
+
+def test_resuming_jobs_get_the_reserved_slots():
+    limiter = HostLimiter(2)
+    limiter.inflight = 1
+    limiter.waiting = 1
+    assert not limiter.has_capacity(0.0)
+    assert limiter.has_capacity(0.0, resuming=True)
+
+
+def test_scheduler_runs_jobs_and_reports_hosts():
+    with SegmentScheduler(max_workers=4, initial=2) as scheduler:
+        futures = [scheduler.submit('a.example', lambda i=i: i * 10) for i in range(5)]
+        futures.append(scheduler.for_host('b.example').submit(lambda: 1))
+        assert [future.result(timeout=5) for future in futures] == [0, 10, 20, 30, 40, 1]
+        stats = scheduler.stats()
+    assert stats['a.example']['done'] == 5
+    assert stats['b.example']['done'] == 1
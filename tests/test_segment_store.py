@@ -0,0 +1,57 @@
+import hashlib
+import pytest
+from segment_store import SegmentStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SegmentStore(str(tmp_path / 'cache'))
+    yield store
+    store.close()
+
+
+def test_add_then_fetch(store, tmp_path):
+    path = tmp_path / '1.ts'
+    path.write_bytes(b'segment')
+    digest = store.add('https://a.example/v/1.ts', str(path))
+    assert digest == hashlib.sha256(b'segment').hexdigest()
+    # looked up without the host, which changes on failover
+    dest = tmp_path / 'copy.ts'
+    assert store.fetch('https://b.example/v/1.ts', str(dest)) == len(b'segment')
+    assert dest.read_bytes() == b'segment'
+    assert store.fetch('https://a.example/v/1.ts', str(dest), tag='other key') is None
+
+
+def test_add_trusts_the_given_digest(store, tmp_path):
+    path = tmp_path / '1.ts'
+    path.write_bytes(b'segment')
+    store.add('/v/1.ts', str(path), digest='ab' * 32)
+    assert store.lookup('/v/1.ts')[0].endswith('ab' * 32)
+
+
+def test_truncated_blob_is_dropped(store, tmp_path):
+    store.add_bytes('/v/1.ts', b'segment')
+    blob, _ = store.lookup('/v/1.ts')
+    with open(blob, 'r+b') as f:
+        f.truncate(3)
+    assert store.lookup('/v/1.ts') is None
+    assert store.stats()['segments'] == 0
+
+
+def test_segment_with_another_length_is_downloaded_again(store, tmp_path):
+    store.add_bytes('https://a.example/v/1.ts', b'segment')
+    dest = tmp_path / '1.ts'
+    assert store.fetch('https://a.example/v/1.ts', str(dest), length=len(b'segment')) == len(b'segment')
+    # re-uploaded under the same url
+    assert store.fetch('https://a.example/v/1.ts', str(dest), length=len(b'new segment')) is None
+    assert not store.cached('https://a.example/v/1.ts')
+    store.add_bytes('https://a.example/v/1.ts', b'new segment')
+    assert store.read('https://a.example/v/1.ts', length=len(b'new segment')) == b'new segment'
+
+
+def test_length_of_a_decrypted_segment_is_the_origin_body(store, tmp_path):
+    path = tmp_path / '1.ts'
+    path.write_bytes(b'segment')
+    store.add('/v/1.ts', str(path), tag='key', length=16)
+    assert store.lookup('/v/1.ts', tag='key', length=16) is not None
+    assert store.lookup('/v/1.ts', tag='key', length=len(b'segment')) is None
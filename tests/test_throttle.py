@@ -0,0 +1,67 @@
+import pytest
+import throttle
+from throttle import BandwidthLimiter, parse_rate, parse_schedule, rate_at
+
+
+@pytest.mark.parametrize('spec, rate', [
+    ('0', 0.0),
+    ('off', 0.0),
+    ('512', 512.0),
+    ('100k', 100 * 1024.0),
+    ('2m', 2 * 1024 ** 2),
+    ('1.5M', 1.5 * 1024 ** 2),
+    ('1g', 1024.0 ** 3),
+    ('2mb/s', 2 * 1024 ** 2),
+    ('2MiB', 2 * 1024 ** 2),
+])
+def test_parse_rate(spec, rate):
+    assert parse_rate(spec) == rate
+
+
+@pytest.mark.parametrize('spec', ['fast', '2x', '-1', '1 m'])
+def test_parse_rate_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_rate(spec)
+
+
+def test_parse_schedule():
+    assert parse_schedule('08:00-23:00=2m, 23:00-24:00=0') == [(480, 1380, 2 * 1024 ** 2), (1380, 1440, 0.0)]
+    assert parse_schedule('') == []
+
+
+@pytest.mark.parametrize('spec', ['24:30-08:00=1m', '24:00-08:00=1m', '08:00-24:30=1m', '08:60-09:00=1m',
+                                  '08:00-25:00=1m', '8-9=1m', '08:00-09:00'])
+def test_parse_schedule_rejects(spec):
+    with pytest.raises(ValueError):
+        parse_schedule(spec)
+
+
+def test_rate_at_follows_the_windows():
+    windows = parse_schedule('08:00-23:00=2m,23:00-24:00=1m')
+    assert rate_at(windows, 7 * 60 + 59, 5.0) == 5.0
+    assert rate_at(windows, 8 * 60, 5.0) == 2 * 1024 ** 2
+    assert rate_at(windows, 22 * 60 + 59, 5.0) == 2 * 1024 ** 2
+    assert rate_at(windows, 23 * 60 + 59, 5.0) == 1024 ** 2
+
+
+def test_rate_at_wraps_past_midnight():
+    windows = parse_schedule('22:00-06:00=0')
+    assert rate_at(windows, 23 * 60, 9.0) == 0.0
+    assert rate_at(windows, 5 * 60, 9.0) == 0.0
+    assert rate_at(windows, 6 * 60, 9.0) == 9.0
+
+
+def test_reserve_paces_to_the_rate(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(throttle.time, 'monotonic', lambda: clock[0])
+    limiter = BandwidthLimiter(rate=1000, burst=1.0)
+    # one second of burst goes through, after that every byte waits its turn
+    assert limiter.reserve(1000) == 0.0
+    assert limiter.reserve(500) == pytest.approx(0.5)
+    assert limiter.reserve(500) == pytest.approx(1.0)
+    clock[0] += 10
+    assert limiter.reserve(1000) == 0.0
+
+
+def test_unlimited_never_waits():
+    assert BandwidthLimiter(rate=0).reserve(10 ** 9) == 0.0
@@ -0,0 +1,90 @@
+from datetime import datetime
+from watch import DAY, WatchSchedule
+
+WEDNESDAY = datetime(2026, 10, 14, 10, 0).timestamp()
+WEDNESDAY_START = datetime(2026, 10, 14).timestamp()
+
+
+def airing_schedule(**kwargs) -> WatchSchedule:
+    schedule = WatchSchedule(poll_interval=60, max_interval=240, grace=DAY, idle_interval=DAY / 2, **kwargs)
+    schedule.load_week({'Wednesday': [{'name': 'A', 'url': 'thread-1-1-1.html', 'update_color': '', 'color': ''}]})
+    schedule.add(1, WEDNESDAY)
+    assert schedule.pop_due(WEDNESDAY) == [1]
+    return schedule
+
+
+def test_load_week():
+    schedule = WatchSchedule()
+    schedule.load_week({
+        'Monday': [{'name': 'A', 'url': 'https://myself-bbs.com/thread-48174-1-1.html', 'update_color': '', 'color': ''}],
+        'Wednesday': [{'name': 'B', 'url': 'forum.php?mod=viewthread&tid=5', 'update_color': '', 'color': ''},
+                      {'name': 'C', 'url': 'https://example.com/', 'update_color': '', 'color': ''}],
+    })
+    assert schedule.airing == {48174: 0, 5: 2}
+
+
+def test_add_is_due_at_once_and_leaves_the_queue():
+    schedule = WatchSchedule()
+    schedule.add(1, 100.0)
+    assert schedule.wait(50.0) == 50.0
+    assert schedule.pop_due(100.0) == [1]
+    assert schedule.pop_due(100.0) == []
+    assert schedule.wait(100.0) is None
+
+
+def test_missed_backs_off_within_the_window():
+    schedule = airing_schedule()
+    now = WEDNESDAY
+    for interval in (60, 120, 240, 240):
+        schedule.missed(1, now)
+        assert schedule.due[1] == now + interval
+        now += interval
+        assert schedule.pop_due(now) == [1]
+
+
+def test_missed_after_grace_waits_for_next_week():
+    schedule = airing_schedule()
+    schedule.missed(1, WEDNESDAY_START + DAY - 30)
+    assert schedule.due[1] == WEDNESDAY_START + 7 * DAY
+
+
+def test_found_waits_for_next_week():
+    schedule = airing_schedule()
+    schedule.missed(1, WEDNESDAY)
+    schedule.pop_due(WEDNESDAY + 60)
+    schedule.found(1, WEDNESDAY + 60)
+    assert schedule.due[1] == WEDNESDAY_START + 7 * DAY
+    assert schedule.interval[1] == 60
+
+
+def test_failed_retries_even_after_the_window():
+    schedule = airing_schedule()
+    late = WEDNESDAY_START + 3 * DAY
+    schedule.failed(1, late)
+    assert schedule.due[1] == late + 60
+    schedule.pop_due(late + 60)
+    schedule.failed(1, late + 60)
+    assert schedule.due[1] == late + 60 + 120
+
+
+def test_show_off_the_schedule_is_checked_every_idle_interval():
+    schedule = WatchSchedule(idle_interval=DAY / 2)
+    schedule.add(7, WEDNESDAY)
+    schedule.pop_due(WEDNESDAY)
+    schedule.missed(7, WEDNESDAY)
+    assert schedule.due[7] == WEDNESDAY + DAY / 2
+    schedule.pop_due(WEDNESDAY + DAY / 2)
+    schedule.found(7, WEDNESDAY + DAY / 2)
+    assert schedule.due[7] == WEDNESDAY + DAY
+
+
+def test_removed_show_is_never_due():
+    schedule = WatchSchedule()
+    schedule.add(1, 100.0)
+    schedule.remove(1)
+    assert schedule.wait(100.0) is None
+    assert schedule.pop_due(200.0) == []
+    # late results of a check that was already running are ignored
+    schedule.missed(1, 200.0)
+    schedule.failed(1, 200.0)
+    assert 1 not in schedule.due
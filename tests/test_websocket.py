@@ -0,0 +1,57 @@
+import json
+import ssl
+import pytest
+import websocket
+import myself
+from myself import Myself, WebsocketPool, ws_opt
+
+
+class FakeSocket:
+    def __init__(self, opt: dict):
+        self.opt = opt
+        self.sent: list[dict] = []
+
+    def send(self, data: str):
+        self.sent.append(json.loads(data))
+
+    def recv(self) -> str:
+        return json.dumps({'video': '//host.example/video/1/index.m3u8'})
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def untrusted(monkeypatch):
+    """create_connection that fails certificate verification unless it is turned off."""
+    connections: list[FakeSocket] = []
+
+    def create_connection(**opt):
+        if 'sslopt' not in opt:
+            raise ssl.SSLCertVerificationError('self signed')
+        connections.append(FakeSocket(opt))
+        return connections[-1]
+
+    monkeypatch.setattr(websocket, 'create_connection', create_connection)
+    return connections
+
+
+def test_single_connection_fallback_leaves_ws_opt_alone(monkeypatch, untrusted):
+    monkeypatch.setattr(myself, 'ws_pool', WebsocketPool(size=0))
+    before = dict(ws_opt)
+    video_url, m3u8_url = Myself.ws_get_host_and_m3u8_url(tid='1', vid='2', video_id='')
+    assert m3u8_url == 'https://host.example/video/1/index.m3u8'
+    assert video_url == 'https://host.example/video/1'
+    assert untrusted[0].opt['sslopt'] == {'cert_reqs': ssl.CERT_NONE}
+    assert ws_opt == before
+
+
+def test_pool_turns_verification_off_for_itself_only(untrusted):
+    pool = WebsocketPool(size=2)
+    before = dict(ws_opt)
+    pool.request({'tid': '1'})
+    pool.request({'tid': '2'})
+    assert pool.connects == 1
+    assert pool.requests == 2
+    assert untrusted[0].sent == [{'tid': '1'}, {'tid': '2'}]
+    assert ws_opt == before
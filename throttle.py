@@ -0,0 +1,122 @@
+import logging
+import re
+import threading
+import time
+from datetime import datetime
+from metrics import metrics
+
+log = logging.getLogger("rich")
+
+RATE_HELP = 'bytes/s with an optional k, m or g suffix (1024 based, like curl --limit-rate), 0 is unlimited'
+SCHEDULE_HELP = 'comma separated HH:MM-HH:MM=RATE windows in local time, e.g. 08:00-23:00=2m, outside them --limit-rate applies'
+
+Window = tuple[int, int, float]
+
+
+def parse_rate(spec: str) -> float:
+    """'2m' -> 2097152.0, raise ValueError when it is not a rate."""
+    spec = spec.strip().lower()
+    if spec in ('', 'off', 'unlimited'):
+        return 0.0
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([kmg]?)(?:i?b)?(?:/s)?', spec)
+    if match is None:
+        raise ValueError(f'unknown rate "{spec}", expected {RATE_HELP}')
+    return float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2) or ' ')
+
+
+def parse_schedule(spec: str) -> list[Window]:
+    """
+    '08:00-23:00=2m' -> [(480, 1380, 2097152.0)], start and end in minutes
+    of the day. Times run from 00:00 to 23:59, an end may also be 24:00.
+    """
+    windows: list[Window] = []
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)', part)
+        if match is None:
+            raise ValueError(f'unknown schedule window "{part}", expected HH:MM-HH:MM=RATE')
+        h1, m1, h2, m2 = map(int, match.groups()[:4])
+        if h1 > 23 or m1 > 59 or m2 > 59 or h2 > 24 or (h2 == 24 and m2 > 0):
+            raise ValueError(f'schedule window "{part}" is not within 00:00-24:00')
+        windows.append((h1 * 60 + m1, h2 * 60 + m2, parse_rate(match.group(5))))
+    return windows
+
+
+def rate_at(windows: list[Window], minute: int, default: float) -> float:
+    """Rate of the first window covering `minute`, windows may wrap past midnight."""
+    for start, end, rate in windows:
+        if start <= minute < end if start <= end else minute >= start or minute < end:
+            return rate
+    return default
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by every segment download in the process.
+
+    Implemented as GCRA: the bucket is a single "theoretical arrival time"
+    and a caller reserves its bytes by pushing it forward, then sleeps off
+    its own share outside the lock. The lock only covers a couple of float
+    operations, so hundreds of workers never queue behind someone who is
+    waiting, and because every byte is reserved exactly once the aggregate
+    rate stays on target however many workers there are. `burst` seconds
+    worth of bytes may go through at once after an idle spell.
+
+    With a schedule the rate follows the time of day and is looked up at
+    most once a second.
+    """
+
+    def __init__(self, rate: float = 0, schedule: list[Window] | None = None, burst: float = 1.0):
+        self._lock = threading.Lock()
+        self.configure(rate, schedule, burst)
+
+    def configure(self, rate: float = 0, schedule: list[Window] | None = None, burst: float = 1.0):
+        """
+        :param rate: bytes/s outside the schedule, 0 is unlimited.
+        :param schedule: windows from parse_schedule that override rate.
+        :param burst: seconds of traffic allowed through at once.
+        """
+        with self._lock:
+            self.rate = rate
+            self.schedule = schedule or []
+            self.burst = burst
+            self._tat = time.monotonic()
+            self._current = rate
+            self._checked = 0.0
+
+    def current_rate(self) -> float:
+        if not self.schedule:
+            return self.rate
+        now = time.monotonic()
+        if now - self._checked >= 1.0:
+            local = datetime.now()
+            current = rate_at(self.schedule, local.hour * 60 + local.minute, self.rate)
+            if current != self._current:
+                log.info(f'bandwidth limit now {current / 1024:.0f} KiB/s' if current else 'bandwidth limit lifted')
+            self._current, self._checked = current, now
+        return self._current
+
+    def reserve(self, nbytes: int) -> float:
+        """Account `nbytes` and return how long the caller has to wait before using them."""
+        rate = self.current_rate()
+        if rate <= 0 or nbytes <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tat = max(self._tat, now) + nbytes / rate
+            wait = self._tat - now - self.burst
+        if wait > 0:
+            metrics.inc('throttled_seconds_total', wait)
+            return wait
+        return 0.0
+
+    def consume(self, nbytes: int):
+        if (wait := self.reserve(nbytes)) > 0:
+            time.sleep(wait)
+
+    async def consume_async(self, nbytes: int):
+        import asyncio
+        if (wait := self.reserve(nbytes)) > 0:
+            await asyncio.sleep(wait)
+
+
+bandwidth = BandwidthLimiter()
@@ -2,10 +2,6 @@
 
 source ./venv/bin/activate
 
-array=($(cat ./subscribed.txt))
-
-for id in "${array[@]}"; do
-	python ./main.py download -d /net/truenas.lan/mnt/main/hank/Anime "$id"
-done
+python ./main.py sync -d /net/truenas.lan/mnt/main/hank/Anime ./subscribed.txt
 
 deactivate
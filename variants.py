@@ -0,0 +1,171 @@
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, TypedDict
+from scheduler import host_of
+
+if TYPE_CHECKING:
+    import m3u8
+
+log = logging.getLogger("rich")
+
+QUALITY_HELP = 'best, worst, auto (measured throughput), a height like 720p or a bitrate cap like 1500k'
+
+# keep some room below the measured rate so other episodes and jitter still fit
+HEADROOM = 0.8
+
+
+class VariantDict(TypedDict):
+    uri: str
+    bandwidth: int
+    resolution: tuple[int, int] | None
+    codecs: str | None
+
+
+def parse_quality(spec: str) -> str:
+    """Normalise a --quality value, raise ValueError when it is not one of QUALITY_HELP."""
+    spec = spec.strip().lower()
+    if spec in ('best', 'worst', 'auto') or re.fullmatch(r'\d+p|\d+k?', spec):
+        return spec
+    raise ValueError(f'unknown quality "{spec}", expected {QUALITY_HELP}')
+
+
+def variants_of(master: 'm3u8.M3U8') -> list[VariantDict]:
+    """Variants of a master playlist with absolute uris, lowest bitrate first."""
+    variants: list[VariantDict] = [{
+        'uri': playlist.absolute_uri,
+        'bandwidth': playlist.stream_info.average_bandwidth or playlist.stream_info.bandwidth or 0,
+        'resolution': playlist.stream_info.resolution,
+        'codecs': playlist.stream_info.codecs,
+    } for playlist in master.playlists]
+    return sorted(variants, key=lambda v: (v['bandwidth'], v['resolution'] or (0, 0)))
+
+
+def variant_label(variant: VariantDict) -> str:
+    if variant['resolution'] is not None:
+        return f'{variant["resolution"][1]}p'
+    return f'{variant["bandwidth"] // 1000}k'
+
+
+def choose_variant(variants: list[VariantDict], quality: str, throughput: float | None = None) -> VariantDict:
+    """
+    Pick a variant for `quality` (see parse_quality). Height and bitrate caps
+    take the best variant under the cap and fall back to the lowest one.
+    `throughput` is in bytes/s and only used by auto.
+    """
+    if quality == 'best' or (quality == 'auto' and throughput is None):
+        return variants[-1]
+    if quality == 'worst':
+        return variants[0]
+
+    if quality == 'auto':
+        fits = lambda v: v['bandwidth'] <= throughput * 8 * HEADROOM
+    elif quality.endswith('p'):
+        fits = lambda v: v['resolution'] is not None and v['resolution'][1] <= int(quality[:-1])
+    elif quality.endswith('k'):
+        fits = lambda v: v['bandwidth'] <= int(quality[:-1]) * 1000
+    else:
+        fits = lambda v: v['bandwidth'] <= int(quality)
+
+    candidates = [v for v in variants if fits(v)]
+    return candidates[-1] if candidates else variants[0]
+
+
+# bytes/s measured per host, so only the first episode of a run pays for the probe
+_throughput: dict[str, float] = {}
+_throughput_lock = threading.Lock()
+
+
+def measured_throughput(host: str) -> float | None:
+    with _throughput_lock:
+        return _throughput.get(host)
+
+
+def record_throughput(host: str, rate: float):
+    with _throughput_lock:
+        _throughput[host] = rate
+
+
+def needs_probe(variants: list[VariantDict], quality: str, probe_segments: int) -> bool:
+    """Whether auto has to measure the link first, the host was not measured yet in this process."""
+    return quality == 'auto' and probe_segments > 0 and measured_throughput(host_of(variants[0]['uri'])) is None
+
+
+def record_probe(segment_url: str, size: int, seconds: float) -> float:
+    """Remember the rate of a probe that moved `size` bytes in `seconds` for the host of `segment_url`."""
+    rate = size / max(seconds, 1e-6)
+    record_throughput(host_of(segment_url), rate)
+    log.info(f'measured {rate * 8 / 1e6:.1f} Mbit/s against {host_of(segment_url)}')
+    return rate
+
+
+def probe_throughput(segment_urls: list[str], fetch: Callable[[str], bytes]) -> float | None:
+    """Fetch the segments in parallel and return the aggregate rate in bytes/s."""
+    if not segment_urls:
+        return None
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=len(segment_urls)) as executor:
+            size = sum(len(content) for content in executor.map(fetch, segment_urls))
+    except ValueError as e:
+        log.warning(f'throughput probe failed: {e}')
+        return None
+    return record_probe(segment_urls[0], size, time.perf_counter() - start)
+
+
+def pick_variant(variants: list[VariantDict], quality: str) -> VariantDict:
+    """choose_variant with what was measured against the host so far."""
+    chosen = choose_variant(variants, quality, measured_throughput(host_of(variants[0]['uri'])))
+    log.info(f'picked {variant_label(chosen)} ({chosen["bandwidth"] // 1000} kbit/s) '
+             f'of {", ".join(variant_label(v) for v in variants)}')
+    return chosen
+
+
+def media_playlist(m3u8_url: str,
+                   text: str,
+                   fetch_text: Callable[[str], str],
+                   fetch_content: Callable[[str], bytes] | None = None,
+                   quality: str = 'best',
+                   probe_segments: int = 2) -> 'tuple[m3u8.M3U8, str, VariantDict | None]':
+    """
+    Resolve the playlist at `m3u8_url` to a media playlist.
+
+    A media playlist is returned as is. For a master playlist a variant is
+    picked by `quality` and its playlist fetched with `fetch_text`; auto
+    first downloads `probe_segments` segments of the lowest variant with
+    `fetch_content` to measure the link, unless the host was measured
+    already in this process. The async engine does the same I/O on the loop
+    around needs_probe, record_probe and pick_variant.
+
+    :return: media playlist, its url and the chosen variant (None for a media playlist).
+    """
+    import m3u8
+    playlist = m3u8.loads(text, uri=m3u8_url)
+    if not playlist.is_variant:
+        return playlist, m3u8_url, None
+
+    variants = variants_of(playlist)
+    probed: m3u8.M3U8 | None = None
+    if fetch_content is not None and needs_probe(variants, quality, probe_segments):
+        probed = m3u8.loads(fetch_text(variants[0]['uri']), uri=variants[0]['uri'])
+        probe_throughput([s.absolute_uri for s in probed.segments[:probe_segments]], fetch_content)
+
+    chosen = pick_variant(variants, quality)
+    if probed is not None and chosen is variants[0]:
+        return probed, chosen['uri'], chosen
+    return m3u8.loads(fetch_text(chosen['uri']), uri=chosen['uri']), chosen['uri'], chosen
+
+
+def variant_path(video_url: str, media_url: str) -> str | None:
+    """
+    Path of the media playlist's directory below the episode's video_url,
+    '' when they are the same and None when the variant lives elsewhere.
+    """
+    media_dir = media_url[:media_url.rfind('/')]
+    if media_dir == video_url:
+        return ''
+    if media_dir.startswith(video_url + '/'):
+        return media_dir[len(video_url):]
+    return None
@@ -0,0 +1,119 @@
+import heapq
+import logging
+from datetime import datetime, timedelta
+from catalog import thread_id_of
+from myself import WeekAnimeDict, week
+
+log = logging.getLogger("rich")
+
+DAY = 24 * 60 * 60
+
+
+class WatchSchedule:
+    """
+    When each subscribed show should be looked at next, as a priority queue.
+
+    A show on the weekly schedule is checked from the start of its update
+    day. Nothing new doubles the wait between checks, from `poll_interval`
+    up to `max_interval`. Once a new episode turns up, or `grace` seconds
+    after the start of the update day have passed, the show waits for the
+    same day next week. A show that is not on the weekly schedule is
+    checked every `idle_interval`.
+
+    Times are epoch seconds. The heap may hold stale entries; `due` holds
+    the current time of each show.
+    """
+
+    def __init__(self,
+                 poll_interval: float = 15 * 60,
+                 max_interval: float = 4 * 60 * 60,
+                 grace: float = 2 * DAY,
+                 idle_interval: float = DAY):
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.grace = grace
+        self.idle_interval = idle_interval
+        self.airing: dict[int, int] = {}
+        self.due: dict[int, float] = {}
+        self.interval: dict[int, float] = {}
+        self._heap: list[tuple[float, int]] = []
+
+    def load_week(self, week_anime: WeekAnimeDict):
+        """Take the update day of every show from Myself.week_anime."""
+        weekdays = {name: index for index, name in week.items()}
+        self.airing = {thread_id: weekdays[day]
+                       for day, animes in week_anime.items()
+                       for anime in animes
+                       if (thread_id := thread_id_of(anime['url'])) is not None}
+
+    def _window(self, thread_id: int, now: float) -> tuple[float, float] | None:
+        """Start and end of the update window of an airing show that started last, which may be today."""
+        if (weekday := self.airing.get(thread_id)) is None:
+            return None
+        today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        start = today - timedelta(days=(today.weekday() - weekday) % 7)
+        return start.timestamp(), start.timestamp() + self.grace
+
+    def _push(self, thread_id: int, due: float):
+        self.due[thread_id] = due
+        heapq.heappush(self._heap, (due, thread_id))
+
+    def add(self, thread_id: int, now: float):
+        """A show that was just subscribed to is checked right away."""
+        self.interval[thread_id] = self.poll_interval
+        self._push(thread_id, now)
+
+    def remove(self, thread_id: int):
+        self.due.pop(thread_id, None)
+        self.interval.pop(thread_id, None)
+
+    def _next_week(self, thread_id: int, now: float) -> float:
+        self.interval[thread_id] = self.poll_interval
+        if (window := self._window(thread_id, now)) is None:
+            return now + self.idle_interval
+        return window[0] + 7 * DAY
+
+    def found(self, thread_id: int, now: float):
+        """New episodes turned up, wait for the next update day."""
+        if thread_id in self.due:
+            self._push(thread_id, self._next_week(thread_id, now))
+
+    def missed(self, thread_id: int, now: float):
+        """Nothing new, check again after a longer wait or next week once the window is over."""
+        if thread_id not in self.due:
+            return
+        window = self._window(thread_id, now)
+        if window is None:
+            self._push(thread_id, now + self.idle_interval)
+            return
+        interval = self.interval.get(thread_id, self.poll_interval)
+        if now + interval < window[1]:
+            self.interval[thread_id] = min(interval * 2, self.max_interval)
+            self._push(thread_id, now + interval)
+        else:
+            self._push(thread_id, self._next_week(thread_id, now))
+
+    def failed(self, thread_id: int, now: float):
+        """The check or a download failed, retry with backoff whether or not the window is over."""
+        if thread_id not in self.due:
+            return
+        interval = self.interval.get(thread_id, self.poll_interval)
+        self.interval[thread_id] = min(interval * 2, self.max_interval)
+        self._push(thread_id, now + interval)
+
+    def wait(self, now: float) -> float | None:
+        """Seconds until the next show is due, None when nothing is scheduled."""
+        while self._heap and self.due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - now, 0.0)
+
+    def pop_due(self, now: float) -> list[int]:
+        """Shows that are due, they stay subscribed but leave the queue until found or missed."""
+        shows = []
+        while (wait := self.wait(now)) is not None and wait <= 0:
+            _, thread_id = heapq.heappop(self._heap)
+            self.due[thread_id] = float('inf')
+            shows.append(thread_id)
+        return shows